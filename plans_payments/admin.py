@@ -1,10 +1,16 @@
 from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
+from django.db.models import BooleanField
+from django.urls import reverse
+from django.utils.html import format_html
 from payments import PaymentStatus
 from plans.models import Order
 from related_admin import RelatedFieldAdmin
 
 from . import models
+from .facets import FACET_FIELDS, facet_counts_enabled, get_facet_counts
+from .jobs import JOB_ACTIONS, create_job
+from .routers import render_from_replica
 
 
 class FaultyPaymentsFilter(SimpleListFilter):
@@ -22,6 +28,78 @@ class FaultyPaymentsFilter(SimpleListFilter):
         return queryset
 
 
+class FacetCountListFilter(SimpleListFilter):
+    """Filter on ``field_name`` taking its values and counts from ``PaymentFacetCount``."""
+
+    field_name = None
+
+    def lookups(self, request, model_admin):
+        field = model_admin.model._meta.get_field(self.field_name)
+        if isinstance(field, BooleanField):
+            labels = {True: "Yes", False: "No"}
+        else:
+            labels = dict(field.flatchoices)
+        values = get_facet_counts().get(self.field_name, {})
+        return [(value, labels.get(field.to_python(value), value)) for value in sorted(values)]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            return queryset.filter(**{self.field_name: self.value()})
+        return queryset
+
+    def get_facet_queryset(self, changelist):
+        other_filters = set(changelist.get_filters_params()) - set(self.expected_parameters())
+        if other_filters or changelist.query:
+            # The stored counts are for the whole table
+            return super().get_facet_queryset(changelist)
+        counts = get_facet_counts().get(self.field_name, {})
+        return {f"{i}__c": counts.get(value, 0) for i, (value, _) in enumerate(self.lookup_choices)}
+
+
+def facet_count_filter(field_name):
+    return type(
+        f"{field_name.title().replace('_', '')}FacetCountListFilter",
+        (FacetCountListFilter,),
+        {"field_name": field_name, "parameter_name": field_name, "title": field_name.replace("_", " ")},
+    )
+
+
+def job_action(action):
+    """Admin action queueing ``action`` for the selected payments."""
+
+    def queue_job(modeladmin, request, queryset):
+        job = create_job(action, queryset.values_list("pk", flat=True).iterator(), user=request.user)
+        url = reverse("admin:plans_payments_adminjob_change", args=[job.pk])
+        modeladmin.message_user(
+            request, format_html('<a href="{}">{}</a> queued for {} payments', url, job, job.total)
+        )
+
+    return queue_job
+
+
+class PaymentGatewayFieldInline(admin.TabularInline):
+    model = models.PaymentGatewayField
+    fields = ("key", "value")
+    readonly_fields = ("key", "value")
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class PaymentEventInline(admin.TabularInline):
+    model = models.PaymentEvent
+    fields = ("created", "kind", "value")
+    readonly_fields = ("created", "kind", "value")
+    ordering = ("created", "pk")
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(models.Payment)
 class PaymentAdmin(RelatedFieldAdmin):
     list_display = (
@@ -57,10 +135,191 @@ class PaymentAdmin(RelatedFieldAdmin):
         "transaction_id",
         "extra_data",
         "token",
+        "=gateway_fields__value",
     )
     list_select_related = ("order__user",)
     autocomplete_fields = ("order",)
+    inlines = (PaymentGatewayFieldInline, PaymentEventInline)
     readonly_fields = (
+        "user",
         "created",
         "modified",
     )
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if facet_counts_enabled():
+            return [facet_count_filter(name) if name in FACET_FIELDS else name for name in list_filter]
+        return list_filter
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        if self.has_change_permission(request):
+            for action, (label, _) in JOB_ACTIONS.items():
+                name = f"job_{action}"
+                actions[name] = (job_action(action), name, label)
+        return actions
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method == "POST":
+            # Admin actions write
+            return super().changelist_view(request, extra_context=extra_context)
+        # Changelist, filters and counts are read-only - serve them from a replica
+        return render_from_replica(super().changelist_view, request, extra_context=extra_context)
+
+
+@admin.register(models.AdminJob)
+class AdminJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "action",
+        "status",
+        "progress",
+        "failed",
+        "created_by",
+        "created",
+        "finished",
+    )
+    list_filter = ("status", "action")
+    list_select_related = ("created_by",)
+    fields = (
+        "action",
+        "status",
+        "progress",
+        "failed",
+        "results",
+        "created_by",
+        "created",
+        "started",
+        "finished",
+    )
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description="progress")
+    def progress(self, obj):
+        percent = 100 * obj.processed // obj.total if obj.total else 100
+        return f"{obj.processed}/{obj.total} ({percent} %)"
+
+    @admin.display(description="results")
+    def results(self, obj):
+        url = reverse("admin:plans_payments_adminjobitem_changelist")
+        failed_url = f"{url}?job__id__exact={obj.pk}&status__exact={models.AdminJobItem.Status.FAILED}"
+        return format_html(
+            '<a href="{}?job__id__exact={}">all payments</a>, <a href="{}">failed payments</a>',
+            url,
+            obj.pk,
+            failed_url,
+        )
+
+
+@admin.register(models.AdminJobItem)
+class AdminJobItemAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "job",
+        "payment",
+        "status",
+        "message",
+        "processed",
+    )
+    list_filter = ("status", "job__action")
+    list_select_related = ("job", "payment")
+    readonly_fields = ("job", "payment", "status", "message", "processed")
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(models.RenewalSlot)
+class RenewalSlotAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "user",
+        "variant",
+        "run_at",
+        "status",
+        "message",
+        "processed",
+    )
+    list_filter = ("status", "variant")
+    list_select_related = ("user",)
+    raw_id_fields = ("recurring", "user")
+    readonly_fields = ("message", "processed")
+
+
+@admin.register(models.RenewalRetry)
+class RenewalRetryAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "user",
+        "variant",
+        "status",
+        "attempts",
+        "next_attempt",
+        "decline_code",
+        "modified",
+    )
+    list_filter = ("status", "variant", "decline_code")
+    list_select_related = ("user",)
+    raw_id_fields = ("recurring", "user", "payment")
+
+
+@admin.register(models.RenewalRun)
+class RenewalRunAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "status",
+        "providers",
+        "renewed",
+        "skipped",
+        "failed",
+        "deferred",
+        "started",
+        "checkpointed",
+        "finished",
+    )
+    list_filter = ("status",)
+    fields = (
+        "status",
+        "providers",
+        "renewed",
+        "skipped",
+        "failed",
+        "deferred",
+        "entries",
+        "last_expire",
+        "last_recurring_id",
+        "started",
+        "checkpointed",
+        "finished",
+    )
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description="entries")
+    def entries(self, obj):
+        url = reverse("admin:plans_payments_renewalrunentry_changelist")
+        return format_html('<a href="{}?run__id__exact={}">accounts</a>', url, obj.pk)
+
+
+@admin.register(models.RenewalRunEntry)
+class RenewalRunEntryAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "run",
+        "user",
+        "outcome",
+        "message",
+        "processed",
+    )
+    list_filter = ("outcome",)
+    list_select_related = ("run", "user")
+    readonly_fields = ("run", "recurring", "user", "outcome", "message", "processed")
+
+    def has_add_permission(self, request):
+        return False
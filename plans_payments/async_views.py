@@ -0,0 +1,155 @@
+"""
+Async versions of the payment views for ASGI deployments.
+
+Database access uses Django's async ORM, and the provider's ``get_form()``
+(which may call the gateway and change the payment) runs on a bounded thread
+pool of ``PLANS_PAYMENTS_ASYNC_PROVIDER_WORKERS`` threads (``10``; ``0`` runs
+provider calls on the thread-sensitive executor shared with the ORM). A worker
+can thus keep many slow gateway round-trips in flight while at most that many
+threads are blocked on them.
+
+Select them with ``PLANS_PAYMENTS_ASYNC_VIEWS = True``, ``plans_payments.urls``
+then routes ``payment_details`` and ``create_payment`` to these views.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import close_old_connections
+from django.http import Http404
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import reverse, reverse_lazy
+from django.views.generic import View
+from payments import RedirectNeeded, get_payment_model
+from plans.models import Order
+
+from .routers import get_primary_database, get_replica_database, mark_primary_write, primary_reads, replica_is_fresh
+from .users import user_filter
+from .utils import get_payment_kwargs
+
+# Relations create_payment_object() reads from the order
+PAYMENT_ORDER_RELATED = ("plan", "pricing", "user__billinginfo", "user__userplan__recurring")
+
+_provider_executor = None
+_provider_executor_lock = threading.Lock()
+
+
+def get_provider_executor():
+    """Return the thread pool for provider calls, ``None`` if disabled."""
+    global _provider_executor
+    workers = getattr(settings, "PLANS_PAYMENTS_ASYNC_PROVIDER_WORKERS", 10)
+    if not workers:
+        return None
+    with _provider_executor_lock:
+        if _provider_executor is None or _provider_executor._max_workers != workers:
+            _provider_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plans-payments-provider")
+        return _provider_executor
+
+
+def _in_provider_thread(func):
+    def call(*args, **kwargs):
+        # Pool threads are not request threads, honour CONN_MAX_AGE here
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return call
+
+
+async def run_provider_call(func, *args, **kwargs):
+    """Await blocking provider call ``func(*args, **kwargs)`` on the provider pool."""
+    executor = get_provider_executor()
+    if executor is None:
+        return await sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+    return await sync_to_async(_in_provider_thread(func), thread_sensitive=False, executor=executor)(*args, **kwargs)
+
+
+async def acreate_payment_object(payment_variant, order, request=None, autorenewed_payment=False):
+    """Async ``create_payment_object``, ``order`` is loaded with ``PAYMENT_ORDER_RELATED``."""
+    Payment = get_payment_model()
+    with primary_reads():
+        if (
+            hasattr(order.user.userplan, "recurring")
+            and order.user.userplan.recurring.payment_provider != payment_variant
+        ):
+            await order.user.userplan.recurring.adelete()
+        return await Payment.objects.acreate(
+            **get_payment_kwargs(payment_variant, order, request, autorenewed_payment)
+        )
+
+
+def _resolve_user(request):
+    # Accessing the lazy request.user loads it
+    request.user.is_authenticated
+    return request.user
+
+
+async def aget_user(request):
+    if hasattr(request, "auser"):
+        return await request.auser()
+    # Django < 5.0
+    return await sync_to_async(_resolve_user)(request)
+
+
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    async def dispatch(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        # Resolved, so that sync code (handle_no_permission, templates) can use it
+        request.user = user
+        if not user.is_authenticated:
+            return self.handle_no_permission()
+        return await super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+
+
+class AsyncPaymentDetailView(AsyncLoginRequiredMixin, View):
+    login_url = reverse_lazy("auth_login")
+    template_name = "plans_payments/payment.html"
+
+    async def get_payment(self, request, payment_id):
+        payments = get_payment_model().objects.filter(**user_filter(request.user))
+        # The session may not be loaded yet
+        if await sync_to_async(replica_is_fresh)(request):
+            try:
+                payment = await payments.using(get_replica_database()).aget(id=payment_id)
+            except ObjectDoesNotExist:
+                # Replication lag - the replica does not have the payment yet
+                pass
+            else:
+                # The provider may update the payment while building the form
+                payment._state.db = get_primary_database()
+                return payment
+        try:
+            return await payments.aget(id=payment_id)
+        except ObjectDoesNotExist:
+            raise Http404("No Payment matches the given query.")
+
+    async def get(self, request, *args, payment_id=None):
+        payment = await self.get_payment(request, payment_id)
+        try:
+            form = await run_provider_call(payment.get_form, data=request.POST or None)
+        except RedirectNeeded as redirect_to:
+            await payment.asave()
+            await sync_to_async(mark_primary_write)(request)
+            return redirect(str(redirect_to))
+        return TemplateResponse(request, self.template_name, {"form": form, "payment": payment})
+
+
+class AsyncCreatePaymentView(AsyncLoginRequiredMixin, View):
+    login_url = reverse_lazy("auth_login")
+
+    async def get(self, request, *args, order_id=None, payment_variant=None):
+        with primary_reads():
+            try:
+                order = await Order.objects.select_related(*PAYMENT_ORDER_RELATED).aget(pk=order_id, user=request.user)
+            except Order.DoesNotExist:
+                raise Http404("No Order matches the given query.")
+        payment = await acreate_payment_object(payment_variant, order, request)
+        await sync_to_async(mark_primary_write)(request)
+        return redirect(reverse("payment_details", kwargs={"payment_id": payment.id}))
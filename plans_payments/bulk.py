@@ -0,0 +1,199 @@
+"""
+Bulk payment status updates for settlement and batch reports.
+
+Applying thousands of gateway confirmations through ``payment.change_status()``
+runs ``change_payment_status`` and its order queries once per row. The API
+here updates ``Payment`` rows with one compare-and-swap ``UPDATE`` per
+distinct status transition and batch (see ``transitions``), and then runs the
+order completion, cancellation and return logic of ``change_payment_status``
+set-wise, reaching the same end state. Payments whose status changed
+concurrently are left as they are, and statuses ``PAYMENT_TRANSITIONS`` does
+not allow are skipped.
+
+The ``status_changed`` signal is not sent for bulk updates, and the order
+cancellation is a queryset ``UPDATE`` (django-simple-history does not record
+it).
+"""
+
+import logging
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+from plans.models import Order, RecurringUserPlan
+
+from .cdc import record_payment_changes
+from .events import EventKind, make_event, record_events
+from .facets import apply_facet_deltas, facet_counts_enabled
+from .transitions import PAYMENT_TRANSITIONS, complete_order, return_order, transition_orders, transition_payments
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+# Number of unmatched identifiers kept in BulkStatusResult.missing
+MISSING_SAMPLE_SIZE = 100
+
+# Payment statuses with which change_payment_status keeps the order as it is
+ORDER_KEEPING_STATUSES = (
+    PaymentStatus.CONFIRMED,
+    PaymentStatus.WAITING,
+    PaymentStatus.INPUT,
+)
+
+
+@dataclass
+class BulkStatusResult:
+    #: Number of payment rows matched by the updates
+    updated: int = 0
+    #: Number of payments whose status changed
+    changed: int = 0
+    #: Number of payments skipped as PAYMENT_TRANSITIONS does not allow their new status
+    invalid_transitions: int = 0
+    #: Number of identifiers that did not match any payment
+    missing_count: int = 0
+    #: The first MISSING_SAMPLE_SIZE of them
+    missing: list = field(default_factory=list)
+    #: Orders of refunded payments that could not be returned
+    unreturnable_orders: list = field(default_factory=list)
+
+
+def bulk_change_status(updates, key="transaction_id", batch_size=500, gateway_field=None):
+    """Apply ``(identifier, new_status, fee)`` tuples to payments in batches.
+
+    ``identifier`` is matched against the ``key`` field of ``Payment``
+    (``transaction_id`` or ``pk``), or against the value of the given
+    ``gateway_field`` (e.g. PayPal ``sale_id``, see ``gateway_fields``),
+    converted to the field's type first.
+    ``new_status`` or ``fee`` may be ``None`` to leave the status or the
+    transaction fee unchanged; a given fee is stored as settled. ``updates``
+    may be any iterable (e.g. a generator over a settlement file); it is
+    consumed lazily, one batch at a time, each batch in its own transaction.
+    """
+    result = BulkStatusResult()
+    for batch in chunked(updates, batch_size):
+        with transaction.atomic():
+            _apply_batch(batch, key, gateway_field, result)
+    return result
+
+
+def _add_missing(result, identifier):
+    result.missing_count += 1
+    if len(result.missing) < MISSING_SAMPLE_SIZE:
+        result.missing.append(identifier)
+
+
+def _apply_batch(batch, key, gateway_field, result):
+    Payment = get_payment_model()
+    # As the database returns them, e.g. "1" is pk 1 and 123 the transaction id "123"
+    if gateway_field is not None:
+        normalize = str
+    else:
+        normalize = (Payment._meta.pk if key == "pk" else Payment._meta.get_field(key)).to_python
+    requested = {}
+    for identifier, status, fee in batch:
+        try:
+            requested[normalize(identifier)] = (status, fee)
+        except ValidationError:
+            _add_missing(result, identifier)
+    if gateway_field is None:
+        rows = Payment.objects.filter(**{f"{key}__in": list(requested)}).values_list(
+            "pk", key, "order_id", "status", "transaction_fee"
+        )
+    else:
+        rows = Payment.objects.filter(
+            gateway_fields__key=gateway_field,
+            gateway_fields__value__in=list(requested),
+        ).values_list("pk", "gateway_fields__value", "order_id", "status", "transaction_fee")
+
+    matched = set()
+    pks_by_transition = defaultdict(list)
+    order_ids = {}
+    order_ids_by_status = defaultdict(set)
+    fee_updates = []
+    fee_events = []
+    facet_deltas = Counter()
+    now = timezone.now()
+    for pk, identifier, order_id, old_status, old_fee in rows:
+        matched.add(identifier)
+        status, fee = requested[identifier]
+        if status == old_status:
+            # Reported again, the order transitions still apply
+            if order_id is not None:
+                order_ids_by_status[status].add(order_id)
+        elif status in PAYMENT_TRANSITIONS.get(old_status, ()):
+            pks_by_transition[old_status, status].append(pk)
+            order_ids[pk] = order_id
+        elif status is not None:
+            logger.warning("Payment %s cannot change from %s to %s, skipped", pk, old_status, status)
+            result.invalid_transitions += 1
+        if fee is not None:
+            fee_updates.append(Payment(pk=pk, transaction_fee=Decimal(fee), transaction_fee_settled=True))
+            if Decimal(fee) != old_fee:
+                fee_events.append(make_event(pk, EventKind.FEE, Decimal(fee), now))
+    result.updated += len(rows)
+    for identifier in requested:
+        if identifier not in matched:
+            _add_missing(result, identifier)
+
+    changed = set()
+    events = []
+    for (old_status, status), pks in pks_by_transition.items():
+        if transition_payments(pks, status, old_status, now) < len(pks):
+            # Some changed concurrently since read; the updated rows stay locked
+            pks = list(Payment.objects.filter(pk__in=pks, status=status, modified=now).values_list("pk", flat=True))
+        changed.update(pks)
+        facet_deltas["status", old_status] -= len(pks)
+        facet_deltas["status", status] += len(pks)
+        for pk in pks:
+            events.append(make_event(pk, EventKind.STATUS, status, now))
+            if order_ids[pk] is not None:
+                order_ids_by_status[status].add(order_ids[pk])
+    result.changed += len(changed)
+    if fee_updates:
+        Payment.objects.bulk_update(fee_updates, ["transaction_fee", "transaction_fee_settled"])
+    if events or fee_events:
+        record_events(events + fee_events)
+    record_payment_changes(sorted(changed | {p.pk for p in fee_updates}))
+    if facet_counts_enabled():
+        apply_facet_deltas(facet_deltas)
+    apply_order_transitions(order_ids_by_status, result)
+
+
+def apply_order_transitions(order_ids_by_status, result):
+    """Set-wise equivalent of ``change_payment_status`` for many orders.
+
+    ``order_ids_by_status`` maps the new payment status to the ids of the
+    orders of the payments that got it.
+    """
+    confirmed = order_ids_by_status.get(PaymentStatus.CONFIRMED, set())
+    if confirmed:
+        user_ids = Order.objects.filter(pk__in=confirmed).values("user_id")
+        RecurringUserPlan.objects.filter(user_plan__user__in=user_ids).update(token_verified=True)
+        for order_id in Order.objects.filter(pk__in=confirmed, completed__isnull=True).values_list("pk", flat=True):
+            complete_order(Order(pk=order_id))
+
+    returned = set()
+    if getattr(settings, "PLANS_PAYMENTS_RETURN_ORDER_WHEN_PAYMENT_REFUNDED", False):
+        returned = order_ids_by_status.get(PaymentStatus.REFUNDED, set())
+        change_reason = f"Django-plans-payments: Payment status changed to {PaymentStatus.REFUNDED}"
+        for order_id in (
+            Order.objects.filter(pk__in=returned).exclude(status=Order.STATUS.RETURNED).values_list("pk", flat=True)
+        ):
+            try:
+                return_order(Order(pk=order_id), change_reason)
+            except ValueError as e:
+                logger.warning("Cannot return order %s: %s", order_id, e)
+                result.unreturnable_orders.append(order_id)
+
+    canceled = set()
+    for status, order_ids in order_ids_by_status.items():
+        if status not in ORDER_KEEPING_STATUSES:
+            canceled |= order_ids
+    canceled -= returned
+    if canceled:
+        transition_orders(canceled, Order.STATUS.CANCELED)
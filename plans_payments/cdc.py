@@ -0,0 +1,134 @@
+"""
+Change-data-capture feed of payments.
+
+With ``PLANS_PAYMENTS_CDC = True`` every write of a payment through this app
+(``Payment.save``, deletion, ``bulk_change_status`` and fee recomputation)
+appends a ``PaymentChange`` row; its auto-incremented id is the change
+sequence. ``export_changes`` reads the changes after the consumer's
+``CDCWatermark``, collapses them to one record per payment with its current
+state (or ``"deleted": true``) and writes them as JSON lines, one batch at a
+time, moving the watermark after every written batch.
+
+Sequence values are assigned on insert but become visible on commit, so a
+change of a long transaction can show up behind a higher, already exported
+one. Changes younger than ``PLANS_PAYMENTS_CDC_LAG`` (``60`` seconds) are
+therefore left for the next export. Exported changes can be removed with
+``prune_changes``.
+"""
+
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from payments import get_payment_model
+
+# Payment fields of the exported records
+EXPORT_FIELDS = (
+    "id",
+    "created",
+    "modified",
+    "status",
+    "fraud_status",
+    "variant",
+    "transaction_id",
+    "currency",
+    "total",
+    "captured_amount",
+    "transaction_fee",
+    "order_id",
+    "user_id",
+    "autorenewed_payment",
+)
+
+
+def cdc_enabled():
+    return getattr(settings, "PLANS_PAYMENTS_CDC", False)
+
+
+def get_lag():
+    return timedelta(seconds=getattr(settings, "PLANS_PAYMENTS_CDC_LAG", 60))
+
+
+def record_payment_changes(payment_ids):
+    """Append a change for each of ``payment_ids``."""
+    from .models import PaymentChange
+
+    if not cdc_enabled():
+        return []
+    now = timezone.now()
+    return PaymentChange.objects.bulk_create(
+        [PaymentChange(payment_id=pk, created=now) for pk in payment_ids if pk is not None]
+    )
+
+
+def get_watermark(consumer):
+    from .models import CDCWatermark
+
+    watermark = CDCWatermark.objects.filter(consumer=consumer).values_list("position", flat=True).first()
+    return watermark or 0
+
+
+def set_watermark(consumer, position):
+    from .models import CDCWatermark
+
+    CDCWatermark.objects.update_or_create(consumer=consumer, defaults={"position": position})
+
+
+def iter_change_batches(after=0, batch_size=1000, lag=None):
+    """Yield ``(position, records)`` of the changes after the ``after`` sequence.
+
+    ``records`` holds the current state of every payment changed in the
+    batch, ``position`` is the sequence of the last change in it.
+    """
+    from .models import PaymentChange
+
+    Payment = get_payment_model()
+    changes = PaymentChange.objects.filter(created__lte=timezone.now() - (get_lag() if lag is None else lag))
+    while True:
+        batch = list(changes.filter(pk__gt=after).order_by("pk").values_list("pk", "payment_id")[:batch_size])
+        if not batch:
+            return
+        # Several changes of one payment are exported once, at the last of them
+        sequences = {}
+        for sequence, payment_id in batch:
+            sequences[payment_id] = sequence
+        rows = {row["id"]: row for row in Payment.objects.filter(pk__in=list(sequences)).values(*EXPORT_FIELDS)}
+        records = []
+        for payment_id, sequence in sorted(sequences.items(), key=lambda item: item[1]):
+            record = rows.get(payment_id, {"id": payment_id, "deleted": True})
+            records.append({"seq": sequence, **record})
+        after = batch[-1][0]
+        yield after, records
+
+
+def export_changes(stream, consumer="default", batch_size=1000, lag=None):
+    """Write the changes after the watermark of ``consumer`` to ``stream`` as JSON lines.
+
+    Returns the number of written records.
+    """
+    written = 0
+    for position, records in iter_change_batches(get_watermark(consumer), batch_size, lag):
+        for record in records:
+            stream.write(json.dumps(record, cls=DjangoJSONEncoder, separators=(",", ":")) + "\n")
+        stream.flush()
+        set_watermark(consumer, position)
+        written += len(records)
+    return written
+
+
+def prune_changes():
+    """Delete the changes exported to all consumers; returns the number deleted."""
+    from .models import CDCWatermark, PaymentChange
+
+    position = CDCWatermark.objects.aggregate(position=Min("position"))["position"]
+    if not position:
+        return 0
+    with transaction.atomic():
+        # Keep the last change, so that the sequence does not restart on backends reusing deleted ids
+        last = PaymentChange.objects.aggregate(last=Max("pk"))["last"] or 0
+        deleted, _ = PaymentChange.objects.filter(pk__lte=min(position, last - 1)).delete()
+    return deleted
@@ -0,0 +1,152 @@
+"""
+Per-variant circuit breaker for renewal charges.
+
+When a gateway degrades, every renewal charge waits for its timeout.
+``renew_account`` asks the breaker of the recurring plan's payment provider
+before charging; while the breaker is open, the renewal is deferred: the
+renewal attempt is cleared so the next task run picks the account again,
+and ``plans_payments.signals.renewal_deferred`` is sent.
+
+The breaker counts the charges and the failed ones (raised, left the
+payment in ``error`` or slower than ``slow_call_seconds``) in fixed windows of ``window`` seconds. Once at least
+``min_calls`` calls were made in a window and ``error_rate`` of them failed,
+it opens for ``open_seconds``; then it lets a single probe charge through
+(half-open) and closes if it succeeds or opens again if it fails. Results of
+calls reported while it is open (started before it opened) are ignored.
+
+State lives in the Django cache (``PLANS_PAYMENTS_CIRCUIT_BREAKER_CACHE``,
+``"default"``), so all workers sharing the cache share the breaker. Enable it
+with ``PLANS_PAYMENTS_CIRCUIT_BREAKER``, a dict of the options above, and
+override them per variant with ``PLANS_PAYMENTS_CIRCUIT_BREAKERS``.
+"""
+
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULTS = {
+    "error_rate": 0.5,
+    "slow_call_seconds": 10,
+    "min_calls": 10,
+    "window": 60,
+    "open_seconds": 60,
+}
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        name,
+        error_rate=0.5,
+        slow_call_seconds=10,
+        min_calls=10,
+        window=60,
+        open_seconds=60,
+        cache=None,
+        clock=time.time,
+    ):
+        self.name = name
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.cache = cache or caches[getattr(settings, "PLANS_PAYMENTS_CIRCUIT_BREAKER_CACHE", "default")]
+        self.clock = clock
+
+    def _key(self, suffix):
+        return f"plans_payments_circuit:{self.name}:{suffix}"
+
+    def _window_keys(self):
+        window = int(self.clock() // self.window)
+        return self._key(f"calls:{window}"), self._key(f"failures:{window}")
+
+    def _incr(self, key):
+        self.cache.add(key, 0, self.window * 2)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Expired between add and incr
+            self.cache.add(key, 1, self.window * 2)
+            return 1
+
+    @property
+    def state(self):
+        opened = self.cache.get_many([self._key("open"), self._key("tripped")])
+        if self._key("open") in opened:
+            return self.OPEN
+        if self._key("tripped") in opened:
+            return self.HALF_OPEN
+        return self.CLOSED
+
+    def allow_request(self):
+        """Whether a call may be made now; in half-open state only one probe call is allowed."""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        # The probe slot frees itself if the probe never reports back
+        return self.cache.add(self._key("probe"), True, max(self.slow_call_seconds * 2, 1))
+
+    def record(self, success, duration=0):
+        """Record the result of a call made after ``allow_request()``."""
+        success = success and duration <= self.slow_call_seconds
+        state = self.state
+        if state == self.OPEN:
+            # Started before the breaker opened, only the half-open probe closes it
+            return
+        if state == self.HALF_OPEN:
+            # Result of the probe
+            if success:
+                self.cache.delete_many([self._key("tripped"), self._key("probe")])
+            else:
+                self.trip()
+            return
+        calls_key, failures_key = self._window_keys()
+        calls = self._incr(calls_key)
+        failures = self._incr(failures_key) if not success else self.cache.get(failures_key, 0)
+        if calls >= self.min_calls and failures >= calls * self.error_rate:
+            self.trip()
+
+    def trip(self):
+        calls_key, failures_key = self._window_keys()
+        self.cache.set(self._key("open"), True, self.open_seconds)
+        self.cache.set(self._key("tripped"), True, None)
+        self.cache.delete_many([self._key("probe"), calls_key, failures_key])
+
+    def reset(self):
+        self.cache.delete_many([self._key("open"), self._key("tripped"), self._key("probe"), *self._window_keys()])
+
+    @contextmanager
+    def guard(self, ignore=(), failed=None):
+        """Record the wrapped call; exceptions in ``ignore`` count as success.
+
+        ``failed`` is called after a call that did not raise and tells whether
+        it failed nonetheless.
+        """
+        start = self.clock()
+        try:
+            yield
+        except ignore:
+            self.record(True, self.clock() - start)
+            raise
+        except Exception:
+            self.record(False, self.clock() - start)
+            raise
+        self.record(not (failed and failed()), self.clock() - start)
+
+
+def get_circuit_breaker(variant):
+    """Breaker of ``variant``, ``None`` if not configured."""
+    options = getattr(settings, "PLANS_PAYMENTS_CIRCUIT_BREAKER", None)
+    overrides = getattr(settings, "PLANS_PAYMENTS_CIRCUIT_BREAKERS", {})
+    if options is None and variant not in overrides:
+        return None
+    return CircuitBreaker(variant, **{**DEFAULTS, **(options or {}), **overrides.get(variant, {})})
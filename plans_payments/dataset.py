@@ -0,0 +1,252 @@
+"""
+Synthetic dataset for benchmarks and admin performance tests.
+
+``generate_chunk`` creates ``size`` users with their ``BillingInfo``,
+``UserPlan``, ``RecurringUserPlan`` (for ``recurring_share`` of them),
+``Order`` and ``Payment`` rows with ``bulk_create``. Everything is drawn from
+a random generator seeded with the dataset seed and the chunk number, so
+the chunks can be generated in parallel processes and the same seed always
+gives the same data.
+
+The distributions imitate production: ``STATUS_WEIGHTS`` for the payment
+statuses, the variant weights given (all ``PAYMENT_VARIANTS`` equally by
+default), orders spread over ``DAYS`` days, a failed attempt before some of
+the payments, PayPal style gateway responses with a fee in ``extra_data``
+of ``paypal`` variants and decline codes on rejected payments.
+
+The ``created`` times (``auto_now_add``) are written with ``bulk_update``
+after the rows are inserted.
+
+``Payment.save`` is bypassed: fees and the denormalized user are filled in,
+but gateway fields, facet counts, events and change records are not; run
+``backfill_gateway_fields`` and ``refresh_payment_facets`` afterwards if a
+benchmark needs them.
+"""
+
+import json
+import random
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+from plans.base.models import AbstractRecurringUserPlan
+from plans.models import BillingInfo, Order, Plan, PlanPricing, Pricing, RecurringUserPlan, UserPlan
+
+from .fees import compute_transaction_fee
+
+STATUS_WEIGHTS = {
+    PaymentStatus.CONFIRMED: 85,
+    PaymentStatus.REJECTED: 5,
+    PaymentStatus.ERROR: 1,
+    PaymentStatus.WAITING: 3,
+    PaymentStatus.INPUT: 3,
+    PaymentStatus.REFUNDED: 2,
+    PaymentStatus.PREAUTH: 1,
+}
+ORDER_STATUSES = {
+    PaymentStatus.CONFIRMED: Order.STATUS.COMPLETED,
+    PaymentStatus.REFUNDED: Order.STATUS.RETURNED,
+    PaymentStatus.REJECTED: Order.STATUS.CANCELED,
+    PaymentStatus.ERROR: Order.STATUS.CANCELED,
+}
+DECLINE_CODES = ["INSUFFICIENT_FUNDS", "DO_NOT_HONOR", "EXPIRED_CARD", "SUSPECTED_FRAUD", "INVALID_TOKEN"]
+COUNTRIES = ["CZ", "SK", "DE", "AT", "PL", "GB", "US", "FR"]
+#: Share of the payments preceded by a rejected attempt
+FAILED_ATTEMPT_SHARE = 0.1
+DAYS = 730
+
+CATALOGUE = [
+    ("Benchmark Basic", "benchmark-basic", [("Monthly", 30, Decimal("9.00")), ("Yearly", 365, Decimal("90.00"))]),
+    ("Benchmark Pro", "benchmark-pro", [("Monthly", 30, Decimal("29.00")), ("Yearly", 365, Decimal("290.00"))]),
+]
+
+
+def ensure_catalogue():
+    """``(plan_id, pricing_id, price)`` of the plan pricings used, creating the benchmark plans if needed."""
+    for name, slug, pricings in CATALOGUE:
+        plan, _ = Plan.objects.get_or_create(slug=slug, defaults={"name": name, "available": True})
+        for pricing_name, period, price in pricings:
+            pricing, _ = Pricing.objects.get_or_create(name=pricing_name, period=period)
+            PlanPricing.objects.get_or_create(plan=plan, pricing=pricing, defaults={"price": price})
+    return list(
+        PlanPricing.objects.filter(plan__slug__in=[slug for _, slug, _ in CATALOGUE]).values_list(
+            "plan_id", "pricing_id", "price"
+        )
+    )
+
+
+def gateway_response(rng, variant, status, total, currency):
+    """``extra_data`` of a payment, as the variant's provider would store it."""
+    extra_data = {}
+    if "paypal" in variant and status in (PaymentStatus.CONFIRMED, PaymentStatus.REFUNDED):
+        fee = (total * Decimal("0.034") + Decimal("0.35")).quantize(Decimal("0.01"))
+        extra_data["response"] = {
+            "id": f"PAYID-{rng.getrandbits(64):016X}",
+            "payer": {"payer_info": {"payer_id": f"{rng.getrandbits(52):013X}"}},
+            "transactions": [
+                {
+                    "related_resources": [
+                        {
+                            "sale": {
+                                "id": f"{rng.getrandbits(68):017X}",
+                                "transaction_fee": {"value": str(fee), "currency": currency},
+                            }
+                        }
+                    ]
+                }
+            ],
+        }
+    if status == PaymentStatus.REJECTED:
+        extra_data["decline_code"] = rng.choice(DECLINE_CODES)
+    return json.dumps(extra_data) if extra_data else ""
+
+
+def generate_chunk(
+    chunk,
+    size,
+    seed=0,
+    variants=None,
+    orders_per_user=3,
+    recurring_share=0.6,
+    batch_size=1000,
+    plan_pricings=None,
+):
+    """Generate the ``chunk``-th ``size`` users and their rows; returns ``(users, orders, payments)``.
+
+    ``variants`` maps variants to weights, ``plan_pricings`` are the result
+    of ``ensure_catalogue()``.
+    """
+    User = get_user_model()
+    Payment = get_payment_model()
+    rng = random.Random(f"{seed}:{chunk}")
+    variants = variants or {variant: 1 for variant in settings.PAYMENT_VARIANTS}
+    variant_names, variant_weights = list(variants), list(variants.values())
+    statuses, status_weights = list(STATUS_WEIGHTS), list(STATUS_WEIGHTS.values())
+    currency = getattr(settings, "PLANS_CURRENCY", "EUR")
+    plan_pricings = plan_pricings or ensure_catalogue()
+    now = timezone.now()
+    today = timezone.localdate()
+
+    prefix = f"bench-{seed}-{chunk}-"
+    usernames = [f"{prefix}{i}" for i in range(size)]
+    with transaction.atomic():
+        User.objects.bulk_create(
+            [User(username=username, email=f"{username}@example.com") for username in usernames],
+            batch_size=batch_size,
+        )
+        # Looked up by the prefix, bulk_create does not return the primary keys on all databases
+        emails = dict(User.objects.filter(username__startswith=prefix).order_by("pk").values_list("pk", "email"))
+        user_ids = list(emails)
+        accounts = [
+            (user_id, rng.choice(plan_pricings), rng.choices(variant_names, variant_weights)[0])
+            for user_id in user_ids
+        ]
+        BillingInfo.objects.bulk_create(
+            [
+                BillingInfo(
+                    user_id=user_id,
+                    name=f"Customer {user_id}",
+                    street=f"Street {rng.randint(1, 999)}",
+                    zipcode=f"{rng.randint(10000, 99999)}",
+                    city="City",
+                    country=rng.choice(COUNTRIES),
+                )
+                for user_id, _, _ in accounts
+            ],
+            batch_size=batch_size,
+        )
+        UserPlan.objects.bulk_create(
+            [
+                UserPlan(
+                    user_id=user_id,
+                    plan_id=plan_id,
+                    expire=today + timedelta(days=rng.randint(-30, 365)),
+                    active=True,
+                )
+                for user_id, (plan_id, _, _), _ in accounts
+            ],
+            batch_size=batch_size,
+        )
+        userplans = dict(UserPlan.objects.filter(user__username__startswith=prefix).values_list("user_id", "pk"))
+        RecurringUserPlan.objects.bulk_create(
+            [
+                RecurringUserPlan(
+                    user_plan_id=userplans[user_id],
+                    pricing_id=pricing_id,
+                    amount=price,
+                    currency=currency,
+                    payment_provider=variant,
+                    token=uuid.UUID(int=rng.getrandbits(128)).hex,
+                    token_verified=rng.random() < 0.95,
+                    renewal_triggered_by=AbstractRecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+                )
+                for user_id, (_, pricing_id, price), variant in accounts
+                if rng.random() < recurring_share
+            ],
+            batch_size=batch_size,
+        )
+
+        orders = []
+        order_payments = []
+        for user_id, (plan_id, pricing_id, price), variant in accounts:
+            for _ in range(rng.randint(1, 2 * orders_per_user - 1)):
+                created = now - timedelta(seconds=rng.randint(0, DAYS * 86400))
+                status = rng.choices(statuses, status_weights)[0]
+                attempts = [PaymentStatus.REJECTED] if rng.random() < FAILED_ATTEMPT_SHARE else []
+                orders.append(
+                    Order(
+                        user_id=user_id,
+                        plan_id=plan_id,
+                        pricing_id=pricing_id,
+                        amount=price,
+                        currency=currency,
+                        created=created,
+                        completed=created if status == PaymentStatus.CONFIRMED else None,
+                        status=ORDER_STATUSES.get(status, Order.STATUS.NEW),
+                    )
+                )
+                order_payments.append((user_id, variant, created, [*attempts, status]))
+        Order.objects.bulk_create(orders, batch_size=batch_size)
+        # Orders have no unique field to match them by: this relies on the primary keys following the insertion
+        # order, as auto-increment and sequence keys do for the rows of one bulk insert
+        order_ids = list(
+            Order.objects.filter(user__username__startswith=prefix).order_by("pk").values_list("pk", flat=True)
+        )
+        payments = []
+        payment_times = []
+        for order_id, order, (user_id, variant, created, payment_statuses) in zip(order_ids, orders, order_payments):
+            # auto_now_add overwrote the creation time on insert, it is updated below
+            order.pk, order.created = order_id, created
+            for attempt, status in enumerate(payment_statuses):
+                payment = Payment(
+                    order_id=order_id,
+                    user_id=user_id,
+                    variant=variant,
+                    status=status,
+                    total=order.amount,
+                    currency=currency,
+                    description=f"Order {order_id} purchase",
+                    transaction_id=uuid.UUID(int=rng.getrandbits(128)).hex,
+                    billing_email=emails[user_id],
+                    customer_ip_address="127.0.0.1",
+                    extra_data=gateway_response(rng, variant, status, order.amount, currency),
+                    autorenewed_payment=rng.random() < 0.5,
+                )
+                payment.transaction_fee, _ = compute_transaction_fee(payment)
+                payments.append(payment)
+                payment_times.append(created + timedelta(minutes=attempt))
+        Payment.objects.bulk_create(payments, batch_size=batch_size)
+        # Matched by their unique transaction ids
+        payment_ids = dict(
+            Payment.objects.filter(order__user__username__startswith=prefix).values_list("transaction_id", "pk")
+        )
+        for payment, created in zip(payments, payment_times):
+            payment.pk, payment.created = payment_ids[payment.transaction_id], created
+        Order.objects.bulk_update(orders, ["created"], batch_size=batch_size)
+        Payment.objects.bulk_update(payments, ["created"], batch_size=batch_size)
+    return len(user_ids), len(orders), len(payments)
@@ -0,0 +1,86 @@
+"""
+Run deadlines and per-call timeout budgets.
+
+A renewal run given a deadline charges an account only if the charge's
+timeout budget still fits before it, otherwise the account is left untouched
+(not claimed), so it stays due for the next run. While charging, the budget
+(capped by the time left) is available to the provider as
+``get_call_timeout()``; providers should pass it as the timeout of their
+gateway requests::
+
+    response = requests.post(url, json=data, timeout=get_call_timeout(default=30))
+
+Budgets are ``PLANS_PAYMENTS_RENEWAL_CALL_TIMEOUT`` seconds (``30``),
+overridden per variant by ``PLANS_PAYMENTS_RENEWAL_CALL_TIMEOUTS``.
+"""
+
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.utils import timezone
+
+_call_timeout = contextvars.ContextVar("plans_payments_call_timeout", default=None)
+
+
+def get_call_timeout(default=None):
+    """Timeout in seconds for a gateway call made now, ``default`` if there is none."""
+    timeout = _call_timeout.get()
+    return default if timeout is None else timeout
+
+
+@contextmanager
+def call_timeout(seconds):
+    token = _call_timeout.set(seconds)
+    try:
+        yield seconds
+    finally:
+        _call_timeout.reset(token)
+
+
+def get_call_budget(variant):
+    budgets = getattr(settings, "PLANS_PAYMENTS_RENEWAL_CALL_TIMEOUTS", {})
+    return budgets.get(variant, getattr(settings, "PLANS_PAYMENTS_RENEWAL_CALL_TIMEOUT", 30))
+
+
+class Deadline:
+    """Point in time (aware datetime) work has to be finished by."""
+
+    def __init__(self, at, clock=timezone.now):
+        self.at = at
+        self._clock = clock
+
+    def remaining(self):
+        """Seconds left, negative when passed."""
+        return (self.at - self._clock()).total_seconds()
+
+    def allows(self, seconds):
+        return self.remaining() >= seconds
+
+
+@dataclass
+class BudgetUsage:
+    #: Charges made
+    calls: int = 0
+    #: Seconds of budget given to them
+    budget: float = 0
+    #: Seconds they took
+    used: float = 0
+    #: Seconds the slowest one took
+    slowest: float = 0
+    #: Charges left for a later run because their budget did not fit before the deadline
+    deferred: int = 0
+
+    def add(self, budget, used):
+        self.calls += 1
+        self.budget += budget
+        self.used += used
+        self.slowest = max(self.slowest, used)
+
+    def __str__(self):
+        share = f" ({self.used / self.budget:.0%})" if self.budget else ""
+        return (
+            f"{self.calls} charges, {self.used:.1f} s of {self.budget:.1f} s budget{share}, "
+            f"slowest {self.slowest:.1f} s, {self.deferred} deferred"
+        )
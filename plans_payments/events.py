@@ -0,0 +1,108 @@
+"""
+Compact append-only payment event log.
+
+Instead of copying the whole payment row on every save (as
+django-simple-history does), ``PaymentEvent`` stores one small row per
+status transition, fee change and recurring token event: the payment, the
+time, a small integer kind and the new value as a short string (the status
+value, the fee, the token provider). The previous value is the value of the
+previous event of the same kind.
+
+``Payment.save``, ``set_renew_token`` and ``invalidate_renew_token`` record
+events; bulk operations collect them and write them with one
+``bulk_create`` (``record_events``). Disable the log with
+``PLANS_PAYMENTS_EVENT_LOG = False``.
+"""
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+
+class EventKind(models.IntegerChoices):
+    STATUS = 1, "Status"
+    FEE = 2, "Transaction fee"
+    TOKEN_SET = 3, "Recurring token set"
+    TOKEN_INVALIDATED = 4, "Recurring token invalidated"
+
+
+# Payment fields whose changes are recorded, with their event kind
+TRACKED_FIELDS = {
+    "status": EventKind.STATUS,
+    "transaction_fee": EventKind.FEE,
+}
+
+
+def event_log_enabled():
+    return getattr(settings, "PLANS_PAYMENTS_EVENT_LOG", True)
+
+
+def encode_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, Decimal):
+        value = value.quantize(Decimal("0.01"))
+    return str(value)[:32]
+
+
+def make_event(payment_id, kind, value, created=None):
+    """Unsaved ``PaymentEvent``, to be written with ``record_events``."""
+    from .models import PaymentEvent
+
+    return PaymentEvent(
+        payment_id=payment_id,
+        kind=kind,
+        value=encode_value(value),
+        created=created or timezone.now(),
+    )
+
+
+def record_events(events, batch_size=1000):
+    """Write events with ``bulk_create``."""
+    from .models import PaymentEvent
+
+    if not event_log_enabled():
+        return []
+    return PaymentEvent.objects.bulk_create(list(events), batch_size=batch_size)
+
+
+def record_event(payment, kind, value):
+    if payment.pk is None:
+        # Not saved, nothing to attach the event to
+        return []
+    return record_events([make_event(payment.pk, kind, value)])
+
+
+def loaded_values(payment):
+    """Current values of the tracked fields loaded on ``payment``."""
+    return {name: payment.__dict__[name] for name in TRACKED_FIELDS if name in payment.__dict__}
+
+
+def record_changes(payment, previous, update_fields=None):
+    """Record events for tracked fields of ``payment`` changed from ``previous``.
+
+    ``previous`` is ``None`` for a new payment (its initial status is
+    recorded), fields missing from it (deferred) are not compared.
+    """
+    events = []
+    current = loaded_values(payment)
+    for name, kind in TRACKED_FIELDS.items():
+        if update_fields is not None and name not in update_fields or name not in current:
+            continue
+        if previous is None:
+            if name == "status":
+                events.append(make_event(payment.pk, kind, current[name]))
+        # Compared as stored, an unrounded fee is not a change
+        elif name in previous and encode_value(previous[name]) != encode_value(current[name]):
+            events.append(make_event(payment.pk, kind, current[name]))
+    if events:
+        record_events(events)
+
+
+def payment_timeline(payment):
+    """Events of ``payment``, oldest first."""
+    from .models import PaymentEvent
+
+    return PaymentEvent.objects.filter(payment=payment).order_by("created", "pk")
@@ -0,0 +1,128 @@
+"""
+Materialized counts of payments per value of the admin ``list_filter`` fields.
+
+The default admin filters of ``variant`` and ``currency`` run a
+``SELECT DISTINCT`` over the whole payment table on every changelist load,
+and facet counts (Django 5.0+) add a grouped count per filter. With
+``PLANS_PAYMENTS_FACET_COUNTS = True`` the ``PaymentFacetCount`` table keeps
+the number of payments per value of ``FACET_FIELDS``: it is updated
+incrementally by ``Payment.save``, payment deletion and
+``bulk_change_status``, and rebuilt by the ``refresh_payment_facets``
+command (run it once after enabling, and on a schedule to fix drift from
+other queryset updates). ``PaymentAdmin`` then builds these filters and the
+facet counts of the unfiltered changelist from the table, read through the
+cache for ``PLANS_PAYMENTS_FACET_CACHE_TIMEOUT`` seconds (``60``).
+"""
+
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from payments import get_payment_model
+
+FACET_FIELDS = ("status", "variant", "fraud_status", "currency", "autorenewed_payment")
+
+CACHE_KEY = "plans_payments_facet_counts"
+
+
+def facet_counts_enabled():
+    return getattr(settings, "PLANS_PAYMENTS_FACET_COUNTS", False)
+
+
+def encode_facet_value(value):
+    return str(value)[:100]
+
+
+def facet_values(payment, update_fields=None):
+    """Current values of the facet fields loaded on ``payment`` (and in ``update_fields``)."""
+    return {
+        name: payment.__dict__[name]
+        for name in FACET_FIELDS
+        if name in payment.__dict__ and (update_fields is None or name in update_fields)
+    }
+
+
+def apply_facet_deltas(deltas):
+    """Add ``{(field, value): delta}`` to the facet counts, in one ``UPDATE`` usually."""
+    from .models import PaymentFacetCount
+
+    deltas = {(field, encode_facet_value(value)): delta for (field, value), delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    def update(keys):
+        condition = Q()
+        whens = []
+        for field, value in keys:
+            key_q = Q(field=field, value=value)
+            condition |= key_q
+            whens.append(When(key_q, then=Value(deltas[field, value])))
+        return PaymentFacetCount.objects.filter(condition).update(count=F("count") + Case(*whens, default=Value(0)))
+
+    with transaction.atomic():
+        if update(deltas) < len(deltas):
+            existing = set(
+                PaymentFacetCount.objects.filter(
+                    field__in={field for field, _ in deltas},
+                    value__in={value for _, value in deltas},
+                ).values_list("field", "value")
+            )
+            missing = [key for key in deltas if key not in existing]
+            PaymentFacetCount.objects.bulk_create(
+                [PaymentFacetCount(field=field, value=value, count=0) for field, value in missing],
+                ignore_conflicts=True,
+            )
+            update(missing)
+
+
+def record_payment_change(payment, previous, update_fields=None):
+    """Update the counts for ``payment`` saved with ``previous`` values (``None`` if new).
+
+    Only the ``update_fields`` are compared, other values were not written.
+    """
+    current = facet_values(payment, update_fields)
+    deltas = Counter()
+    for name, value in current.items():
+        if previous is None:
+            deltas[name, value] += 1
+        elif name in previous and previous[name] != value:
+            deltas[name, previous[name]] -= 1
+            deltas[name, value] += 1
+    apply_facet_deltas(deltas)
+
+
+def record_payment_deletion(payment):
+    apply_facet_deltas(Counter({(name, value): -1 for name, value in facet_values(payment).items()}))
+
+
+def refresh_facet_counts():
+    """Recount the facet values of all payments and replace the table."""
+    from .models import PaymentFacetCount
+
+    Payment = get_payment_model()
+    rows = []
+    for name in FACET_FIELDS:
+        for value, count in Payment.objects.order_by().values_list(name).annotate(count=Count("pk")):
+            rows.append(PaymentFacetCount(field=name, value=encode_facet_value(value), count=count))
+    with transaction.atomic():
+        PaymentFacetCount.objects.all().delete()
+        PaymentFacetCount.objects.bulk_create(rows)
+    cache.delete(CACHE_KEY)
+    return rows
+
+
+def get_facet_counts():
+    """Return ``{field: {value: count}}`` of values with payments, cached."""
+    from .models import PaymentFacetCount
+
+    def load():
+        counts = defaultdict(dict)
+        for field, value, count in PaymentFacetCount.objects.filter(count__gt=0).values_list(
+            "field", "value", "count"
+        ):
+            counts[field][value] = count
+        return dict(counts)
+
+    return cache.get_or_set(CACHE_KEY, load, getattr(settings, "PLANS_PAYMENTS_FACET_CACHE_TIMEOUT", 60))
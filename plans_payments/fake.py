@@ -0,0 +1,83 @@
+"""
+Fake payment provider for tests, development and load simulations.
+
+It behaves as ``payments.dummy.DummyProvider`` and additionally implements
+the provider hooks used by this app (``fetch_status``,
+``autocomplete_with_wallet``) without talking to any gateway. Configure it as
+a variant::
+
+    PAYMENT_VARIANTS = {
+        "fake": ("plans_payments.fake.FakeProvider", {"latency": 0.2, "failure_rate": 0.05}),
+    }
+
+``latency`` (seconds) is added to every gateway call, drawn from a normal
+distribution with ``latency_stdev`` if given (calls slower than
+``get_call_timeout()`` time out with ``PaymentError``), ``failure_rate`` of the
+calls raise ``PaymentError``, ``status`` is the status the gateway reports for
+payments (``statuses`` overrides it per ``transaction_id``) and ``seed`` makes
+the latencies and failures reproducible. ``sleep`` is called with the latency
+of each call; ``plans_payments.simulation`` passes one adding it up instead
+of waiting.
+"""
+
+import random
+import threading
+import time
+
+from payments import PaymentError, PaymentStatus
+from payments.dummy import DummyProvider
+
+from .deadlines import get_call_timeout
+
+
+class FakeProvider(DummyProvider):
+    def __init__(
+        self,
+        status=PaymentStatus.CONFIRMED,
+        statuses=None,
+        latency=0,
+        latency_stdev=0,
+        failure_rate=0,
+        seed=None,
+        sleep=time.sleep,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.status = status
+        self.statuses = statuses or {}
+        self.latency = latency
+        self.latency_stdev = latency_stdev
+        self.failure_rate = failure_rate
+        self.sleep = sleep
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _gateway_call(self):
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+            latency = self.latency
+            if self.latency_stdev:
+                latency = max(0, self._random.gauss(self.latency, self.latency_stdev))
+        timeout = get_call_timeout()
+        if timeout is not None and latency > timeout:
+            self.sleep(timeout)
+            raise PaymentError("Fake gateway timeout")
+        if latency:
+            self.sleep(latency)
+        if fail:
+            raise PaymentError("Fake gateway failure")
+
+    def fetch_status(self, payment):
+        self._gateway_call()
+        return self.statuses.get(payment.transaction_id, self.status)
+
+    def autocomplete_with_wallet(self, payment):
+        """Charge the stored token: confirmed, or rejected when the call fails."""
+        try:
+            self._gateway_call()
+        except PaymentError as e:
+            payment.change_status(PaymentStatus.REJECTED, str(e))
+        else:
+            payment.change_status(self.statuses.get(payment.transaction_id, self.status))
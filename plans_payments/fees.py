@@ -0,0 +1,86 @@
+"""
+Transaction fee computation shared by ``Payment.save`` and the
+``recompute_transaction_fees`` backfill command.
+"""
+
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+
+from payments import get_payment_model
+
+from .cdc import record_payment_changes
+from .events import EventKind, make_event, record_events
+
+logger = logging.getLogger(__name__)
+
+
+def compute_transaction_fee(payment):
+    """Return ``(fee, fee_missing)`` for ``payment``.
+
+    The fee is derived from the variant, ``total`` and the stored gateway
+    response in ``extra_data``; when it cannot be determined the current
+    ``transaction_fee`` is returned. ``fee_missing`` tells that the gateway
+    response lacks a fee it should have contained.
+    """
+    fee = payment.transaction_fee
+    if payment.transaction_fee_settled:
+        return fee, False
+    if "payu" in payment.variant:
+        # Estimate only, replaced by the real fee on settlement import
+        # (see plans_payments.settlement)
+        # Rounded as stored, so that recomputing it finds no change
+        return (payment.total * Decimal("0.029") + Decimal("0.05")).quantize(Decimal("0.01")), False
+    if not payment.extra_data:
+        return fee, False
+    extra_data = json.loads(payment.extra_data)
+    if "response" not in extra_data:
+        return fee, False
+    transaction_fee_missing = False
+    try:
+        transactions = extra_data["response"]["transactions"]
+    except KeyError:
+        transaction_fee_missing = fee == 0
+    else:
+        for transaction in transactions:
+            related_resources = transaction["related_resources"]
+            if len(related_resources) == 1:
+                sale = related_resources[0]["sale"]
+                if "transaction_fee" in sale:
+                    fee = Decimal(sale["transaction_fee"]["value"])
+                else:
+                    transaction_fee_missing = True
+    return fee, transaction_fee_missing
+
+
+def recompute_fee_range(start, end, dry_run=False, batch_size=500):
+    """Recompute fees of payments with ``start <= pk < end``.
+
+    Changed fees are written with ``bulk_update`` (bypassing the full save
+    path) unless ``dry_run`` is set. Payments with malformed ``extra_data``
+    are logged and skipped. Returns ``(pk, old_fee, new_fee)`` for
+    every changed payment.
+    """
+    Payment = get_payment_model()
+    payments = (
+        Payment.objects.filter(pk__gte=start, pk__lt=end, transaction_fee_settled=False)
+        .only("pk", "variant", "total", "extra_data", "transaction_fee", "transaction_fee_settled")
+        .order_by("pk")
+    )
+    changed = []
+    diffs = []
+    for payment in payments.iterator(chunk_size=batch_size):
+        try:
+            fee, _ = compute_transaction_fee(payment)
+        except (ValueError, KeyError, TypeError, InvalidOperation):
+            logger.exception("Cannot compute the fee of payment %s from its extra_data, skipping", payment.pk)
+            continue
+        if fee != payment.transaction_fee:
+            diffs.append((payment.pk, payment.transaction_fee, fee))
+            payment.transaction_fee = fee
+            changed.append(payment)
+    if changed and not dry_run:
+        Payment.objects.bulk_update(changed, ["transaction_fee"], batch_size=batch_size)
+        record_events(make_event(pk, EventKind.FEE, new_fee) for pk, _, new_fee in diffs)
+        record_payment_changes(pk for pk, _, _ in diffs)
+    return diffs
@@ -0,0 +1,131 @@
+"""
+Gateway identifiers extracted from ``Payment.extra_data``.
+
+Providers store their raw responses as JSON in ``extra_data``, which cannot
+be queried efficiently. The keys declared here are copied into the indexed
+``PaymentGatewayField`` side table whenever a payment is saved with a
+changed ``extra_data``, so webhook lookups and support searches become
+index seeks.
+
+Keys are declared as lists of dotted paths into the ``extra_data`` JSON;
+``*`` iterates over a list. The first non-empty scalar found wins. Extend or
+override the defaults with the ``PLANS_PAYMENTS_GATEWAY_FIELDS`` setting, or
+declare ``gateway_fields`` (same format) on the provider class.
+"""
+
+import json
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from payments import get_payment_model
+from payments.core import provider_factory
+
+logger = logging.getLogger(__name__)
+
+PAYPAL_RELATED_RESOURCES = "response.transactions.*.related_resources.*"
+
+DEFAULT_GATEWAY_FIELDS = {
+    "sale_id": [f"{PAYPAL_RELATED_RESOURCES}.sale.id"],
+    "payer_id": ["payer_info.payer_id", "response.payer.payer_info.payer_id"],
+    "refund_id": [f"{PAYPAL_RELATED_RESOURCES}.refund.id"],
+    "fee_currency": [f"{PAYPAL_RELATED_RESOURCES}.sale.transaction_fee.currency"],
+}
+
+
+def get_gateway_field_paths(variant):
+    """Return ``{key: [path, ...]}`` declared for the given payment variant."""
+    paths = dict(DEFAULT_GATEWAY_FIELDS)
+    paths.update(getattr(settings, "PLANS_PAYMENTS_GATEWAY_FIELDS", {}))
+    try:
+        provider = provider_factory(variant)
+    except ValueError:
+        provider = None
+    paths.update(getattr(provider, "gateway_fields", {}))
+    return paths
+
+
+def _resolve(data, parts):
+    if not parts:
+        if isinstance(data, (str, int)) and not isinstance(data, bool) and data != "":
+            yield str(data)
+        return
+    head, rest = parts[0], parts[1:]
+    if head == "*":
+        if isinstance(data, (list, tuple)):
+            for item in data:
+                yield from _resolve(item, rest)
+    elif isinstance(data, dict) and head in data:
+        yield from _resolve(data[head], rest)
+
+
+def extract_gateway_fields(variant, extra_data):
+    """Extract the declared gateway fields from raw ``extra_data`` JSON."""
+    if not extra_data:
+        return {}
+    try:
+        data = json.loads(extra_data)
+    except ValueError:
+        logger.warning("Payment extra_data is not valid JSON", extra={"extra_data": extra_data})
+        return {}
+    fields = {}
+    for key, paths in get_gateway_field_paths(variant).items():
+        for path in paths:
+            value = next(_resolve(data, path.split(".")), None)
+            if value is not None:
+                fields[key] = value[:255]
+                break
+    return fields
+
+
+def sync_gateway_fields(payment, created=False):
+    """Bring the side table of ``payment`` in line with its ``extra_data``.
+
+    Issues no writes when nothing changed, so repeated saves stay cheap.
+    """
+    from .models import PaymentGatewayField
+
+    fields = extract_gateway_fields(payment.variant, payment.extra_data)
+    if created:
+        existing = {}
+    else:
+        existing = dict(PaymentGatewayField.objects.filter(payment=payment).values_list("key", "value"))
+    if fields == existing:
+        return
+    with transaction.atomic():
+        stale = [key for key, value in existing.items() if fields.get(key) != value]
+        if stale:
+            PaymentGatewayField.objects.filter(payment=payment, key__in=stale).delete()
+        PaymentGatewayField.objects.bulk_create(
+            PaymentGatewayField(payment=payment, key=key, value=value)
+            for key, value in fields.items()
+            if existing.get(key) != value
+        )
+
+
+def find_payments(key, value):
+    """Return payments whose gateway field ``key`` equals ``value``."""
+    return get_payment_model().objects.filter(gateway_fields__key=key, gateway_fields__value=value)
+
+
+def backfill_gateway_fields(batch_size=1000, start_pk=0):
+    """Populate the side table for existing payments, in primary-key chunks.
+
+    Yields the last processed primary key after each chunk so callers can
+    report progress or resume with ``start_pk``.
+    """
+    Payment = get_payment_model()
+    last_pk = start_pk
+    while True:
+        chunk = list(
+            Payment.objects.filter(pk__gt=last_pk)
+            .exclude(extra_data="")
+            .order_by("pk")
+            .only("pk", "variant", "extra_data")[:batch_size]
+        )
+        if not chunk:
+            return
+        for payment in chunk:
+            sync_gateway_fields(payment)
+        last_pk = chunk[-1].pk
+        yield last_pk
@@ -0,0 +1,211 @@
+"""
+Admin actions executed in the background.
+
+Selecting payments in the admin and running one of the registered actions
+only stores an ``AdminJob`` with one ``AdminJobItem`` per payment; the
+``process_admin_jobs`` command then runs the action over the items in
+batches on a thread pool, recording the result of every item and the job
+progress as it goes. The worker holds a lease of
+``PLANS_PAYMENTS_ADMIN_JOB_LEASE`` seconds (``300``) on the job, extended
+from a background thread while it runs; the job of a worker that died is
+taken over once the lease expires, with its items not processed yet.
+
+Actions are callables taking a payment and returning a result message; an
+exception marks the item as failed with the exception as message. Register
+your own with ``register_job_action``::
+
+    @register_job_action("capture", "Capture the selected payments")
+    def capture(payment):
+        payment.capture()
+        return f"captured {payment.captured_amount}"
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+from payments.core import provider_factory
+
+from .fees import compute_transaction_fee
+from .models import AdminJob, AdminJobItem
+from .utils import Heartbeat, chunked, default_worker_id
+
+logger = logging.getLogger(__name__)
+
+# action name: (admin label, callable)
+JOB_ACTIONS = {}
+
+
+class JobActionError(Exception):
+    """Raised by an action when it cannot be applied to the payment."""
+
+
+def register_job_action(name, label):
+    def register(func):
+        JOB_ACTIONS[name] = (label, func)
+        return func
+
+    return register
+
+
+@register_job_action("sync_status", "Re-sync status from the gateway")
+def sync_status(payment):
+    """Ask the provider for the current status (``provider.fetch_status(payment)``)."""
+    provider = provider_factory(payment.variant, payment)
+    if not hasattr(provider, "fetch_status"):
+        raise JobActionError(f"Provider of variant {payment.variant} cannot fetch the payment status")
+    status = provider.fetch_status(payment)
+    if not status or status == payment.status:
+        return f"status {payment.status} unchanged"
+    old_status = payment.status
+    if not payment.change_status(status):
+        return f"status {old_status} not changed to {status}"
+    return f"status {old_status} -> {status}"
+
+
+@register_job_action("refund", "Refund at the gateway")
+def refund(payment):
+    if payment.status != PaymentStatus.CONFIRMED:
+        raise JobActionError(f"Payment with status {payment.status} cannot be refunded")
+    payment.refund()
+    return f"refunded, status {payment.status}"
+
+
+@register_job_action("recompute_fee", "Recompute transaction fee")
+def recompute_fee(payment):
+    old_fee = payment.transaction_fee
+    fee, _ = compute_transaction_fee(payment)
+    if fee == old_fee:
+        return f"fee {fee:.2f} unchanged"
+    payment.transaction_fee = fee
+    payment.save(update_fields=["transaction_fee"])
+    return f"fee {old_fee:.2f} -> {fee:.2f}"
+
+
+def create_job(action, payment_ids, user=None, batch_size=1000):
+    """Store a job running ``action`` over the payments with ``payment_ids``."""
+    if action not in JOB_ACTIONS:
+        raise ValueError(f"Unknown admin job action: {action}")
+    with transaction.atomic():
+        job = AdminJob.objects.create(action=action, created_by=user)
+        total = 0
+        for ids in chunked(payment_ids, batch_size):
+            AdminJobItem.objects.bulk_create([AdminJobItem(job=job, payment_id=pk) for pk in ids])
+            total += len(ids)
+        job.total = total
+        job.save(update_fields=["total"])
+    return job
+
+
+def get_job_lease():
+    return timedelta(seconds=getattr(settings, "PLANS_PAYMENTS_ADMIN_JOB_LEASE", 300))
+
+
+def claimable_jobs(now=None):
+    """Pending jobs and running jobs whose worker's lease expired."""
+    now = timezone.now() if now is None else now
+    return AdminJob.objects.filter(
+        Q(status=AdminJob.Status.PENDING) | Q(status=AdminJob.Status.RUNNING, lease_until__lt=now)
+    )
+
+
+def _run_item(func, item_id, payment_id, close_connection):
+    Payment = get_payment_model()
+    try:
+        # No transaction, it would hold row locks during the gateway calls
+        payment = Payment.objects.select_related("order").get(pk=payment_id)
+        message = func(payment)
+        status = AdminJobItem.Status.DONE
+    except Exception as e:
+        logger.warning("Admin job item %s failed", item_id, exc_info=True)
+        status, message = AdminJobItem.Status.FAILED, str(e) or e.__class__.__name__
+    finally:
+        if close_connection:
+            # Pool threads would keep their connection open otherwise
+            connection.close()
+    return item_id, status, message or ""
+
+
+def process_job(job, workers=4, batch_size=100, worker=None, lease=None):
+    """Run the pending items of ``job``; returns ``False`` if another worker took it."""
+    worker = default_worker_id() if worker is None else worker
+    lease = get_job_lease() if lease is None else lease
+    now = timezone.now()
+    claimed = (
+        claimable_jobs(now)
+        .filter(pk=job.pk)
+        .update(
+            status=AdminJob.Status.RUNNING,
+            worker=worker,
+            lease_until=now + lease,
+            started=Coalesce("started", Value(now)),
+        )
+    )
+    if not claimed:
+        return False
+    ours = AdminJob.objects.filter(pk=job.pk, worker=worker, status=AdminJob.Status.RUNNING)
+
+    def extend_lease():
+        return ours.update(lease_until=timezone.now() + lease)
+
+    func = JOB_ACTIONS[job.action][1]
+    pending = AdminJobItem.objects.filter(job=job, status=AdminJobItem.Status.PENDING).order_by("pk")
+    with (
+        Heartbeat(extend_lease, lease.total_seconds() / 2),
+        ThreadPoolExecutor(max_workers=workers) if workers > 1 else _InlineExecutor() as executor,
+    ):
+        while True:
+            if not extend_lease():
+                logger.warning("Lease of admin job %s lost, stopping", job.pk)
+                return False
+            # Processed items leave the pending set, so this pages through it
+            batch = list(pending.values_list("pk", "payment_id")[:batch_size])
+            if not batch:
+                break
+            results = list(executor.map(lambda item: _run_item(func, *item, close_connection=workers > 1), batch))
+            now = timezone.now()
+            AdminJobItem.objects.bulk_update(
+                [
+                    AdminJobItem(pk=pk, status=status, message=message, processed=now)
+                    for pk, status, message in results
+                ],
+                ["status", "message", "processed"],
+            )
+            failed = sum(1 for _, status, _ in results if status == AdminJobItem.Status.FAILED)
+            AdminJob.objects.filter(pk=job.pk).update(
+                processed=F("processed") + len(results),
+                failed=F("failed") + failed,
+            )
+    ours.update(status=AdminJob.Status.DONE, finished=timezone.now())
+    return True
+
+
+def process_pending_jobs(workers=4, batch_size=100):
+    """Process all pending jobs and jobs of dead workers, oldest first; returns the processed jobs."""
+    processed = []
+    for job in claimable_jobs().order_by("created"):
+        if job.action not in JOB_ACTIONS:
+            logger.error("Admin job %s has unknown action %s", job.pk, job.action)
+            continue
+        if process_job(job, workers=workers, batch_size=batch_size):
+            processed.append(job)
+    return processed
+
+
+class _InlineExecutor:
+    """Runs ``map`` in the calling thread (single worker, tests)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def map(self, func, iterable):
+        return map(func, iterable)
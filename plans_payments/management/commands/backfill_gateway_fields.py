@@ -0,0 +1,30 @@
+from django.core.management import BaseCommand
+
+from plans_payments.gateway_fields import backfill_gateway_fields
+
+
+class Command(BaseCommand):
+    help = "Extract indexed gateway fields from extra_data of existing payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            dest="batch_size",
+            help="Number of payments processed per chunk",
+        )
+        parser.add_argument(
+            "--start-pk",
+            type=int,
+            default=0,
+            dest="start_pk",
+            help="Resume after this payment primary key",
+        )
+
+    def handle(self, *args, **options):
+        last_pk = options["start_pk"]
+        for last_pk in backfill_gateway_fields(batch_size=options["batch_size"], start_pk=last_pk):
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Processed payments up to pk {last_pk}")
+        self.stdout.write(f"Gateway fields backfilled up to pk {last_pk}")
@@ -0,0 +1,30 @@
+from django.core.management import BaseCommand
+
+from plans_payments.users import backfill_payment_user
+
+
+class Command(BaseCommand):
+    help = "Copy the order user to Payment.user of existing payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            dest="batch_size",
+            help="Size of the primary key range updated per query",
+        )
+        parser.add_argument(
+            "--start-pk",
+            type=int,
+            default=0,
+            dest="start_pk",
+            help="Resume after this payment primary key",
+        )
+
+    def handle(self, *args, **options):
+        last_pk = options["start_pk"]
+        for last_pk in backfill_payment_user(batch_size=options["batch_size"], start_pk=last_pk):
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Processed payments up to pk {last_pk}")
+        self.stdout.write(f"Payment users backfilled up to pk {last_pk}")
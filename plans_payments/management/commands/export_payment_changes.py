@@ -0,0 +1,45 @@
+from django.core.management import BaseCommand
+
+from plans_payments.cdc import export_changes, prune_changes
+
+
+class Command(BaseCommand):
+    help = "Export payment changes after the consumer's watermark as JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--consumer",
+            default="default",
+            dest="consumer",
+            help="Name of the consumer whose watermark is used and moved",
+        )
+        parser.add_argument(
+            "--output",
+            default=None,
+            dest="output",
+            help="File the JSON lines are appended to (standard output by default)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            dest="batch_size",
+            help="Number of changes exported and committed to the watermark together",
+        )
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            dest="prune",
+            help="Delete the changes exported to all consumers afterwards",
+        )
+
+    def handle(self, *args, **options):
+        if options["output"]:
+            with open(options["output"], "a") as stream:
+                written = export_changes(stream, options["consumer"], options["batch_size"])
+        else:
+            written = export_changes(self.stdout, options["consumer"], options["batch_size"])
+        message = f"{written} payment changes exported"
+        if options["prune"]:
+            message += f", {prune_changes()} pruned"
+        self.stderr.write(message)
@@ -0,0 +1,117 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+
+from plans_payments.dataset import ensure_catalogue, generate_chunk
+from plans_payments.utils import init_worker_process
+
+
+def parse_variant(value):
+    variant, _, weight = value.partition(":")
+    try:
+        return variant, float(weight or 1)
+    except ValueError:
+        raise CommandError(f"Invalid variant weight: {value}")
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic dataset of users, plans, orders and payments for benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=10000,
+            dest="users",
+            help="Number of users to generate",
+        )
+        parser.add_argument(
+            "--orders-per-user",
+            type=int,
+            default=3,
+            dest="orders_per_user",
+            help="Mean number of orders of a user",
+        )
+        parser.add_argument(
+            "--recurring-share",
+            type=float,
+            default=0.6,
+            dest="recurring_share",
+            help="Share of the users with a recurring plan",
+        )
+        parser.add_argument(
+            "--variant",
+            action="append",
+            dest="variants",
+            help="Payment variant with its weight as VARIANT:WEIGHT (can be repeated; default: all variants equally)",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            dest="seed",
+            help="Seed of the dataset; use another one to add more users to an existing dataset",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            dest="chunk_size",
+            help="Number of users generated by one task",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            dest="batch_size",
+            help="Number of rows per bulk_create statement",
+        )
+
+    def handle(self, *args, **options):
+        variants = dict(parse_variant(value) for value in options["variants"] or []) or None
+        plan_pricings = ensure_catalogue()
+        chunk_size = options["chunk_size"]
+        tasks = [
+            dict(
+                chunk=chunk,
+                size=min(chunk_size, options["users"] - chunk * chunk_size),
+                seed=options["seed"],
+                variants=variants,
+                orders_per_user=options["orders_per_user"],
+                recurring_share=options["recurring_share"],
+                batch_size=options["batch_size"],
+                plan_pricings=plan_pricings,
+            )
+            for chunk in range((options["users"] + chunk_size - 1) // chunk_size)
+        ]
+
+        start = time.monotonic()
+        totals = [0, 0, 0]
+        if options["workers"] > 1:
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=init_worker_process) as executor:
+                futures = [executor.submit(generate_chunk, **task) for task in tasks]
+                for future in as_completed(futures):
+                    self._add(totals, future.result(), options)
+        else:
+            for task in tasks:
+                self._add(totals, generate_chunk(**task), options)
+
+        users, orders, payments = totals
+        self.stdout.write(
+            f"{users} users, {orders} orders, {payments} payments generated in {time.monotonic() - start:.1f} s"
+        )
+
+    def _add(self, totals, counts, options):
+        for i, count in enumerate(counts):
+            totals[i] += count
+        if options["verbosity"] > 1:
+            self.stdout.write(f"{totals[0]} users generated")
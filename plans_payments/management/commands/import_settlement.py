@@ -0,0 +1,43 @@
+from django.core.management import BaseCommand, CommandError
+
+from plans_payments.settlement import SETTLEMENT_FORMATS, guess_file_format, import_settlement, open_settlement_file
+
+
+class Command(BaseCommand):
+    help = "Import transaction fees and statuses from a gateway settlement export"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Settlement file, optionally gzipped")
+        parser.add_argument(
+            "--provider",
+            required=True,
+            choices=sorted(SETTLEMENT_FORMATS),
+            help="Gateway that produced the file",
+        )
+        parser.add_argument(
+            "--format",
+            choices=("csv", "jsonl"),
+            dest="file_format",
+            help="File format, guessed from the file name by default",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            dest="batch_size",
+            help="Number of rows applied per transaction",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["file_format"] or guess_file_format(path)
+        try:
+            with open_settlement_file(path) as stream:
+                result = import_settlement(stream, options["provider"], file_format, options["batch_size"])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"{result.updated} payments updated, {result.missing_count} rows without payment")
+        if result.missing and options["verbosity"] > 1:
+            self.stdout.write("Unmatched: " + ", ".join(result.missing))
+        for order_id in result.unreturnable_orders:
+            self.stderr.write(f"Order {order_id} could not be returned")
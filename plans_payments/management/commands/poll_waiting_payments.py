@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+
+from plans_payments.polling import poll_waiting_payments
+
+
+class Command(BaseCommand):
+    help = "Ask gateways for the status of payments stuck waiting and apply it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            default=30,
+            dest="older_than",
+            help="Poll payments waiting without change for this many minutes",
+        )
+        parser.add_argument(
+            "--max-age",
+            type=int,
+            default=30,
+            dest="max_age",
+            help="Give up on payments not modified for this many days",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            dest="workers",
+            help="Number of concurrent gateway requests",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            dest="batch_size",
+            help="Number of payments polled and updated together",
+        )
+
+    def handle(self, *args, **options):
+        result = poll_waiting_payments(
+            older_than=timedelta(minutes=options["older_than"]),
+            max_age=timedelta(days=options["max_age"]),
+            workers=options["workers"],
+            batch_size=options["batch_size"],
+        )
+        self.stdout.write(
+            f"{result.polled} payments polled, {result.changed} changed, {result.failed} failed, "
+            f"{result.skipped} skipped (no status polling)"
+        )
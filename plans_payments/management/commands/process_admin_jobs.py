@@ -0,0 +1,41 @@
+import time
+
+from django.core.management import BaseCommand
+
+from plans_payments.jobs import process_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Run pending background admin actions on payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            dest="workers",
+            help="Number of payments processed in parallel",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            dest="batch_size",
+            help="Number of payments whose results are saved together",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=0,
+            dest="poll",
+            help="Keep running and look for new jobs every POLL seconds (default: exit when done)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            for job in process_pending_jobs(workers=options["workers"], batch_size=options["batch_size"]):
+                job.refresh_from_db()
+                self.stdout.write(f"Job {job}: {job.processed} payments processed, {job.failed} failed")
+            if not options["poll"]:
+                break
+            time.sleep(options["poll"])
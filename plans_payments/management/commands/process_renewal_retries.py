@@ -0,0 +1,34 @@
+import time
+
+from django.core.management import BaseCommand
+
+from plans_payments.retries import process_due_retries
+
+
+class Command(BaseCommand):
+    help = "Charge again the failed renewals whose retry is due"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            dest="batch_size",
+            help="Number of retries fetched at once",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=0,
+            dest="poll",
+            help="Keep running and look for due retries every POLL seconds (default: exit when done)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_due_retries(batch_size=options["batch_size"])
+            if processed or not options["poll"]:
+                self.stdout.write(f"{processed} renewal retries processed")
+            if not options["poll"]:
+                break
+            time.sleep(options["poll"])
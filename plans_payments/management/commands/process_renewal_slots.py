@@ -0,0 +1,44 @@
+import time
+
+from django.core.management import BaseCommand
+
+from plans_payments.scheduler import process_renewal_slots
+from plans_payments.utils import default_worker_id
+
+
+class Command(BaseCommand):
+    help = "Renew the accounts whose scheduled renewal slot has come"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            dest="batch_size",
+            help="Number of slots fetched at once",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=0,
+            dest="poll",
+            help="Keep running and look for due slots every POLL seconds (default: exit when done)",
+        )
+        parser.add_argument(
+            "--worker",
+            default=None,
+            dest="worker",
+            help="Name of the worker in the slot leases (default: host, process id and a random suffix)",
+        )
+
+    def handle(self, *args, **options):
+        # Shared across polls, so that the rate limits hold over the whole run
+        buckets = {}
+        worker = options["worker"] or default_worker_id()
+        while True:
+            renewed, failed = process_renewal_slots(batch_size=options["batch_size"], buckets=buckets, worker=worker)
+            if renewed or failed or not options["poll"]:
+                self.stdout.write(f"{renewed} renewals processed, {failed} failed")
+            if not options["poll"]:
+                break
+            time.sleep(options["poll"])
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+
+from plans_payments.webhooks import prune_events
+
+
+class Command(BaseCommand):
+    help = "Delete stored gateway callback ids older than the gateways' retry period"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=30,
+            dest="days",
+            help="Delete callback ids stored for longer than this many days",
+        )
+
+    def handle(self, *args, **options):
+        deleted = prune_events(timedelta(days=options["days"]))
+        self.stdout.write(f"{deleted} webhook events deleted")
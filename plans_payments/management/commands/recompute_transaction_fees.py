@@ -0,0 +1,96 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
+from payments import get_payment_model
+
+from plans_payments.fees import recompute_fee_range
+from plans_payments.utils import init_worker_process
+
+
+def _load_state(path):
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.load(f)["done"])
+
+
+def _save_state(path, done):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"done": sorted(done)}, f)
+    os.replace(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = "Recompute transaction fees of existing payments from extra_data and total"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            dest="chunk_size",
+            help="Width of the primary key range processed by one task",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            dest="batch_size",
+            help="Number of payments written per bulk_update",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            dest="dry_run",
+            help="Print the fee changes without saving them",
+        )
+        parser.add_argument(
+            "--state-file",
+            dest="state_file",
+            help="File recording finished ranges; rerun with the same file to resume",
+        )
+
+    def handle(self, *args, **options):
+        bounds = get_payment_model().objects.aggregate(first=Min("pk"), last=Max("pk"))
+        if bounds["first"] is None:
+            self.stdout.write("No payments")
+            return
+        chunk_size = options["chunk_size"]
+        state_file = None if options["dry_run"] else options["state_file"]
+        done = _load_state(state_file)
+        starts = [start for start in range(bounds["first"], bounds["last"] + 1, chunk_size) if start not in done]
+        tasks = [(start, start + chunk_size, options["dry_run"], options["batch_size"]) for start in starts]
+
+        changed = 0
+        if options["workers"] > 1:
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=init_worker_process) as executor:
+                futures = {executor.submit(recompute_fee_range, *task): task[0] for task in tasks}
+                for future in as_completed(futures):
+                    changed += self._finish(futures[future], future.result(), done, state_file, options)
+        else:
+            for task in tasks:
+                changed += self._finish(task[0], recompute_fee_range(*task), done, state_file, options)
+
+        verb = "would change" if options["dry_run"] else "changed"
+        self.stdout.write(f"{len(tasks)} ranges processed, {changed} fees {verb}")
+
+    def _finish(self, start, diffs, done, state_file, options):
+        if options["dry_run"] or options["verbosity"] > 1:
+            for pk, old_fee, new_fee in diffs:
+                self.stdout.write(f"Payment {pk}: {old_fee} -> {new_fee}")
+        if state_file:
+            done.add(start)
+            _save_state(state_file, done)
+        return len(diffs)
@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from plans_payments.facets import refresh_facet_counts
+
+
+class Command(BaseCommand):
+    help = "Recount the payments per value of the admin filter fields"
+
+    def handle(self, *args, **options):
+        rows = refresh_facet_counts()
+        self.stdout.write(f"{len(rows)} facet values counted")
@@ -0,0 +1,118 @@
+import datetime
+
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_time
+
+from plans_payments.models import RenewalRun
+from plans_payments.renewal import run_renewals
+
+
+class Command(BaseCommand):
+    help = "Renew the accounts due for automatic renewal, streaming them to keep memory bounded"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--provider",
+            action="append",
+            dest="providers",
+            help="Renew only accounts of this payment provider (can be repeated)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            dest="limit",
+            help="Renew at most this many accounts",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            dest="chunk_size",
+            help="Number of due accounts fetched from the database cursor at once",
+        )
+        parser.add_argument(
+            "--deadline",
+            default=None,
+            dest="deadline",
+            help="Leave accounts that cannot be charged before this time (ISO datetime or HH:MM today) for later",
+        )
+        parser.add_argument(
+            "--resume",
+            nargs="?",
+            type=int,
+            const=0,
+            default=None,
+            dest="resume",
+            help="Resume the unfinished run RESUME (default: the latest unfinished run) from its checkpoint",
+        )
+        parser.add_argument(
+            "--checkpoint-every",
+            type=int,
+            default=100,
+            dest="checkpoint_every",
+            help="Number of accounts whose outcome is written to the run at once",
+        )
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            dest="trace_memory",
+            help="Report the peak memory allocated by the run (slower) instead of the peak process size",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            dest="dry_run",
+            help="Only count the due accounts",
+        )
+
+    def parse_deadline(self, value):
+        deadline = parse_datetime(value)
+        if deadline is None:
+            at = parse_time(value)
+            if at is None:
+                raise CommandError(f"Invalid deadline: {value}")
+            deadline = datetime.datetime.combine(timezone.localdate(), at)
+        if timezone.is_naive(deadline):
+            deadline = timezone.make_aware(deadline)
+        return deadline
+
+    def get_run(self, options):
+        if options["dry_run"]:
+            return None
+        if options["resume"] is None:
+            return RenewalRun.objects.create(providers=",".join(options["providers"] or []))
+        runs = RenewalRun.objects.filter(status=RenewalRun.Status.RUNNING)
+        if options["resume"]:
+            runs = runs.filter(pk=options["resume"])
+        run = runs.order_by("-started").first()
+        if run is None:
+            raise CommandError("No unfinished renewal run to resume")
+        if options["providers"]:
+            raise CommandError("--provider cannot be used with --resume, the run keeps its providers")
+        return run
+
+    def handle(self, *args, **options):
+        run = self.get_run(options)
+        result = run_renewals(
+            run=run,
+            checkpoint_every=options["checkpoint_every"],
+            providers=options["providers"],
+            limit=options["limit"],
+            chunk_size=options["chunk_size"],
+            dry_run=options["dry_run"],
+            trace_memory=options["trace_memory"],
+            deadline=self.parse_deadline(options["deadline"]) if options["deadline"] else None,
+        )
+        self.stdout.write(
+            f"{result.due} due, {result.renewed} renewed, {result.skipped} skipped, {result.failed} failed, "
+            f"{result.deferred} deferred, peak memory {result.peak_memory / 2**20:.1f} MiB"
+        )
+        for variant, usage in sorted(result.budgets.items()):
+            self.stdout.write(f"{variant}: {usage}")
+        if run is not None:
+            self.stdout.write(
+                f"{run}: {run.get_status_display().lower()}, {result.recovered} recovered, {run.renewed} renewed, "
+                f"{run.skipped} skipped, {run.failed} failed, {run.deferred} deferred in total"
+            )
@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+
+from plans_payments.scheduler import schedule_renewals
+
+
+class Command(BaseCommand):
+    help = "Spread the accounts due for automatic renewal over a window of renewal slots"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--provider",
+            action="append",
+            dest="providers",
+            help="Schedule only accounts of this payment provider (can be repeated)",
+        )
+        parser.add_argument(
+            "--window",
+            type=int,
+            default=None,
+            dest="window",
+            help="Spread the renewals over this many seconds (default: PLANS_PAYMENTS_RENEWAL_WINDOW)",
+        )
+
+    def handle(self, *args, **options):
+        window = timedelta(seconds=options["window"]) if options["window"] is not None else None
+        scheduled = schedule_renewals(providers=options["providers"], window=window)
+        self.stdout.write(f"{scheduled} renewals scheduled")
@@ -0,0 +1,79 @@
+import json
+
+from django.core.management import BaseCommand
+
+from plans_payments.simulation import simulate_renewals
+
+
+class Command(BaseCommand):
+    help = "Simulate a renewal run against fake gateways, rolling back all writes, and report its projected duration"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--provider",
+            action="append",
+            dest="providers",
+            help="Simulate only accounts of this payment provider (can be repeated)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            dest="limit",
+            help="Simulate at most this many accounts and project the duration from them",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.5,
+            dest="latency",
+            help="Mean latency of a gateway call in seconds",
+        )
+        parser.add_argument(
+            "--latency-stdev",
+            type=float,
+            default=0,
+            dest="latency_stdev",
+            help="Standard deviation of the gateway latency in seconds",
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0,
+            dest="failure_rate",
+            help="Share of the charges declined by the gateway",
+        )
+        parser.add_argument(
+            "--variant-options",
+            type=json.loads,
+            default=None,
+            dest="overrides",
+            help='Fake gateway options per variant as JSON, e.g. \'{"payu": {"latency": 1.2, "failure_rate": 0.1}}\'',
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=None,
+            dest="seed",
+            help="Seed of the latencies and failures",
+        )
+
+    def handle(self, *args, **options):
+        result = simulate_renewals(
+            providers=options["providers"],
+            limit=options["limit"],
+            latency=options["latency"],
+            latency_stdev=options["latency_stdev"],
+            failure_rate=options["failure_rate"],
+            overrides=options["overrides"],
+            seed=options["seed"],
+        )
+        self.stdout.write(
+            f"{result.accounts} of {result.due} due accounts simulated: {result.renewed} renewed, "
+            f"{result.failed} failed, {result.skipped} skipped, {result.emails} emails"
+        )
+        self.stdout.write(
+            f"{result.queries_per_account:.1f} queries per account (max {result.max_queries}), "
+            f"{result.seconds_per_account:.3f} s per account, peak memory {result.peak_memory / 2**20:.1f} MiB"
+        )
+        self.stdout.write(f"projected duration {result.projected_duration:.0f} s")
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0006_alter_payment_status"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PaymentGatewayField",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=50)),
+                ("value", models.CharField(max_length=255)),
+                (
+                    "payment",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="gateway_fields",
+                        to="plans_payments.payment",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["key", "value"], name="plans_payme_key_4a0dd5_idx")],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("payment", "key"),
+                        name="plans_payments_gateway_field_unique",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:28
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0007_payment_gateway_field"),
+        migrations.swappable_dependency(settings.PLANS_ORDER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(fields=["transaction_id"], name="plans_payme_transac_42f379_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0008_payment_transaction_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="transaction_fee_settled",
+            field=models.BooleanField(default=False),
+        ),
+    ]
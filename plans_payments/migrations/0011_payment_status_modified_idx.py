@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0010_admin_job"),
+        migrations.swappable_dependency(settings.PLANS_ORDER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(fields=["status", "modified"], name="plans_payme_status_a0428d_idx"),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0012_payment_event"),
+        migrations.swappable_dependency(settings.PLANS_ORDER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(fields=["order", "created"], name="plans_payme_order_i_6f7a1a_idx"),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0014_payment_user"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PaymentFacetCount",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("field", models.CharField(max_length=30)),
+                ("value", models.CharField(max_length=100)),
+                ("count", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("field", "value"),
+                        name="plans_payments_facet_count_unique",
+                    )
+                ],
+            },
+        ),
+    ]
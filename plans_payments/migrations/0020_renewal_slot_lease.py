@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0019_renewal_retry"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        migrations.swappable_dependency(settings.PLANS_RECURRINGUSERPLAN_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="renewalslot",
+            name="claimed",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="renewalslot",
+            name="lease_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="renewalslot",
+            name="worker",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name="renewalslot",
+            index=models.Index(fields=["status", "lease_until"], name="plans_payme_status_801a7d_idx"),
+        ),
+    ]
@@ -0,0 +1,118 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0020_renewal_slot_lease"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        migrations.swappable_dependency(settings.PLANS_RECURRINGUSERPLAN_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RenewalRun",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("running", "Running"), ("finished", "Finished")],
+                        default="running",
+                        max_length=10,
+                    ),
+                ),
+                ("providers", models.CharField(blank=True, default="", max_length=255)),
+                ("last_expire", models.DateField(blank=True, null=True)),
+                ("last_recurring_id", models.IntegerField(blank=True, null=True)),
+                ("renewed", models.PositiveIntegerField(default=0)),
+                ("skipped", models.PositiveIntegerField(default=0)),
+                ("failed", models.PositiveIntegerField(default=0)),
+                ("deferred", models.PositiveIntegerField(default=0)),
+                ("started", models.DateTimeField(auto_now_add=True)),
+                ("checkpointed", models.DateTimeField(blank=True, null=True)),
+                ("finished", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["status", "started"],
+                        name="plans_payme_status_0ecd96_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="RenewalRunEntry",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "outcome",
+                    models.CharField(
+                        choices=[
+                            ("renewed", "Renewed"),
+                            ("skipped", "Skipped"),
+                            ("failed", "Failed"),
+                            ("deferred", "Deferred"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                ("message", models.TextField(blank=True, default="")),
+                ("processed", models.DateTimeField()),
+                (
+                    "recurring",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.PLANS_RECURRINGUSERPLAN_MODEL,
+                    ),
+                ),
+                (
+                    "run",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="entries",
+                        to="plans_payments.renewalrun",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "renewal run entries",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("run", "recurring"),
+                        name="plans_payments_renewal_run_entry_unique",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0021_renewal_run"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="adminjob",
+            name="lease_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="adminjob",
+            name="worker",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+    ]
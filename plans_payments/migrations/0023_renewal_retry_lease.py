@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0022_admin_job_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="renewalretry",
+            name="lease_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
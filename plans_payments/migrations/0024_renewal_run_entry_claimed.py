@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0023_renewal_retry_lease"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="renewalrunentry",
+            name="outcome",
+            field=models.CharField(
+                choices=[
+                    ("renewed", "Renewed"),
+                    ("skipped", "Skipped"),
+                    ("failed", "Failed"),
+                    ("deferred", "Deferred"),
+                    ("claimed", "Claimed"),
+                ],
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("plans_payments", "0024_renewal_run_entry_claimed"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="renewalretry",
+            name="polls",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -1,23 +1,42 @@
 import json
 import logging
 import warnings
+from contextlib import nullcontext
 from decimal import Decimal
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
+from django.db.models.signals import post_delete
 from django.dispatch.dispatcher import receiver
 from django.urls import reverse
+from django.utils import timezone
 from payments import PaymentStatus, PurchasedItem, RedirectNeeded
 from payments.models import BasePayment
 from payments.signals import status_changed
 from plans.base.models import AbstractRecurringUserPlan
-from plans.contrib import get_user_language, send_template_email
 from plans.models import Order
 from plans.signals import account_automatic_renewal
 
-from .signals import renew_token_invalidated
-from .views import create_payment_object
+from .cdc import cdc_enabled, record_payment_changes
+from .circuitbreaker import get_circuit_breaker
+from .events import EventKind, event_log_enabled, loaded_values, record_changes, record_event
+from .facets import facet_counts_enabled, facet_values, record_payment_change, record_payment_deletion
+from .fees import compute_transaction_fee
+from .gateway_fields import sync_gateway_fields
+from .retries import RETRYABLE_STATUSES, renewal_retries_enabled, schedule_retry
+from .routers import changed_fields, get_replica_databases, primary_reads, replica_values
+from .signals import renew_token_invalidated, renewal_deferred
+from .transitions import (
+    LOADED_VALUES,
+    PAYMENT_TRANSITIONS,
+    complete_order,
+    return_order,
+    transition_order,
+    transition_payment,
+)
+from .users import denormalized_user_enabled
+from .utils import create_payment_object
 
 logger = logging.getLogger(__name__)
 
@@ -29,11 +48,26 @@ class Payment(BasePayment):
         null=True,
         blank=True,
     )
+    # Copy of order.user, see plans_payments.users
+    user: models.ForeignKey = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+        # Covered by the (user, created) index
+        db_index=False,
+    )
     transaction_fee: models.DecimalField = models.DecimalField(
         max_digits=9,
         decimal_places=2,
         default=Decimal("0.0"),
     )
+    # Set when the fee comes from the gateway settlement report; it is no
+    # longer estimated on save then.
+    transaction_fee_settled: models.BooleanField = models.BooleanField(
+        default=False,
+    )
     autorenewed_payment: models.BooleanField = models.BooleanField(
         default=False,
     )
@@ -42,35 +76,85 @@ class Payment(BasePayment):
         indexes = [
             models.Index(fields=["status"]),
             models.Index(fields=["status", "transaction_id"]),
+            models.Index(fields=["transaction_id"]),
+            models.Index(fields=["status", "modified"]),
+            models.Index(fields=["order", "created"]),
+            models.Index(fields=["user", "created"]),
+            models.Index(fields=["user", "status"]),
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Values the event log and the facet counts compare against on save
+        instance._loaded_values = loaded_values(instance)
+        instance._facet_values = facet_values(instance)
+        # Gateway fields are only synced when extra_data changes
+        instance._loaded_extra_data = instance.__dict__.get("extra_data")
+        if db in get_replica_databases():
+            instance._replica_values = replica_values(instance)
+        return instance
+
+    @primary_reads()
     def save(self, **kwargs):
-        if "payu" in self.variant:
-            # TODO: base this on actual payment methods and currency fees on PayU
-            # or even better on real PayU info
-            self.transaction_fee = self.total * Decimal("0.029") + Decimal("0.05")
-        elif hasattr(self, "extra_data") and self.extra_data:
-            extra_data = json.loads(self.extra_data)
-            if "response" in extra_data:
-                transaction_fee_missing = False
-                try:
-                    transactions = extra_data["response"]["transactions"]
-                except KeyError:
-                    transaction_fee_missing = self.transaction_fee == 0
-                else:
-                    for transaction in transactions:
-                        related_resources = transaction["related_resources"]
-                        if len(related_resources) == 1:
-                            sale = related_resources[0]["sale"]
-                            if "transaction_fee" in sale:
-                                self.transaction_fee = Decimal(sale["transaction_fee"]["value"])
-                            else:
-                                transaction_fee_missing = True
-                if transaction_fee_missing:
-                    logger.warning("Payment fee not included", extra={"extra_data": extra_data})
+        created = self._state.adding
+        if created and self.user_id is None and self.order_id is not None:
+            self.user_id = self.order.user_id
+        self.transaction_fee, transaction_fee_missing = compute_transaction_fee(self)
+        if transaction_fee_missing:
+            logger.warning("Payment fee not included", extra={"extra_data": json.loads(self.extra_data)})
+        if getattr(self, "_replica_values", None) is not None and kwargs.get("update_fields") is None:
+            # Loaded from a replica, its other values may be stale
+            kwargs["update_fields"] = changed_fields(self, self._replica_values)
         ret_val = super().save(**kwargs)
+        if getattr(self, "_replica_values", None) is not None:
+            self._replica_values = replica_values(self)
+        update_fields = kwargs.get("update_fields")
+        if (update_fields is None or "extra_data" in update_fields) and (
+            created or self.extra_data != getattr(self, "_loaded_extra_data", None)
+        ):
+            sync_gateway_fields(self, created=created)
+            self._loaded_extra_data = self.extra_data
+        if event_log_enabled():
+            previous = None if created else getattr(self, "_loaded_values", {})
+            record_changes(self, previous, update_fields)
+            self._loaded_values = {**getattr(self, "_loaded_values", {}), **loaded_values(self)}
+        if facet_counts_enabled() and (created or hasattr(self, "_facet_values")):
+            record_payment_change(self, None if created else self._facet_values, update_fields)
+            self._facet_values = {**getattr(self, "_facet_values", {}), **facet_values(self, update_fields)}
+        if cdc_enabled():
+            record_payment_changes([self.pk])
         return ret_val
 
+    @primary_reads()
+    def change_status(self, status, message=""):
+        """Change the status with ``transition_payment``; returns whether it took effect.
+
+        The same status only updates the message. A transition
+        ``PAYMENT_TRANSITIONS`` does not allow is ignored, and a payment
+        changed concurrently is reloaded instead of overwritten.
+        """
+        expected = self.status
+        if getattr(self, "_replica_values", None) is not None:
+            # Loaded from a replica, its status may be stale
+            expected = type(self).objects.filter(pk=self.pk).values_list("status", flat=True).get()
+        if status == expected:
+            if message != self.message:
+                self.message = message
+                self.save(update_fields=["message"])
+            self.status = status
+            return False
+        if status not in PAYMENT_TRANSITIONS.get(expected, ()):
+            logger.warning("Payment %s cannot change from %s to %s, ignored", self.pk, expected, status)
+            return False
+        if transition_payment(self, status, expected, message):
+            return True
+        logger.info("Payment %s changed concurrently, not changed to %s", self.pk, status)
+        self.refresh_from_db(fields=["status", "message", "modified"])
+        for values in filter(None, (getattr(self, name, None) for name in LOADED_VALUES)):
+            values.update((name, getattr(self, name)) for name in ("status", "message", "modified") if name in values)
+        return False
+
     def get_failure_url(self):
         return reverse("order_payment_failure", kwargs={"pk": self.order.pk})
 
@@ -90,13 +174,19 @@ class Payment(BasePayment):
             currency=self.currency,
         )
 
+    def get_user(self):
+        """User of the payment, through the denormalized ``user`` if enabled."""
+        if self.user_id is not None and denormalized_user_enabled():
+            return self.user
+        return self.order.user
+
     def get_renew_token(self):
         """
         Get the recurring payments renew token for user of this payment
         Used by PayU provider for now
         """
         try:
-            recurring_plan = self.order.user.userplan.recurring
+            recurring_plan = self.get_user().userplan.recurring
             if recurring_plan.token_verified and self.variant == recurring_plan.payment_provider:
                 return recurring_plan.token
         except ObjectDoesNotExist:
@@ -114,11 +204,12 @@ class Payment(BasePayment):
         apps can prompt the user to update their payment method.
         """
         try:
-            recurring_plan = self.order.user.userplan.recurring
+            recurring_plan = self.get_user().userplan.recurring
         except ObjectDoesNotExist:
             return
         recurring_plan.token_verified = False
         recurring_plan.save()
+        record_event(self, EventKind.TOKEN_INVALIDATED, self.variant)
         renew_token_invalidated.send(sender=self.__class__, payment=self, recurring_user_plan=recurring_plan)
 
     def get_renew_data(self):
@@ -137,7 +228,7 @@ class Payment(BasePayment):
             None: If wallet is not verified or doesn't exist
         """
         try:
-            recurring_plan = self.order.user.userplan.recurring
+            recurring_plan = self.get_user().userplan.recurring
             if not (recurring_plan.token_verified and self.variant == recurring_plan.payment_provider):
                 return None
 
@@ -224,31 +315,430 @@ class Payment(BasePayment):
             if recurring_plan.extra_data:
                 recurring_plan.save(update_fields=["extra_data"])
 
+        record_event(self, EventKind.TOKEN_SET, self.variant)
+
+
+class PaymentGatewayField(models.Model):
+    """
+    Gateway identifier (e.g. PayPal sale id) copied out of ``Payment.extra_data``
+    so it can be looked up through an index. See ``plans_payments.gateway_fields``.
+    """
+
+    payment: models.ForeignKey = models.ForeignKey(
+        Payment,
+        on_delete=models.CASCADE,
+        related_name="gateway_fields",
+    )
+    key: models.CharField = models.CharField(max_length=50)
+    value: models.CharField = models.CharField(max_length=255)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["payment", "key"], name="plans_payments_gateway_field_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["key", "value"]),
+        ]
+
+    def __str__(self):
+        return f"{self.key}={self.value}"
+
+
+class PaymentEvent(models.Model):
+    """
+    Append-only log of status transitions, fee changes and recurring token
+    events of a payment, see ``plans_payments.events``.
+    """
+
+    payment: models.ForeignKey = models.ForeignKey(
+        Payment,
+        on_delete=models.CASCADE,
+        related_name="events",
+        # Covered by the (payment, created) index
+        db_index=False,
+    )
+    created: models.DateTimeField = models.DateTimeField(default=timezone.now)
+    kind: models.PositiveSmallIntegerField = models.PositiveSmallIntegerField(choices=EventKind.choices)
+    value: models.CharField = models.CharField(max_length=32, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["payment", "created"]),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()}: {self.value}"
+
+
+class PaymentFacetCount(models.Model):
+    """
+    Number of payments with ``value`` in ``field``, for the admin filters.
+    See ``plans_payments.facets``.
+    """
+
+    field: models.CharField = models.CharField(max_length=30)
+    value: models.CharField = models.CharField(max_length=100)
+    count: models.BigIntegerField = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["field", "value"], name="plans_payments_facet_count_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.field}={self.value}: {self.count}"
+
+
+class PaymentChange(models.Model):
+    """
+    Change of a payment; the id is the change sequence of the
+    change-data-capture feed, see ``plans_payments.cdc``.
+    """
+
+    id: models.BigAutoField = models.BigAutoField(primary_key=True)
+    # No constraint, the changes outlive deleted payments
+    payment: models.ForeignKey = models.ForeignKey(
+        Payment,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+        related_name="+",
+    )
+    created: models.DateTimeField = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"#{self.pk} payment {self.payment_id}"
+
+
+class CDCWatermark(models.Model):
+    """Last change sequence exported to ``consumer``."""
+
+    consumer: models.CharField = models.CharField(max_length=100, unique=True)
+    position: models.BigIntegerField = models.BigIntegerField(default=0)
+    modified: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.consumer}: {self.position}"
+
+
+class WebhookEvent(models.Model):
+    """Processed gateway callback, see ``plans_payments.webhooks``."""
+
+    # Variant of the static endpoint or token of the payment
+    scope: models.CharField = models.CharField(max_length=100)
+    event_id: models.CharField = models.CharField(max_length=128)
+    created: models.DateTimeField = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "event_id"], name="plans_payments_webhook_event_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope}: {self.event_id}"
+
+
+class RenewalSlot(models.Model):
+    """
+    Scheduled renewal of an account, see ``plans_payments.scheduler``.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    recurring: models.ForeignKey = models.ForeignKey(
+        "plans.RecurringUserPlan",
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    user: models.ForeignKey = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    variant: models.CharField = models.CharField(max_length=255)
+    run_at: models.DateTimeField = models.DateTimeField()
+    status: models.CharField = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.PENDING,
+    )
+    # Lease of the worker processing the slot
+    worker: models.CharField = models.CharField(max_length=64, blank=True, default="")
+    lease_until: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    # First claimed by a worker
+    claimed: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    message: models.TextField = models.TextField(blank=True, default="")
+    processed: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_at"]),
+            models.Index(fields=["status", "lease_until"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["recurring"],
+                condition=models.Q(status="pending"),
+                name="plans_payments_renewal_slot_pending_unique",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.variant} renewal of user {self.user_id} at {self.run_at}"
+
+
+class RenewalRetry(models.Model):
+    """
+    Scheduled retry of a failed renewal charge, see ``plans_payments.retries``.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+        # Out of attempts, stopped by a decline code rule or no longer renewed by the task
+        EXHAUSTED = "exhausted", "Exhausted"
+        # Token reported permanently dead
+        DEAD = "dead", "Token dead"
+
+    recurring: models.ForeignKey = models.ForeignKey(
+        "plans.RecurringUserPlan",
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    user: models.ForeignKey = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    # Last failed renewal payment
+    payment: models.ForeignKey = models.ForeignKey(
+        Payment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    variant: models.CharField = models.CharField(max_length=255)
+    status: models.CharField = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.PENDING,
+    )
+    # Failed charges so far
+    attempts: models.PositiveSmallIntegerField = models.PositiveSmallIntegerField(default=0)
+    # Times the retry found its charge still waiting for the gateway
+    polls: models.PositiveSmallIntegerField = models.PositiveSmallIntegerField(default=0)
+    next_attempt: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    # Lease of the worker charging the retry
+    lease_until: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    decline_code: models.CharField = models.CharField(max_length=100, blank=True, default="")
+    created: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    modified: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "renewal retries"
+        indexes = [
+            models.Index(fields=["status", "next_attempt"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["recurring"],
+                condition=models.Q(status__in=["pending", "running"]),
+                name="plans_payments_renewal_retry_active_unique",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.variant} renewal retry of user {self.user_id} ({self.attempts} failed)"
+
+
+class RenewalRun(models.Model):
+    """
+    Checkpointed run of ``plans_payments.renewal.run_renewals``, resumed
+    with ``run_renewals --resume`` after its worker died.
+    """
+
+    class Status(models.TextChoices):
+        RUNNING = "running", "Running"
+        FINISHED = "finished", "Finished"
+
+    status: models.CharField = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.RUNNING,
+    )
+    # Comma separated, all providers if empty
+    providers: models.CharField = models.CharField(max_length=255, blank=True, default="")
+    # Last checkpointed account in the (user_plan__expire, pk) order of the due renewals
+    last_expire: models.DateField = models.DateField(null=True, blank=True)
+    last_recurring_id: models.IntegerField = models.IntegerField(null=True, blank=True)
+    renewed: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    skipped: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    failed: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    deferred: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    started: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    checkpointed: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    finished: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "started"]),
+        ]
+
+    def __str__(self):
+        return f"Renewal run #{self.pk}"
+
+    def get_providers(self):
+        return self.providers.split(",") if self.providers else None
+
+
+class RenewalRunEntry(models.Model):
+    class Outcome(models.TextChoices):
+        RENEWED = "renewed", "Renewed"
+        # Claimed by a concurrent run
+        SKIPPED = "skipped", "Skipped"
+        FAILED = "failed", "Failed"
+        # Left due, the charge would not finish before the deadline or the circuit breaker was open
+        DEFERRED = "deferred", "Deferred"
+        # Claimed, the outcome is not recorded yet
+        CLAIMED = "claimed", "Claimed"
+
+    run: models.ForeignKey = models.ForeignKey(
+        RenewalRun,
+        on_delete=models.CASCADE,
+        related_name="entries",
+    )
+    recurring: models.ForeignKey = models.ForeignKey(
+        "plans.RecurringUserPlan",
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    user: models.ForeignKey = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    outcome: models.CharField = models.CharField(max_length=10, choices=Outcome.choices)
+    message: models.TextField = models.TextField(blank=True, default="")
+    processed: models.DateTimeField = models.DateTimeField()
+
+    class Meta:
+        verbose_name_plural = "renewal run entries"
+        constraints = [
+            models.UniqueConstraint(fields=["run", "recurring"], name="plans_payments_renewal_run_entry_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.outcome} renewal of user {self.user_id}"
+
+
+class AdminJob(models.Model):
+    """
+    Admin action run in the background over the selected payments, see
+    ``plans_payments.jobs`` and the ``process_admin_jobs`` command.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+
+    action: models.CharField = models.CharField(max_length=50)
+    status: models.CharField = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.PENDING,
+    )
+    created_by: models.ForeignKey = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    total: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    processed: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    failed: models.PositiveIntegerField = models.PositiveIntegerField(default=0)
+    created: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    started: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    # Lease of the worker processing the job
+    worker: models.CharField = models.CharField(max_length=64, blank=True, default="")
+    lease_until: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    finished: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created"]),
+        ]
+
+    def __str__(self):
+        return f"{self.action} #{self.pk}"
+
+
+class AdminJobItem(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    job: models.ForeignKey = models.ForeignKey(
+        AdminJob,
+        on_delete=models.CASCADE,
+        related_name="items",
+    )
+    payment: models.ForeignKey = models.ForeignKey(
+        Payment,
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    status: models.CharField = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.PENDING,
+    )
+    message: models.TextField = models.TextField(blank=True, default="")
+    processed: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["job", "status"]),
+        ]
+
+    def __str__(self):
+        return f"{self.job} payment {self.payment_id}"
+
 
 @receiver(status_changed, sender=Payment)
+@primary_reads()
 def change_payment_status(sender, *args, **kwargs):
     payment = kwargs["instance"]
     order = payment.order
     if payment.status == PaymentStatus.CONFIRMED:
         if hasattr(order.user.userplan, "recurring"):
-            order.user.userplan.recurring.token_verified = True
-            order.user.userplan.recurring.save()
-        order.complete_order()
+            recurring = order.user.userplan.recurring
+            type(recurring).objects.filter(pk=recurring.pk, token_verified=False).update(token_verified=True)
+            recurring.token_verified = True
+        complete_order(order)
     if (
         getattr(settings, "PLANS_PAYMENTS_RETURN_ORDER_WHEN_PAYMENT_REFUNDED", False)
         and payment.status == PaymentStatus.REFUNDED
     ):
-        order._change_reason = f"Django-plans-payments: Payment status changed to {payment.status}"
-        order.return_order()
-    elif order.status != Order.STATUS.COMPLETED and payment.status not in (
+        return_order(order, f"Django-plans-payments: Payment status changed to {payment.status}")
+    elif payment.status not in (
         PaymentStatus.CONFIRMED,
         PaymentStatus.WAITING,
         PaymentStatus.INPUT,
     ):
-        order.status = Order.STATUS.CANCELED
-        # In case django-simples-history is installed
-        order._change_reason = f"Django-plans-payments: Payment status changed to {payment.status}"
-        order.save()
+        # Not if completed meanwhile, whatever the loaded order says
+        transition_order(
+            order,
+            Order.STATUS.CANCELED,
+            change_reason=f"Django-plans-payments: Payment status changed to {payment.status}",
+        )
         # Maybe we would like to re-enable this for payments statuses that will not be ever renewed
         # (like "SAC - Account closed (do not try again)" on PayU)
         # if hasattr(order.user.userplan, "recurring"):
@@ -256,31 +746,80 @@ def change_payment_status(sender, *args, **kwargs):
         #     order.user.userplan.recurring.save()
 
 
-@receiver(account_automatic_renewal)
-def renew_accounts(sender, user, *args, **kwargs):
+@receiver(status_changed, sender=Payment)
+def schedule_renewal_retry(sender, instance, **kwargs):
+    if renewal_retries_enabled() and instance.autorenewed_payment and instance.status in RETRYABLE_STATUSES:
+        schedule_retry(instance)
+
+
+@receiver(post_delete, sender=Payment)
+def update_facet_counts_on_delete(sender, instance, **kwargs):
+    if facet_counts_enabled():
+        record_payment_deletion(instance)
+
+
+@receiver(post_delete, sender=Payment)
+def record_change_on_delete(sender, instance, **kwargs):
+    if cdc_enabled():
+        record_payment_changes([instance.pk])
+
+
+def defer_renewal(user, reason):
+    """Leave the account of ``user`` due for the next renewal run without charging it."""
+    recurring = user.userplan.recurring
+    logger.warning("Renewal of user %s via %s deferred: %s", user.pk, recurring.payment_provider, reason)
+    # Clearing the attempt the renewal task recorded makes the account due again
+    type(recurring).objects.filter(pk=recurring.pk).update(last_renewal_attempt=None)
+    recurring.last_renewal_attempt = None
+    renewal_deferred.send(sender=Payment, user=user, variant=recurring.payment_provider, reason=reason)
+
+
+def renew_account(user):
+    """Charge the stored recurring token of ``user`` for a renewal order.
+
+    Returns the created payment, or ``None`` if the account is not renewed by
+    this app (foreign provider or renewal not triggered by the task) or the
+    renewal was deferred.
+    """
+    from plans.contrib import get_user_language, send_template_email
+
     userplan = user.userplan
     if (
-        userplan.recurring.payment_provider in settings.PAYMENT_VARIANTS
-        and userplan.recurring.renewal_triggered_by == AbstractRecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK
+        userplan.recurring.payment_provider not in settings.PAYMENT_VARIANTS
+        or userplan.recurring.renewal_triggered_by != AbstractRecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK
     ):
-        order = userplan.recurring.create_renew_order()
+        return None
+    breaker = get_circuit_breaker(userplan.recurring.payment_provider)
+    if breaker is not None and not breaker.allow_request():
+        defer_renewal(user, "circuit breaker open")
+        return None
+    order = userplan.recurring.create_renew_order()
 
-        payment = create_payment_object(userplan.recurring.payment_provider, order, autorenewed_payment=True)
+    payment = create_payment_object(userplan.recurring.payment_provider, order, autorenewed_payment=True)
 
-        try:
+    try:
+        # Gateways that are down often report an error status instead of raising
+        failed = lambda: payment.status == PaymentStatus.ERROR  # noqa: E731
+        with breaker.guard(ignore=(RedirectNeeded,), failed=failed) if breaker else nullcontext():
             payment.autocomplete_with_wallet()
-        except RedirectNeeded as redirect_to:
-            print("CVV2/3DS code is required, enter it at %s" % str(redirect_to))
-            send_template_email(
-                [payment.order.user.email],
-                "mail/renew_cvv_3ds_title.txt",
-                "mail/renew_cvv_3ds_body.txt",
-                {
-                    "redirect_url": str(redirect_to),
-                    "user": user,
-                    "userplan": userplan,
-                },
-                get_user_language(payment.order.user),
-            )
-        if payment.status == PaymentStatus.CONFIRMED:
-            order.complete_order()
+    except RedirectNeeded as redirect_to:
+        print("CVV2/3DS code is required, enter it at %s" % str(redirect_to))
+        send_template_email(
+            [payment.order.user.email],
+            "mail/renew_cvv_3ds_title.txt",
+            "mail/renew_cvv_3ds_body.txt",
+            {
+                "redirect_url": str(redirect_to),
+                "user": user,
+                "userplan": userplan,
+            },
+            get_user_language(payment.order.user),
+        )
+    if payment.status == PaymentStatus.CONFIRMED:
+        complete_order(order)
+    return payment
+
+
+@receiver(account_automatic_renewal)
+def renew_accounts(sender, user, *args, **kwargs):
+    renew_account(user)
@@ -0,0 +1,52 @@
+"""
+Keyset (cursor) pagination on ``(created, id)``, newest first.
+
+Unlike ``OFFSET`` pagination, fetching a page costs the same wherever it
+is in the listing: the cursor holds the ``(created, id)`` of the last row of
+the previous page and the next page continues right after it through an
+index on ``(..., created)``.
+"""
+
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created, pk):
+    data = json.dumps([created.isoformat(), pk], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created, pk = json.loads(data)
+        created = parse_datetime(created)
+    except (ValueError, TypeError):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    if created is None or not isinstance(pk, int):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    return created, pk
+
+
+def keyset_page(queryset, fields, cursor=None, limit=20):
+    """Return ``(rows, next_cursor)`` of ``queryset`` rows as dicts of ``fields``.
+
+    ``fields`` must include ``created`` and ``id``; ``next_cursor`` is ``None``
+    on the last page.
+    """
+    queryset = queryset.order_by("-created", "-id")
+    if cursor:
+        created, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created__lt=created) | Q(created=created, id__lt=pk))
+    rows = list(queryset.values(*fields)[: limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1]["created"], rows[-1]["id"])
@@ -0,0 +1,115 @@
+"""
+Status polling of payments stuck in ``PaymentStatus.WAITING``.
+
+Some gateways never call back, so their payments stay waiting and the
+orders are never completed or canceled. ``poll_waiting_payments`` walks the
+waiting payments not modified for ``older_than`` (through the
+``(status, modified)`` index), asks the provider for the real status with
+``provider.fetch_status(payment)`` on a thread pool, limited to
+``PLANS_PAYMENTS_POLL_RATE`` calls per second per variant (override per
+variant with ``PLANS_PAYMENTS_POLL_RATE_LIMITS``), and applies the changes
+per batch with ``bulk_change_status``. Variants whose provider does not
+implement ``fetch_status`` are skipped.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+from payments.core import provider_factory
+
+from .bulk import bulk_change_status
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PollResult:
+    #: Payments the provider was asked about
+    polled: int = 0
+    #: Payments whose status changed
+    changed: int = 0
+    #: Provider calls that raised
+    failed: int = 0
+    #: Payments of variants without ``fetch_status``
+    skipped: int = 0
+
+
+def get_rate_limit(variant):
+    limits = getattr(settings, "PLANS_PAYMENTS_POLL_RATE_LIMITS", {})
+    return limits.get(variant, getattr(settings, "PLANS_PAYMENTS_POLL_RATE", 5))
+
+
+def supports_polling(variant):
+    try:
+        provider = provider_factory(variant)
+    except ValueError:
+        return False
+    return hasattr(provider, "fetch_status")
+
+
+def stale_waiting_payments(older_than, max_age=None):
+    """Waiting payments not modified for ``older_than``, oldest first."""
+    now = timezone.now()
+    payments = get_payment_model().objects.filter(status=PaymentStatus.WAITING, modified__lt=now - older_than)
+    if max_age is not None:
+        payments = payments.filter(modified__gte=now - max_age)
+    return payments.order_by("modified", "pk")
+
+
+def _fetch_status(payment, bucket):
+    bucket.acquire()
+    try:
+        return payment.pk, provider_factory(payment.variant, payment).fetch_status(payment), None
+    except Exception as e:
+        logger.warning("Fetching status of payment %s failed", payment.pk, exc_info=True)
+        return payment.pk, None, e
+    finally:
+        # Pool threads would keep the connection the provider opened
+        connection.close()
+
+
+def poll_waiting_payments(older_than=timedelta(minutes=30), max_age=timedelta(days=30), workers=8, batch_size=100):
+    """Poll stale waiting payments and apply the reported statuses; returns ``PollResult``."""
+    result = PollResult()
+    buckets = {}
+    pollable = {}
+    payments = stale_waiting_payments(older_than, max_age)
+    last = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch_query = payments
+            if last is not None:
+                # Keyset pagination, the payments that did not change stay waiting
+                batch_query = payments.filter(Q(modified__gt=last[0]) | Q(modified=last[0], pk__gt=last[1]))
+            batch = list(batch_query[:batch_size])
+            if not batch:
+                break
+            last = (batch[-1].modified, batch[-1].pk)
+            to_poll = []
+            for payment in batch:
+                if payment.variant not in pollable:
+                    pollable[payment.variant] = supports_polling(payment.variant)
+                if not pollable[payment.variant]:
+                    result.skipped += 1
+                    continue
+                if payment.variant not in buckets:
+                    buckets[payment.variant] = TokenBucket(get_rate_limit(payment.variant))
+                to_poll.append(payment)
+            updates = []
+            for pk, status, error in executor.map(lambda p: _fetch_status(p, buckets[p.variant]), to_poll):
+                result.polled += 1
+                if error is not None:
+                    result.failed += 1
+                elif status and status != PaymentStatus.WAITING:
+                    updates.append((pk, status, None))
+            if updates:
+                result.changed += bulk_change_status(updates, key="pk", batch_size=batch_size).changed
+    return result
@@ -0,0 +1,382 @@
+"""
+Bounded-memory automatic renewals.
+
+``plans.tasks.autorenew_account`` loads every due account as a ``User`` with
+its ``UserPlan`` and ``RecurringUserPlan`` before renewing the first one,
+so a large run keeps all of them in memory. ``run_renewals`` selects the same
+accounts, but streams them with a server-side cursor (``iterator``) as
+``DueRenewal`` tuples of a few columns, and loads the full user, user plan
+and recurring plan of one account only after claiming its renewal attempt.
+The ``account_automatic_renewal`` signal is sent for each claimed account
+as the plans task does, so ``renew_accounts`` charges it.
+
+The peak resident size of the process is returned in the
+``RenewalResult``; with ``trace_memory`` the peak memory allocated by Python
+during the run is measured with ``tracemalloc`` instead, which slows down
+every allocation.
+
+Given a ``deadline``, the accounts are processed by expiration date (most
+urgent first), each charge runs with its variant's timeout budget (see
+``plans_payments.deadlines``) and accounts whose budget no longer fits
+before the deadline are deferred without being claimed. Once not even the
+smallest budget fits, the run stops; the remaining accounts stay due and are
+not counted. The budget use per variant is returned in
+``RenewalResult.budgets``.
+
+Accounts whose variant's circuit breaker is open are deferred without being
+claimed, and accounts whose renewal was deferred while charging are counted
+as deferred, not renewed.
+
+Given a ``RenewalRun``, the outcome of every account is recorded as a
+``RenewalRunEntry``. The entries are buffered and written with
+``bulk_create`` every ``checkpoint_every`` accounts, together with the
+position of the last account in the ``(user_plan__expire, pk)`` order of the
+due renewals. Claiming an account also writes a ``CLAIMED`` entry right
+away, replaced by the outcome at the next checkpoint. A run whose worker
+died is resumed from its position: the accounts it left ``CLAIMED`` are
+recorded as renewed if a renewal payment was created for them since the
+claim, otherwise their claim is released and they are charged by the resumed
+run. Claims of other runs and of ``schedule_renewals`` are left alone.
+"""
+
+import datetime
+import logging
+import sys
+import time
+import tracemalloc
+import warnings
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from payments import get_payment_model
+from plans.base.models import AbstractRecurringUserPlan
+from plans.models import RecurringUserPlan
+from plans.signals import account_automatic_renewal
+from plans.utils import slot_open_day_delta
+
+from .circuitbreaker import get_circuit_breaker
+from .deadlines import BudgetUsage, Deadline, call_timeout, get_call_budget
+from .models import RenewalRun, RenewalRunEntry
+
+logger = logging.getLogger(__name__)
+
+
+class DueRenewal(NamedTuple):
+    recurring_id: int
+    user_id: int
+    payment_provider: str
+    expire: datetime.date
+    last_renewal_attempt: Optional[datetime.datetime]
+
+
+DUE_RENEWAL_FIELDS = ("pk", "user_plan__user_id", "payment_provider", "user_plan__expire", "last_renewal_attempt")
+
+
+@dataclass
+class RenewalResult:
+    #: Accounts due for renewal
+    due: int = 0
+    #: Accounts the renewal signal was sent for
+    renewed: int = 0
+    #: Accounts claimed by a concurrent run
+    skipped: int = 0
+    #: Accounts whose renewal raised
+    failed: int = 0
+    #: Accounts left due: their charge would not finish before the deadline or their breaker was open
+    deferred: int = 0
+    #: Peak resident size of the process, or peak memory allocated during the run if traced, in bytes
+    peak_memory: int = 0
+    #: ``BudgetUsage`` per variant
+    budgets: dict = field(default_factory=dict)
+    #: Accounts charged by the interrupted worker of a resumed run
+    recovered: int = 0
+
+
+def due_renewals(providers=None):
+    """Recurring plans due for renewal, selected as ``plans.tasks.autorenew_account`` does."""
+    recurring = RecurringUserPlan.objects.filter(
+        renewal_triggered_by=AbstractRecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+        token_verified=True,
+    )
+    schedules = getattr(settings, "PLANS_AUTORENEW_SCHEDULE", None)
+    if schedules is not None:
+        now = timezone.now()
+        max_renew_after = getattr(settings, "PLANS_AUTORENEW_MAX_DAYS_AFTER_EXPIRY", datetime.timedelta(days=30))
+        q = Q()
+        for schedule in schedules:
+            day_before_slot_opens = datetime.timedelta(days=slot_open_day_delta(schedule) + 1)
+            q |= Q(
+                Q(last_renewal_attempt__isnull=True)
+                | Q(last_renewal_attempt__date__lte=F("user_plan__expire") - day_before_slot_opens),
+                user_plan__expire__lte=timezone.localdate(now + schedule),
+                user_plan__expire__gte=timezone.localdate(now + schedule - max_renew_after),
+            )
+        recurring = recurring.filter(q)
+    else:
+        warnings.warn(
+            "PLANS_AUTORENEW_BEFORE_DAYS and PLANS_AUTORENEW_BEFORE_HOURS are deprecated, "
+            "use PLANS_AUTORENEW_SCHEDULE instead.",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        recurring = recurring.filter(
+            user_plan__expire__lt=timezone.now()
+            + datetime.timedelta(
+                days=getattr(settings, "PLANS_AUTORENEW_BEFORE_DAYS", 0),
+                hours=getattr(settings, "PLANS_AUTORENEW_BEFORE_HOURS", 0),
+            ),
+        )
+    if providers:
+        recurring = recurring.filter(payment_provider__in=providers)
+    # Most urgent first, so that a run stopped by its deadline leaves the later ones
+    return recurring.order_by("user_plan__expire", "pk")
+
+
+def after_position(recurring, position):
+    """Recurring plans after ``position``, an ``(expire, pk)`` tuple in the due renewals order."""
+    if position is None:
+        return recurring
+    expire, recurring_id = position
+    return recurring.filter(Q(user_plan__expire__gt=expire) | Q(user_plan__expire=expire, pk__gt=recurring_id))
+
+
+def iter_due_renewals(providers=None, chunk_size=2000, after=None):
+    """Stream the due renewals (after the ``(expire, pk)`` position ``after``) as ``DueRenewal`` tuples."""
+    recurring = after_position(due_renewals(providers), after)
+    rows = recurring.values_list(*DUE_RENEWAL_FIELDS).iterator(chunk_size=chunk_size)
+    for row in rows:
+        yield DueRenewal._make(row)
+
+
+def claim_renewal(due, now=None):
+    """Record the renewal attempt unless a concurrent run recorded one since ``due`` was read."""
+    unchanged = RecurringUserPlan.objects.filter(pk=due.recurring_id)
+    if due.last_renewal_attempt is None:
+        unchanged = unchanged.filter(last_renewal_attempt__isnull=True)
+    else:
+        unchanged = unchanged.filter(last_renewal_attempt=due.last_renewal_attempt)
+    return bool(unchanged.update(last_renewal_attempt=timezone.now() if now is None else now))
+
+
+def already_renewed(user_id, since):
+    """Whether a renewal payment was created for ``user_id`` since ``since``."""
+    Payment = get_payment_model()
+    return Payment.objects.filter(order__user_id=user_id, autorenewed_payment=True, created__gte=since).exists()
+
+
+def renew_user(user_id, timeout=None):
+    """Load the account of ``user_id`` and send the renewal signal for it.
+
+    ``timeout`` is available to the provider as ``get_call_timeout()``.
+    Returns ``False`` if the renewal was deferred (see ``defer_renewal``).
+    """
+    # Loaded after the claim, so the recurring plan holds the new attempt time
+    user = get_user_model().objects.select_related("userplan", "userplan__recurring").get(pk=user_id)
+    with call_timeout(timeout):
+        account_automatic_renewal.send(sender=None, user=user)
+    # defer_renewal clears the attempt on the instance the receivers got
+    return user.userplan.recurring.last_renewal_attempt is not None
+
+
+def peak_rss():
+    """Peak resident size of the process in bytes, ``0`` where unknown."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes except on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_run_position(run):
+    if run.last_recurring_id is None:
+        return None
+    return run.last_expire, run.last_recurring_id
+
+
+def claim_for_run(run, due):
+    """Claim the renewal of ``due`` and mark it as claimed by ``run`` at once; returns whether claimed."""
+    now = timezone.now()
+    with transaction.atomic():
+        if not claim_renewal(due, now):
+            return False
+        RenewalRunEntry.objects.create(
+            run=run,
+            recurring_id=due.recurring_id,
+            user_id=due.user_id,
+            outcome=RenewalRunEntry.Outcome.CLAIMED,
+            processed=now,
+        )
+    return True
+
+
+def recover_interrupted(run):
+    """Handle the accounts ``run`` claimed but did not record; returns the entries of those renewed."""
+    claimed = RenewalRunEntry.objects.filter(run=run, outcome=RenewalRunEntry.Outcome.CLAIMED)
+    entries = []
+    for pk, recurring_id, user_id, attempt in claimed.values_list("pk", "recurring_id", "user_id", "processed"):
+        if already_renewed(user_id, attempt):
+            entries.append(
+                RenewalRunEntry(
+                    run=run,
+                    recurring_id=recurring_id,
+                    user_id=user_id,
+                    outcome=RenewalRunEntry.Outcome.RENEWED,
+                    message="recovered",
+                    processed=attempt,
+                )
+            )
+        else:
+            # Claimed, but not charged before the worker died: due again
+            logger.info("Releasing the interrupted renewal of user %s", user_id)
+            with transaction.atomic():
+                RecurringUserPlan.objects.filter(pk=recurring_id, last_renewal_attempt=attempt).update(
+                    last_renewal_attempt=None
+                )
+                RenewalRunEntry.objects.filter(pk=pk).delete()
+    return entries
+
+
+def checkpoint_run(run, entries, position):
+    """Write the buffered ``entries`` and the position of ``run`` at once."""
+    counts = Counter(entry.outcome for entry in entries)
+    with transaction.atomic():
+        # Replacing the CLAIMED entries
+        RenewalRunEntry.objects.bulk_create(
+            entries,
+            update_conflicts=True,
+            unique_fields=["run", "recurring"],
+            update_fields=["outcome", "message", "processed"],
+        )
+        RenewalRun.objects.filter(pk=run.pk).update(
+            last_expire=position[0] if position else run.last_expire,
+            last_recurring_id=position[1] if position else run.last_recurring_id,
+            checkpointed=timezone.now(),
+            renewed=F("renewed") + counts[RenewalRunEntry.Outcome.RENEWED],
+            skipped=F("skipped") + counts[RenewalRunEntry.Outcome.SKIPPED],
+            failed=F("failed") + counts[RenewalRunEntry.Outcome.FAILED],
+            deferred=F("deferred") + counts[RenewalRunEntry.Outcome.DEFERRED],
+        )
+    run.refresh_from_db()
+
+
+def run_renewals(
+    providers=None,
+    limit=None,
+    chunk_size=2000,
+    dry_run=False,
+    deadline=None,
+    run=None,
+    checkpoint_every=100,
+    trace_memory=False,
+):
+    """Renew the due accounts one at a time; returns ``RenewalResult``.
+
+    ``deadline`` is an aware datetime or a ``Deadline``. Outcomes are recorded
+    in the ``RenewalRun`` ``run`` (resumed from its checkpoint), if given.
+    """
+    result = RenewalResult()
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+    if dry_run:
+        run = None
+    entries = []
+    position = None
+    finished = False
+
+    def record(due, outcome, message=""):
+        nonlocal position
+        if run is None:
+            return
+        entries.append(
+            RenewalRunEntry(
+                run=run,
+                recurring_id=due.recurring_id,
+                user_id=due.user_id,
+                outcome=outcome,
+                message=message,
+                processed=timezone.now(),
+            )
+        )
+        position = (due.expire, due.recurring_id)
+        if len(entries) >= checkpoint_every:
+            checkpoint_run(run, entries, position)
+            entries.clear()
+
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    elif trace_memory:
+        tracemalloc.reset_peak()
+    try:
+        if run is not None:
+            providers = run.get_providers()
+            entries.extend(recover_interrupted(run))
+            result.recovered = len(entries)
+        after = get_run_position(run) if run is not None else None
+        # Foreign providers get the default budget
+        min_budget = min(get_call_budget(variant) for variant in [None, *(providers or settings.PAYMENT_VARIANTS)])
+        for due in iter_due_renewals(providers, chunk_size, after=after):
+            if limit is not None and result.due >= limit:
+                break
+            result.due += 1
+            if dry_run:
+                continue
+            usage = result.budgets.setdefault(due.payment_provider, BudgetUsage())
+            budget = get_call_budget(due.payment_provider)
+            if deadline is not None and not deadline.allows(budget):
+                usage.deferred += 1
+                result.deferred += 1
+                record(due, RenewalRunEntry.Outcome.DEFERRED)
+                if not deadline.allows(min_budget):
+                    # No charge fits anymore, do not scan the rest
+                    finished = True
+                    break
+                continue
+            breaker = get_circuit_breaker(due.payment_provider)
+            if breaker is not None and breaker.state == breaker.OPEN:
+                # renew_account would defer it, do not claim it
+                result.deferred += 1
+                record(due, RenewalRunEntry.Outcome.DEFERRED, "circuit breaker open")
+                continue
+            if not (claim_renewal(due) if run is None else claim_for_run(run, due)):
+                logger.info("Renewal of user %s already claimed by a concurrent run, skipping", due.user_id)
+                result.skipped += 1
+                record(due, RenewalRunEntry.Outcome.SKIPPED)
+                continue
+            start = time.monotonic()
+            try:
+                charged = renew_user(due.user_id, budget)
+            except Exception as e:
+                logger.exception("Renewal of user %s failed", due.user_id)
+                result.failed += 1
+                record(due, RenewalRunEntry.Outcome.FAILED, str(e) or e.__class__.__name__)
+            else:
+                if charged:
+                    result.renewed += 1
+                    record(due, RenewalRunEntry.Outcome.RENEWED)
+                else:
+                    # E.g. the half-open breaker's probe was taken; the claim was released
+                    result.deferred += 1
+                    record(due, RenewalRunEntry.Outcome.DEFERRED, "deferred")
+            usage.add(budget, time.monotonic() - start)
+        else:
+            finished = True
+        result.peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else peak_rss()
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        if run is not None:
+            # Also when interrupted by an exception; the account being charged is left to recover_interrupted
+            checkpoint_run(run, entries, position)
+    if run is not None and finished:
+        RenewalRun.objects.filter(pk=run.pk).update(status=RenewalRun.Status.FINISHED, finished=timezone.now())
+        run.refresh_from_db()
+    return result
@@ -0,0 +1,317 @@
+"""
+Retry queue of failed renewal charges.
+
+With ``PLANS_PAYMENTS_RENEWAL_RETRIES = True``, an autorenewed payment
+changing to ``rejected`` or ``error`` schedules a ``RenewalRetry`` of its
+account (one active retry per recurring plan). Every failure pushes the
+next attempt back exponentially: ``PLANS_PAYMENTS_RETRY_DELAY`` seconds
+(``3600``) times ``PLANS_PAYMENTS_RETRY_BACKOFF`` (``2``) to the power of
+the failed attempts so far, until ``PLANS_PAYMENTS_RETRY_MAX_ATTEMPTS``
+(``4``) charges failed.
+
+The decline code of the payment (the provider's ``get_decline_code(payment)``
+or ``"decline_code"`` in ``extra_data``) selects a rule of
+``PLANS_PAYMENTS_RETRY_RULES``: ``"dead"`` invalidates the recurring token
+with ``Payment.invalidate_renew_token()`` and stops, ``"stop"`` only stops,
+and a dict overrides ``delay``, ``backoff`` or ``max_attempts``::
+
+    PLANS_PAYMENTS_RETRY_RULES = {
+        "INSUFFICIENT_FUNDS": {"delay": 86400},
+        "INVALID_TOKEN": "dead",
+        "SUSPECTED_FRAUD": "stop",
+    }
+
+The ``process_renewal_retries`` command charges the retries that are due
+again, found through the ``(status, next_attempt)`` index. The worker holds
+a lease of ``PLANS_PAYMENTS_RENEWAL_LEASE`` seconds (``300``) on the retry,
+extended while it charges; retries of a worker that died are taken over
+once the lease expires. A retry is done when a renewal payment created since
+it was scheduled is confirmed; while one is still waiting for the gateway,
+the account is not charged again, up to ``PLANS_PAYMENTS_RETRY_MAX_POLLS``
+(``24``) checks before giving up. A charge that raises counts as a failed
+attempt, and an account no longer renewed by the task (foreign provider or
+other ``renewal_triggered_by``) stops its retry. A duplicate status callback
+of the payment that scheduled the retry is not counted again.
+"""
+
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+from payments.core import provider_factory
+from plans.base.models import AbstractRecurringUserPlan
+
+from .utils import Heartbeat
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = (PaymentStatus.REJECTED, PaymentStatus.ERROR)
+# In flight at the gateway
+WAITING_STATUSES = (PaymentStatus.WAITING, PaymentStatus.INPUT, PaymentStatus.PREAUTH)
+
+RETRY = "retry"
+STOP = "stop"
+DEAD = "dead"
+
+DEFAULT_RULES = {
+    "INVALID_TOKEN": DEAD,
+    "EXPIRED_CARD": DEAD,
+    "LOST_CARD": DEAD,
+    "STOLEN_CARD": DEAD,
+}
+
+
+def renewal_retries_enabled():
+    return getattr(settings, "PLANS_PAYMENTS_RENEWAL_RETRIES", False)
+
+
+def get_decline_code(payment):
+    try:
+        provider = provider_factory(payment.variant, payment)
+    except ValueError:
+        provider = None
+    if provider is not None and hasattr(provider, "get_decline_code"):
+        return provider.get_decline_code(payment) or ""
+    try:
+        extra_data = json.loads(payment.extra_data or "{}")
+    except ValueError:
+        return ""
+    return str(extra_data.get("decline_code", "")) if isinstance(extra_data, dict) else ""
+
+
+def get_rule(decline_code):
+    """``(action, options)`` for ``decline_code``."""
+    rules = getattr(settings, "PLANS_PAYMENTS_RETRY_RULES", DEFAULT_RULES)
+    rule = rules.get(decline_code, RETRY) if decline_code else RETRY
+    if isinstance(rule, dict):
+        return RETRY, rule
+    return rule, {}
+
+
+def get_delay(attempts, options=None):
+    """Delay after ``attempts`` failed charges."""
+    options = options or {}
+    delay = options.get("delay", getattr(settings, "PLANS_PAYMENTS_RETRY_DELAY", 3600))
+    backoff = options.get("backoff", getattr(settings, "PLANS_PAYMENTS_RETRY_BACKOFF", 2))
+    return timedelta(seconds=delay * backoff ** (attempts - 1))
+
+
+def get_max_attempts(options=None):
+    return (options or {}).get("max_attempts", getattr(settings, "PLANS_PAYMENTS_RETRY_MAX_ATTEMPTS", 4))
+
+
+def get_max_polls():
+    return getattr(settings, "PLANS_PAYMENTS_RETRY_MAX_POLLS", 24)
+
+
+def schedule_retry(payment, now=None):
+    """Record the failed renewal ``payment`` in the retry queue; returns the ``RenewalRetry``.
+
+    Returns ``None`` if the user has no recurring plan.
+    """
+    from .models import RenewalRetry
+
+    now = timezone.now() if now is None else now
+    user = payment.get_user()
+    try:
+        recurring = user.userplan.recurring
+    except ObjectDoesNotExist:
+        return None
+    decline_code = get_decline_code(payment)[:100]
+    with transaction.atomic():
+        retry = (
+            RenewalRetry.objects.select_for_update()
+            .filter(
+                recurring=recurring,
+                status__in=[RenewalRetry.Status.PENDING, RenewalRetry.Status.RUNNING],
+            )
+            .first()
+        )
+        if retry is None:
+            # Also finished retries, so that a late duplicate does not start a new one
+            retry = RenewalRetry.objects.filter(payment=payment).order_by("-pk").first()
+            if retry is not None:
+                return retry
+            retry = RenewalRetry(recurring=recurring, user=user, variant=payment.variant)
+        elif retry.payment_id == payment.pk:
+            # Duplicate callback (or ERROR then REJECTED) of a failure counted already
+            return retry
+        retry.payment = payment
+        retry.attempts += 1
+        retry.decline_code = decline_code
+        action, options = get_rule(decline_code)
+        if action == DEAD:
+            retry.status, retry.next_attempt = RenewalRetry.Status.DEAD, None
+        elif action == STOP or retry.attempts >= get_max_attempts(options):
+            retry.status, retry.next_attempt = RenewalRetry.Status.EXHAUSTED, None
+        else:
+            retry.status, retry.next_attempt = RenewalRetry.Status.PENDING, now + get_delay(retry.attempts, options)
+        retry.lease_until = None
+        retry.save()
+    if action == DEAD:
+        logger.info("Recurring token of user %s is dead (%s)", user.pk, decline_code)
+        payment.invalidate_renew_token()
+    return retry
+
+
+def get_retry_lease():
+    return timedelta(seconds=getattr(settings, "PLANS_PAYMENTS_RENEWAL_LEASE", 300))
+
+
+def claimable_retries(now):
+    """Due retries and retries whose worker's lease expired."""
+    from .models import RenewalRetry
+
+    return RenewalRetry.objects.filter(
+        Q(status=RenewalRetry.Status.PENDING, next_attempt__lte=now)
+        | Q(status=RenewalRetry.Status.RUNNING, lease_until__lt=now)
+    )
+
+
+def claim_retry(retry_id, now=None, lease=None):
+    from .models import RenewalRetry
+
+    now = timezone.now() if now is None else now
+    lease = get_retry_lease() if lease is None else lease
+    return bool(
+        claimable_retries(now)
+        .filter(pk=retry_id)
+        .update(
+            status=RenewalRetry.Status.RUNNING,
+            lease_until=now + lease,
+        )
+    )
+
+
+def renewal_status(user_id, since):
+    """Status of the renewals of ``user_id`` since ``since``: ``CONFIRMED``, ``WAITING`` (in flight) or ``None``."""
+    Payment = get_payment_model()
+    statuses = set(
+        Payment.objects.filter(order__user_id=user_id, autorenewed_payment=True, created__gte=since).values_list(
+            "status", flat=True
+        )
+    )
+    if PaymentStatus.CONFIRMED in statuses:
+        return PaymentStatus.CONFIRMED
+    if statuses.intersection(WAITING_STATUSES):
+        return PaymentStatus.WAITING
+    return None
+
+
+def fail_retry(retry_id):
+    """Count a failed attempt of the running retry that ``schedule_retry`` did not record, e.g. one that raised."""
+    from .models import RenewalRetry
+
+    with transaction.atomic():
+        retry = (
+            RenewalRetry.objects.select_for_update().filter(pk=retry_id, status=RenewalRetry.Status.RUNNING).first()
+        )
+        if retry is None:
+            return
+        retry.attempts += 1
+        retry.lease_until = None
+        _, options = get_rule(retry.decline_code)
+        if retry.attempts >= get_max_attempts(options):
+            retry.status, retry.next_attempt = RenewalRetry.Status.EXHAUSTED, None
+        else:
+            next_attempt = timezone.now() + get_delay(retry.attempts, options)
+            retry.status, retry.next_attempt = RenewalRetry.Status.PENDING, next_attempt
+        retry.save(update_fields=["attempts", "lease_until", "status", "next_attempt", "modified"])
+
+
+def settle_retry(retry_id, status):
+    """Finish the running retry after a charge whose payment has ``status``."""
+    from .models import RenewalRetry
+
+    running = RenewalRetry.objects.filter(pk=retry_id, status=RenewalRetry.Status.RUNNING)
+    if status == PaymentStatus.CONFIRMED:
+        running.update(status=RenewalRetry.Status.DONE, next_attempt=None, lease_until=None)
+    elif status in WAITING_STATUSES:
+        # Waiting for the gateway: look again later, until it is unlikely to ever finish
+        running.filter(polls__gte=get_max_polls() - 1).update(
+            status=RenewalRetry.Status.EXHAUSTED, polls=F("polls") + 1, next_attempt=None, lease_until=None
+        )
+        running.update(
+            status=RenewalRetry.Status.PENDING,
+            polls=F("polls") + 1,
+            next_attempt=timezone.now() + get_delay(1),
+            lease_until=None,
+        )
+    elif status in RETRYABLE_STATUSES:
+        # Normally rescheduled through schedule_retry already
+        fail_retry(retry_id)
+    else:
+        # Deferred (circuit breaker open): look again later without counting an attempt
+        running.update(
+            status=RenewalRetry.Status.PENDING,
+            next_attempt=timezone.now() + get_delay(1),
+            lease_until=None,
+        )
+
+
+def run_retry(retry_id, user_id, lease=None):
+    """Charge the account of the claimed retry again."""
+    from .models import RenewalRetry, renew_account
+
+    lease = get_retry_lease() if lease is None else lease
+    retry = RenewalRetry.objects.get(pk=retry_id)
+    user = get_user_model().objects.select_related("userplan", "userplan__recurring").get(pk=user_id)
+    recurring = user.userplan.recurring
+    if not recurring.token_verified:
+        # Invalidated since the retry was scheduled
+        RenewalRetry.objects.filter(pk=retry_id).update(status=RenewalRetry.Status.DEAD, next_attempt=None)
+        return
+    if (
+        recurring.payment_provider not in settings.PAYMENT_VARIANTS
+        or recurring.renewal_triggered_by != AbstractRecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK
+    ):
+        # renew_account would never charge it
+        RenewalRetry.objects.filter(pk=retry_id).update(status=RenewalRetry.Status.EXHAUSTED, next_attempt=None)
+        return
+    # Renewed meanwhile, or charged by a worker that died before recording it
+    status = renewal_status(user_id, retry.created)
+    if status is not None:
+        settle_retry(retry_id, status)
+        return
+
+    def extend_lease():
+        RenewalRetry.objects.filter(pk=retry_id, status=RenewalRetry.Status.RUNNING).update(
+            lease_until=timezone.now() + lease
+        )
+
+    try:
+        with Heartbeat(extend_lease, lease.total_seconds() / 2):
+            payment = renew_account(user)
+    except Exception:
+        logger.exception("Renewal retry of user %s failed", user_id)
+        fail_retry(retry_id)
+        return
+    settle_retry(retry_id, payment.status if payment is not None else None)
+
+
+def process_due_retries(now=None, batch_size=100):
+    """Charge the accounts whose retry is due; returns the number of retries run."""
+    now = timezone.now() if now is None else now
+    due = claimable_retries(now).order_by("next_attempt", "pk")
+    processed = 0
+    last = None
+    while True:
+        batch_query = due
+        if last is not None:
+            batch_query = due.filter(Q(next_attempt__gt=last[0]) | Q(next_attempt=last[0], pk__gt=last[1]))
+        batch = list(batch_query.values_list("next_attempt", "pk", "user_id")[:batch_size])
+        if not batch:
+            break
+        last = batch[-1][:2]
+        for _, retry_id, user_id in batch:
+            if claim_retry(retry_id, now):
+                run_retry(retry_id, user_id)
+                processed += 1
+    return processed
@@ -0,0 +1,152 @@
+"""
+Optional read-replica routing.
+
+Enable it with::
+
+    DATABASE_ROUTERS = ["plans_payments.routers.ReplicaRouter"]
+    PLANS_PAYMENTS_REPLICA_DATABASES = ["replica"]
+
+Reads go to a replica only inside ``replica_reads()`` (used by the admin
+changelist and ``ReplicaReadMixin`` views); everything else, and every write,
+stays on ``PLANS_PAYMENTS_PRIMARY_DATABASE`` (``"default"``). Write paths
+wrap themselves in ``primary_reads()`` so the reads they base their writes on
+are never stale, and instances loaded from a replica are saved to the
+primary. ``Payment`` only writes the fields changed since it was loaded from
+a replica then, so its possibly stale values do not overwrite newer ones.
+
+Pages reading their own writes (``PaymentDetailView`` right after
+``CreatePaymentView``) use the replica only when the session did not write
+in the last ``PLANS_PAYMENTS_REPLICA_LAG`` seconds, and fall back to the
+primary when the replica does not have the row yet.
+"""
+
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+LAST_WRITE_SESSION_KEY = "plans_payments_last_write"
+
+_read_from = ContextVar("plans_payments_read_from", default=None)
+
+
+def get_primary_database():
+    return getattr(settings, "PLANS_PAYMENTS_PRIMARY_DATABASE", "default")
+
+
+def get_replica_databases():
+    return getattr(settings, "PLANS_PAYMENTS_REPLICA_DATABASES", [])
+
+
+def get_replica_database():
+    """Return a replica alias, or ``None`` if no replica is configured."""
+    replicas = get_replica_databases()
+    return random.choice(replicas) if replicas else None
+
+
+@contextmanager
+def replica_reads():
+    """Route reads made inside the block to a replica."""
+    token = _read_from.set("replica")
+    try:
+        yield
+    finally:
+        _read_from.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Route reads made inside the block (or decorated function) to the primary."""
+    token = _read_from.set("primary")
+    try:
+        yield
+    finally:
+        _read_from.reset(token)
+
+
+def replica_values(instance):
+    """Loaded concrete field values of ``instance``, to tell its changes on save."""
+    return {
+        field.attname: instance.__dict__[field.attname]
+        for field in instance._meta.concrete_fields
+        if field.attname in instance.__dict__
+    }
+
+
+def changed_fields(instance, loaded):
+    """Names of the fields of ``instance`` changed from the ``loaded`` values."""
+    changed = [
+        field.name
+        for field in instance._meta.concrete_fields
+        if not field.primary_key
+        and field.attname in instance.__dict__
+        and (field.attname not in loaded or loaded[field.attname] != instance.__dict__[field.attname])
+    ]
+    if changed:
+        changed += [
+            field.name
+            for field in instance._meta.concrete_fields
+            if getattr(field, "auto_now", False) and field.name not in changed
+        ]
+    return changed
+
+
+def mark_primary_write(request):
+    """Remember that this session has just written to the primary."""
+    if hasattr(request, "session"):
+        request.session[LAST_WRITE_SESSION_KEY] = time.time()
+
+
+def replica_is_fresh(request):
+    """Whether replicas can be expected to contain the session's writes."""
+    if not get_replica_databases():
+        return False
+    last_write = getattr(request, "session", {}).get(LAST_WRITE_SESSION_KEY)
+    if last_write is None:
+        return True
+    return time.time() - last_write > getattr(settings, "PLANS_PAYMENTS_REPLICA_LAG", 5)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        read_from = _read_from.get()
+        if read_from == "primary":
+            return get_primary_database()
+        if read_from == "replica":
+            return get_replica_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in get_replica_databases():
+            return get_primary_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {get_primary_database(), *get_replica_databases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replica_databases():
+            return False
+        return None
+
+
+def render_from_replica(view, request, *args, **kwargs):
+    """Call ``view`` and render its (lazy) response with replica reads."""
+    with replica_reads():
+        response = view(request, *args, **kwargs)
+        if hasattr(response, "render") and callable(response.render):
+            response.render()
+    return response
+
+
+class ReplicaReadMixin:
+    """Serve the whole view from a replica; writes still go to the primary."""
+
+    def dispatch(self, request, *args, **kwargs):
+        return render_from_replica(super().dispatch, request, *args, **kwargs)
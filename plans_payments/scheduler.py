@@ -0,0 +1,189 @@
+"""
+Jittered, rate-limited renewal schedule.
+
+Sending ``account_automatic_renewal`` for all due accounts at once hits the
+gateways with a burst of charges. ``schedule_renewals`` instead claims the
+due accounts (as ``run_renewals`` does) and stores a ``RenewalSlot`` per
+account at a deterministic offset within ``PLANS_PAYMENTS_RENEWAL_WINDOW``
+seconds (``3600``): the offset is derived from a hash of the user id, so a
+user lands at the same point of the window on every run and on every node.
+
+``process_renewal_slots`` (run it on any number of worker nodes) renews the
+accounts whose slot time has come, with the charges limited per variant by a
+token bucket of ``PLANS_PAYMENTS_RENEWAL_RATE`` charges per second (``1``),
+overridden per variant by ``PLANS_PAYMENTS_RENEWAL_RATE_LIMITS``. The limits
+apply per worker process; divide the gateway's limit by the number of
+workers.
+
+Workers claim batches of slots with ``SELECT ... FOR UPDATE SKIP LOCKED``
+(where the database supports it; SQLite serializes writers instead), so
+they do not wait for each other, and take a lease of
+``PLANS_PAYMENTS_RENEWAL_LEASE`` seconds (``300``) on them. The lease is
+extended from a background thread (heartbeat) while the worker works through
+the batch, including during the gateway calls, and checked
+right before each charge, so a slot is charged only by the worker holding its
+lease. Slots of a worker that died are claimed again once the lease expires;
+if a renewal payment of the account was created since the slot was first
+claimed, it is not charged again.
+"""
+
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import RenewalSlot
+from .ratelimit import TokenBucket
+from .renewal import already_renewed, claim_renewal, iter_due_renewals, renew_user
+from .utils import Heartbeat, chunked, default_worker_id
+
+logger = logging.getLogger(__name__)
+
+
+def get_window():
+    return timedelta(seconds=getattr(settings, "PLANS_PAYMENTS_RENEWAL_WINDOW", 3600))
+
+
+def get_renewal_rate(variant):
+    limits = getattr(settings, "PLANS_PAYMENTS_RENEWAL_RATE_LIMITS", {})
+    return limits.get(variant, getattr(settings, "PLANS_PAYMENTS_RENEWAL_RATE", 1))
+
+
+def jitter(user_id, window):
+    """Deterministic offset of ``user_id`` within ``window``."""
+    digest = hashlib.sha256(str(user_id).encode()).digest()
+    return window * (int.from_bytes(digest[:8], "big") / 2**64)
+
+
+def schedule_batch(dues, start, window):
+    """Claim the renewals of ``dues`` without a pending slot and store their slots; returns the number stored."""
+    pending = set(
+        RenewalSlot.objects.filter(
+            recurring_id__in=[due.recurring_id for due in dues],
+            status=RenewalSlot.Status.PENDING,
+        ).values_list("recurring_id", flat=True)
+    )
+    slots = [
+        RenewalSlot(
+            recurring_id=due.recurring_id,
+            user_id=due.user_id,
+            variant=due.payment_provider,
+            run_at=start + jitter(due.user_id, window),
+        )
+        for due in dues
+        # Already scheduled accounts are not claimed again
+        if due.recurring_id not in pending and claim_renewal(due)
+    ]
+    if not slots:
+        return 0
+    RenewalSlot.objects.bulk_create(slots, ignore_conflicts=True)
+    # bulk_create returns the ignored slots too
+    return RenewalSlot.objects.filter(
+        recurring_id__in=[slot.recurring_id for slot in slots],
+        status=RenewalSlot.Status.PENDING,
+    ).count()
+
+
+def schedule_renewals(providers=None, window=None, start=None, batch_size=1000):
+    """Claim the due renewals and store their slots; returns the number scheduled."""
+    window = get_window() if window is None else window
+    start = timezone.now() if start is None else start
+    return sum(
+        schedule_batch(dues, start, window)
+        for dues in chunked(iter_due_renewals(providers, chunk_size=batch_size), batch_size)
+    )
+
+
+def get_lease():
+    return timedelta(seconds=getattr(settings, "PLANS_PAYMENTS_RENEWAL_LEASE", 300))
+
+
+def claim_slots(worker, limit, now=None, lease=None):
+    """Claim up to ``limit`` due slots for ``worker``; returns ``(pk, user_id, variant, claimed)`` rows."""
+    now = timezone.now() if now is None else now
+    lease = get_lease() if lease is None else lease
+    claimable = Q(status=RenewalSlot.Status.PENDING, run_at__lte=now) | Q(
+        status=RenewalSlot.Status.RUNNING, lease_until__lt=now
+    )
+    with transaction.atomic():
+        candidates = RenewalSlot.objects.filter(claimable).order_by("run_at", "pk")
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list("pk", flat=True)[:limit])
+        if not ids:
+            return []
+        # Conditional, in case the database does not lock the selected rows
+        RenewalSlot.objects.filter(claimable, pk__in=ids).update(
+            status=RenewalSlot.Status.RUNNING,
+            worker=worker,
+            lease_until=now + lease,
+            claimed=Coalesce("claimed", Value(now)),
+        )
+    return list(
+        RenewalSlot.objects.filter(pk__in=ids, worker=worker, status=RenewalSlot.Status.RUNNING)
+        .order_by("run_at", "pk")
+        .values_list("pk", "user_id", "variant", "claimed")
+    )
+
+
+def extend_lease(worker, lease=None, slot_id=None):
+    """Extend the lease of the running slots of ``worker``; returns the number extended."""
+    slots = RenewalSlot.objects.filter(worker=worker, status=RenewalSlot.Status.RUNNING)
+    if slot_id is not None:
+        slots = slots.filter(pk=slot_id)
+    return slots.update(lease_until=timezone.now() + (get_lease() if lease is None else lease))
+
+
+def process_renewal_slots(now=None, batch_size=100, buckets=None, worker=None, lease=None):
+    """Renew the accounts of the slots due by ``now``; returns ``(renewed, failed)``."""
+    buckets = {} if buckets is None else buckets
+    worker = default_worker_id() if worker is None else worker
+    lease = get_lease() if lease is None else lease
+    renewed = failed = 0
+    while True:
+        batch = claim_slots(worker, batch_size, now, lease)
+        if not batch:
+            break
+        # Beats during the charges too, which can outlast the lease
+        with Heartbeat(lambda: extend_lease(worker, lease), lease.total_seconds() / 2):
+            renewed_batch, failed_batch = process_batch(batch, buckets, worker, lease)
+        renewed += renewed_batch
+        failed += failed_batch
+    return renewed, failed
+
+
+def process_batch(batch, buckets, worker, lease):
+    """Renew the accounts of the claimed slots ``batch``; returns ``(renewed, failed)``."""
+    renewed = failed = 0
+    for slot_id, user_id, variant, claimed in batch:
+        if variant not in buckets:
+            buckets[variant] = TokenBucket(get_renewal_rate(variant))
+        buckets[variant].acquire()
+        # Still ours? The lease could be lost, e.g. if heartbeats failed
+        if not extend_lease(worker, lease, slot_id):
+            logger.warning("Lease of renewal slot %s lost, skipping", slot_id)
+            continue
+        if already_renewed(user_id, claimed):
+            status, message = RenewalSlot.Status.DONE, "already renewed"
+        else:
+            try:
+                charged = renew_user(user_id)
+            except Exception as e:
+                logger.exception("Scheduled renewal of user %s failed", user_id)
+                status, message = RenewalSlot.Status.FAILED, str(e) or e.__class__.__name__
+                failed += 1
+            else:
+                # A deferred account is due again and scheduled by the next schedule_renewals
+                status, message = RenewalSlot.Status.DONE, "" if charged else "deferred"
+                renewed += charged
+        RenewalSlot.objects.filter(pk=slot_id, worker=worker).update(
+            status=status,
+            message=message,
+            processed=timezone.now(),
+        )
+    return renewed, failed
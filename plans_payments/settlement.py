@@ -0,0 +1,170 @@
+"""
+Streaming import of gateway settlement exports.
+
+Settlement files are read row by row and applied with
+``plans_payments.bulk.bulk_change_status`` in batches, so memory use does not
+depend on the file size. Supported inputs:
+
+* ``paypal`` - PayPal transaction detail report (CSV, either plain or with the
+  ``RH``/``FH``/``SH``/``CH``/``SB`` row type column) and the Transaction
+  Search API ``transaction_details`` items as JSON lines. Rows are matched by
+  the PayPal sale id (``sale_id`` gateway field), fees are in minor units in
+  the CSV report.
+* ``payu`` - PayU order export with ``orderId``, ``status`` and ``fee``
+  (minor units) columns or keys, matched by ``Payment.transaction_id``.
+
+Gzipped files (``.gz``) are decompressed on the fly.
+"""
+
+import csv
+import gzip
+import io
+import json
+from decimal import Decimal, InvalidOperation
+
+from payments import PaymentStatus
+
+from .bulk import bulk_change_status
+
+PAYPAL_STATUSES = {
+    "S": PaymentStatus.CONFIRMED,
+    "P": PaymentStatus.WAITING,
+    "V": PaymentStatus.REFUNDED,
+    "D": PaymentStatus.REJECTED,
+}
+
+PAYU_STATUSES = {
+    "COMPLETED": PaymentStatus.CONFIRMED,
+    "PENDING": PaymentStatus.WAITING,
+    "WAITING_FOR_CONFIRMATION": PaymentStatus.PREAUTH,
+    "CANCELED": PaymentStatus.REJECTED,
+}
+
+PAYPAL_SECTION_ROW_TYPES = ("RH", "FH", "SH", "CH", "SB", "SF", "SC", "RF", "RC", "FF")
+
+
+class SettlementFormatError(ValueError):
+    pass
+
+
+def _minor_units(value):
+    if value in (None, ""):
+        return None
+    return abs(Decimal(value)) / 100
+
+
+def _paypal_csv_rows(stream):
+    reader = csv.reader(stream)
+    header = None
+    sectioned = False
+    for row in reader:
+        if not row:
+            continue
+        if header is None:
+            sectioned = row[0] in PAYPAL_SECTION_ROW_TYPES
+            if not sectioned:
+                header = row
+            elif row[0] == "CH":
+                header = row[1:]
+            continue
+        if sectioned:
+            if row[0] == "CH":
+                header = row[1:]
+                continue
+            if row[0] != "SB":
+                continue
+            row = row[1:]
+        record = dict(zip(header, row))
+        if "Transaction ID" not in record:
+            raise SettlementFormatError("PayPal report has no 'Transaction ID' column")
+        try:
+            fee = _minor_units(record.get("Fee Amount"))
+        except InvalidOperation as e:
+            raise SettlementFormatError(f"Invalid PayPal transaction on line {reader.line_num}: {e!r}")
+        yield record["Transaction ID"], PAYPAL_STATUSES.get(record.get("Transaction Status")), fee
+
+
+def _paypal_jsonl_rows(stream):
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            info = json.loads(line).get("transaction_info", {})
+            fee = info.get("fee_amount", {}).get("value")
+            row = (
+                info["transaction_id"],
+                PAYPAL_STATUSES.get(info.get("transaction_status")),
+                abs(Decimal(fee)) if fee else None,
+            )
+        except (ValueError, KeyError, TypeError, AttributeError, InvalidOperation) as e:
+            raise SettlementFormatError(f"Invalid PayPal transaction on line {number}: {e!r}")
+        yield row
+
+
+def _payu_record(record, number):
+    try:
+        return (
+            record["orderId"],
+            PAYU_STATUSES.get(record.get("status")),
+            _minor_units(record.get("fee")),
+        )
+    except KeyError:
+        raise SettlementFormatError(f"PayU order on line {number} has no 'orderId'")
+    except (ValueError, TypeError, AttributeError, InvalidOperation) as e:
+        raise SettlementFormatError(f"Invalid PayU order on line {number}: {e!r}")
+
+
+def _payu_csv_rows(stream):
+    reader = csv.DictReader(stream)
+    for record in reader:
+        yield _payu_record(record, reader.line_num)
+
+
+def _payu_jsonl_rows(stream):
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise SettlementFormatError(f"Invalid PayU order on line {number}: {e!r}")
+        yield _payu_record(record, number)
+
+
+# provider: (bulk_change_status keyword arguments, {file format: row parser})
+SETTLEMENT_FORMATS = {
+    "paypal": ({"gateway_field": "sale_id"}, {"csv": _paypal_csv_rows, "jsonl": _paypal_jsonl_rows}),
+    "payu": ({"key": "transaction_id"}, {"csv": _payu_csv_rows, "jsonl": _payu_jsonl_rows}),
+}
+
+
+def guess_file_format(path):
+    name = str(path).lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    return "csv"
+
+
+def open_settlement_file(path):
+    """Open a (possibly gzipped) settlement file as a text stream."""
+    if str(path).endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8-sig", newline="")
+    return open(path, encoding="utf-8-sig", newline="")
+
+
+def iter_settlement_rows(stream, provider, file_format):
+    """Yield ``(identifier, status, fee)`` tuples parsed from ``stream``."""
+    try:
+        parser = SETTLEMENT_FORMATS[provider][1][file_format]
+    except KeyError:
+        raise SettlementFormatError(f"Unsupported settlement format: {provider} {file_format}")
+    return parser(stream)
+
+
+def import_settlement(stream, provider, file_format="csv", batch_size=1000):
+    """Apply the settlement export in ``stream`` and return ``BulkStatusResult``."""
+    rows = iter_settlement_rows(stream, provider, file_format)
+    match_kwargs = SETTLEMENT_FORMATS[provider][0]
+    return bulk_change_status(rows, batch_size=batch_size, **match_kwargs)
@@ -5,3 +5,8 @@ from django.dispatch import Signal
 # prompt the user to update their payment method.
 # Arguments: "payment", "recurring_user_plan"
 renew_token_invalidated = Signal()
+
+# Sent when the renewal of an account is put off without charging (e.g. the
+# circuit breaker of its payment provider is open); the account stays due.
+# Arguments: "user", "variant", "reason"
+renewal_deferred = Signal()
@@ -0,0 +1,204 @@
+"""
+Dry-run simulation of a renewal run.
+
+``simulate_renewals`` goes through the due accounts as ``run_renewals``
+does (claim, ``account_automatic_renewal``, ``renew_accounts``,
+``create_renew_order``, ``create_payment_object`` and
+``autocomplete_with_wallet``), each account inside a transaction that is
+rolled back right after it, so nothing it writes to the database is kept and
+no locks are held across accounts. Each payment variant
+is charged by a ``plans_payments.fake.FakeProvider`` instead of its gateway,
+with the given latency distribution and failure rate (overridable per
+variant). The latency is not waited for, but added up.
+
+Emails are sent to the ``locmem`` backend and circuit breakers are turned
+off during the simulation. Database sequences (primary keys on PostgreSQL)
+still advance.
+
+The ``SimulationResult`` reports the outcomes, the queries per account, the
+peak memory and the projected duration of the real run: the measured time of
+the simulated accounts plus their simulated gateway latency, scaled to all
+due accounts.
+"""
+
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core import mail
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+from payments.core import PROVIDER_CACHE
+
+from .deadlines import get_call_budget
+from .fake import FakeProvider
+from .renewal import claim_renewal, due_renewals, iter_due_renewals, renew_user
+
+SAVEPOINT_PREFIXES = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+@dataclass
+class SimulationResult:
+    #: Accounts due for renewal
+    due: int = 0
+    #: Accounts simulated
+    accounts: int = 0
+    #: Accounts whose renewal payment was confirmed
+    renewed: int = 0
+    #: Accounts whose renewal payment was not confirmed or whose renewal raised
+    failed: int = 0
+    #: Accounts without a renewal payment (other provider, deferred)
+    skipped: int = 0
+    #: Emails that would have been sent
+    emails: int = 0
+    queries: int = 0
+    max_queries: int = 0
+    #: Measured time of the simulated accounts, in seconds
+    elapsed: float = 0
+    #: Simulated gateway latency of the simulated accounts, in seconds
+    gateway_time: float = 0
+    #: Peak memory allocated during the simulation, in bytes
+    peak_memory: int = 0
+
+    @property
+    def queries_per_account(self):
+        return self.queries / self.accounts if self.accounts else 0
+
+    @property
+    def seconds_per_account(self):
+        return (self.elapsed + self.gateway_time) / self.accounts if self.accounts else 0
+
+    @property
+    def projected_duration(self):
+        """Projected duration of renewing all due accounts in one worker, in seconds."""
+        return self.seconds_per_account * self.due
+
+
+class LatencyClock:
+    """``sleep`` of the fake providers, adding the latency up instead of waiting."""
+
+    def __init__(self):
+        self.total = 0
+
+    def sleep(self, seconds):
+        self.total += seconds
+
+
+@contextmanager
+def fake_providers(variants, options, overrides=None):
+    """Charge ``variants`` through ``FakeProvider(**options)`` (updated per variant by ``overrides``)."""
+    overrides = overrides or {}
+    saved = {variant: PROVIDER_CACHE.get(variant) for variant in variants}
+    for variant in variants:
+        PROVIDER_CACHE[variant] = FakeProvider(**{**options, **overrides.get(variant, {})})
+    try:
+        yield
+    finally:
+        for variant, provider in saved.items():
+            if provider is None:
+                PROVIDER_CACHE.pop(variant, None)
+            else:
+                PROVIDER_CACHE[variant] = provider
+
+
+def count_queries(captured):
+    return sum(1 for query in captured if not query["sql"].startswith(SAVEPOINT_PREFIXES))
+
+
+def simulate_account(due, result):
+    """Renew the account of ``due`` and add its outcome to ``result``; the caller rolls it back."""
+    Payment = get_payment_model()
+    started = timezone.now()
+    start = time.monotonic()
+    with CaptureQueriesContext(connection) as captured:
+        try:
+            with transaction.atomic():
+                if claim_renewal(due):
+                    renew_user(due.user_id, get_call_budget(due.payment_provider))
+        except Exception:
+            status = PaymentStatus.ERROR
+        else:
+            status = None
+    result.elapsed += time.monotonic() - start
+    queries = count_queries(captured)
+    result.queries += queries
+    result.max_queries = max(result.max_queries, queries)
+    if status is None:
+        status = (
+            Payment.objects.filter(
+                order__user_id=due.user_id,
+                autorenewed_payment=True,
+                created__gte=started,
+            )
+            .order_by("-pk")
+            .values_list("status", flat=True)
+            .first()
+        )
+    if status is None:
+        result.skipped += 1
+    elif status == PaymentStatus.CONFIRMED:
+        result.renewed += 1
+    else:
+        result.failed += 1
+
+
+def simulate_renewals(
+    providers=None,
+    limit=None,
+    latency=0.5,
+    latency_stdev=0,
+    failure_rate=0,
+    overrides=None,
+    seed=None,
+):
+    """Simulate the renewal of the due accounts; returns ``SimulationResult``.
+
+    ``overrides`` maps variants to ``FakeProvider`` options, e.g.
+    ``{"payu": {"latency": 1.2, "failure_rate": 0.1}}``.
+    """
+    result = SimulationResult()
+    clock = LatencyClock()
+    options = {
+        "latency": latency,
+        "latency_stdev": latency_stdev,
+        "failure_rate": failure_rate,
+        "seed": seed,
+        "sleep": clock.sleep,
+    }
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    else:
+        tracemalloc.reset_peak()
+    try:
+        with override_settings(
+            EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            PLANS_PAYMENTS_CIRCUIT_BREAKER=None,
+            PLANS_PAYMENTS_CIRCUIT_BREAKERS={},
+        ), fake_providers(settings.PAYMENT_VARIANTS, options, overrides):
+            outbox = getattr(mail, "outbox", None)
+            mail.outbox = []
+            result.due = due_renewals(providers).count()
+            for due in iter_due_renewals(providers):
+                if limit is not None and result.accounts >= limit:
+                    break
+                result.accounts += 1
+                # Rolled back per account, so no locks are held across accounts
+                with transaction.atomic():
+                    simulate_account(due, result)
+                    transaction.set_rollback(True)
+            result.emails = len(mail.outbox)
+            if outbox is None:
+                del mail.outbox
+            else:
+                mail.outbox = outbox
+        result.gateway_time = clock.total
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    return result
@@ -0,0 +1,207 @@
+"""
+Compare-and-swap status transitions of payments and orders.
+
+``PAYMENT_TRANSITIONS`` and ``ORDER_TRANSITIONS`` map a status to the
+statuses it may change to. A transition is a single conditional
+``UPDATE ... SET status = <new> WHERE pk IN <pks> AND status IN <expected>``
+(for payments, their loaded status; for orders, by default the statuses the
+table allows to change to the new one), which tells whether it took effect:
+a concurrent writer that changed the status first makes it a no-op instead
+of being overwritten, and only the status (and the modification time) is
+written.
+
+``transition_payment`` is a race-free ``Payment.change_status``: on success
+it records the event, facet counts and change record as ``Payment.save``
+would and sends ``status_changed``. ``complete_order`` and ``return_order``
+claim the order with a transition before django-plans extends or reduces
+the account, so it happens once however many callbacks race.
+
+Queryset updates bypass django-simple-history; ``transition_order`` records
+the history entry itself when the order model has one and the transition
+took effect (``complete_order`` and ``return_order`` save the order).
+"""
+
+from django.db import transaction
+from django.utils import timezone
+from payments import PaymentStatus, get_payment_model
+from payments.signals import status_changed
+from plans.models import Order
+
+from .cdc import cdc_enabled, record_payment_changes
+from .events import EventKind, event_log_enabled, record_event
+from .facets import apply_facet_deltas, facet_counts_enabled
+
+PAYMENT_TRANSITIONS = {
+    PaymentStatus.WAITING: {
+        PaymentStatus.INPUT,
+        PaymentStatus.PREAUTH,
+        PaymentStatus.CONFIRMED,
+        PaymentStatus.REJECTED,
+        PaymentStatus.ERROR,
+    },
+    PaymentStatus.INPUT: {
+        PaymentStatus.WAITING,
+        PaymentStatus.PREAUTH,
+        PaymentStatus.CONFIRMED,
+        PaymentStatus.REJECTED,
+        PaymentStatus.ERROR,
+    },
+    PaymentStatus.PREAUTH: {
+        PaymentStatus.CONFIRMED,
+        PaymentStatus.REJECTED,
+        PaymentStatus.ERROR,
+        PaymentStatus.REFUNDED,
+    },
+    PaymentStatus.CONFIRMED: {PaymentStatus.REFUNDED},
+    # Gateways report the outcome of some payments after an error
+    PaymentStatus.ERROR: {
+        PaymentStatus.WAITING,
+        PaymentStatus.INPUT,
+        PaymentStatus.CONFIRMED,
+        PaymentStatus.REJECTED,
+    },
+    PaymentStatus.REJECTED: set(),
+    PaymentStatus.REFUNDED: set(),
+}
+
+ORDER_TRANSITIONS = {
+    Order.STATUS.NEW: {Order.STATUS.COMPLETED, Order.STATUS.NOT_VALID, Order.STATUS.CANCELED},
+    Order.STATUS.NOT_VALID: {Order.STATUS.COMPLETED, Order.STATUS.CANCELED, Order.STATUS.RETURNED},
+    # A late confirmation completes a canceled order
+    Order.STATUS.CANCELED: {Order.STATUS.COMPLETED, Order.STATUS.NOT_VALID},
+    Order.STATUS.COMPLETED: {Order.STATUS.RETURNED},
+    # change_payment_status cancels the orders of failed payments unless they are completed
+    Order.STATUS.RETURNED: {Order.STATUS.CANCELED},
+}
+
+
+# What Payment.from_db keeps of the loaded row, and Payment.save compares against
+LOADED_VALUES = ("_loaded_values", "_facet_values", "_replica_values")
+
+
+class InvalidTransition(ValueError):
+    pass
+
+
+def sources(transitions, new):
+    """Statuses allowed to change to ``new``."""
+    return [status for status, targets in transitions.items() if new in targets]
+
+
+def transition_payments(payment_ids, new, expected, now=None):
+    """Change the status of the payments ``payment_ids`` from ``expected`` to ``new``; returns the number changed.
+
+    Payments no longer in the ``expected`` status are left as they are.
+    Nothing else is recorded, see ``transition_payment``.
+    """
+    if new not in PAYMENT_TRANSITIONS.get(expected, ()):
+        raise InvalidTransition(f"Payments cannot change from {expected} to {new}")
+    return (
+        get_payment_model()
+        .objects.filter(pk__in=payment_ids, status=expected)
+        .update(status=new, modified=timezone.now() if now is None else now)
+    )
+
+
+def transition_payment(payment, new, expected=None, message=None):
+    """Change the status of ``payment`` from ``expected`` (its loaded status) to ``new``.
+
+    Returns whether the payment still had the ``expected`` status, i.e.
+    whether the transition took effect. Raises ``InvalidTransition`` if
+    ``PAYMENT_TRANSITIONS`` does not allow it.
+    """
+    expected = payment.status if expected is None else expected
+    if new not in PAYMENT_TRANSITIONS.get(expected, ()):
+        raise InvalidTransition(f"Payment {payment.pk} cannot change from {expected} to {new}")
+    fields = {"status": new, "modified": timezone.now()}
+    if message is not None:
+        fields["message"] = message
+    if not get_payment_model().objects.filter(pk=payment.pk, status=expected).update(**fields):
+        return False
+    for name, value in fields.items():
+        setattr(payment, name, value)
+    # What Payment.save records, known without reading the row
+    for values in filter(None, (getattr(payment, name, None) for name in LOADED_VALUES)):
+        values.update((name, value) for name, value in fields.items() if name in values)
+    if event_log_enabled():
+        record_event(payment, EventKind.STATUS, new)
+    if facet_counts_enabled():
+        apply_facet_deltas({("status", expected): -1, ("status", new): 1})
+    if cdc_enabled():
+        record_payment_changes([payment.pk])
+    status_changed.send(sender=type(payment), instance=payment)
+    return True
+
+
+def transition_orders(order_ids, new, expected=None, now=None, **conditions):
+    """Change the status of the orders ``order_ids`` to ``new``; returns the number changed.
+
+    Only orders in the ``expected`` status or statuses (default: those
+    ``ORDER_TRANSITIONS`` allows to change to ``new``) and matching the
+    queryset filter ``conditions`` are changed.
+    """
+    allowed = sources(ORDER_TRANSITIONS, new)
+    if expected is None:
+        expected = allowed
+    elif isinstance(expected, int):
+        expected = [expected]
+    if not allowed or set(expected) - set(allowed):
+        raise InvalidTransition(
+            f"Orders cannot change from {sorted(set(expected) - set(allowed) or expected)} to {new}"
+        )
+    return Order.objects.filter(pk__in=order_ids, status__in=expected, **conditions).update(
+        status=new,
+        updated_at=timezone.now() if now is None else now,
+    )
+
+
+def transition_order(order, new, expected=None, change_reason=""):
+    """Change the status of ``order`` to ``new``; returns whether it took effect."""
+    now = timezone.now()
+    if not transition_orders([order.pk], new, expected, now):
+        return False
+    order.status, order.updated_at = new, now
+    # In case django-simple-history is installed
+    history = getattr(type(order), "history", None)
+    if history is not None:
+        history.bulk_history_create([order], update=True, default_change_reason=change_reason)
+    return True
+
+
+def complete_order(order, change_reason=""):
+    """Complete ``order`` (``Order.complete_order``) unless it is completed already; returns whether it took effect."""
+    with transaction.atomic():
+        # The claim locks the order row until the account is extended
+        if not transition_orders([order.pk], Order.STATUS.COMPLETED, completed__isnull=True):
+            return False
+        claimed = Order.objects.select_related("user").get(pk=order.pk)
+        if change_reason:
+            claimed._change_reason = change_reason
+        claimed.complete_order()
+    order.status, order.completed = claimed.status, claimed.completed
+    return True
+
+
+def return_order(order, change_reason=""):
+    """Return ``order`` (``Order.return_order``) unless it is returned already; returns whether it took effect.
+
+    Raises ``ValueError`` as ``Order.return_order`` does if the order is
+    neither completed nor not valid.
+    """
+    with transaction.atomic():
+        for status in (Order.STATUS.COMPLETED, Order.STATUS.NOT_VALID):
+            if transition_orders([order.pk], Order.STATUS.RETURNED, status):
+                break
+        else:
+            status = Order.objects.filter(pk=order.pk).values_list("status", flat=True).get()
+            if status != Order.STATUS.RETURNED:
+                raise ValueError(f"Cannot return order with status other than COMPLETED and NOT_VALID: {status}")
+            return False
+        claimed = Order.objects.select_related("user").get(pk=order.pk)
+        # return_order reduces the account of completed orders only
+        claimed.status = status
+        if change_reason:
+            claimed._change_reason = change_reason
+        claimed.return_order()
+    order.status = claimed.status
+    return True
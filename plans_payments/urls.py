@@ -1,6 +1,13 @@
+from django.conf import settings
 from django.urls import path
 
-from .views import CreatePaymentView, PaymentDetailView
+from .views import PaymentHistoryView
+
+if getattr(settings, "PLANS_PAYMENTS_ASYNC_VIEWS", False):
+    from .async_views import AsyncCreatePaymentView as CreatePaymentView
+    from .async_views import AsyncPaymentDetailView as PaymentDetailView
+else:
+    from .views import CreatePaymentView, PaymentDetailView
 
 urlpatterns = [
     path(
@@ -13,4 +20,9 @@ urlpatterns = [
         CreatePaymentView.as_view(),
         name="create_payment",
     ),
+    path(
+        "payment_history/",
+        PaymentHistoryView.as_view(),
+        name="payment_history",
+    ),
 ]
@@ -0,0 +1,48 @@
+"""
+Denormalized ``Payment.user``.
+
+Payments are owned through ``order.user``; ``Payment.user`` copies it so
+ownership checks and per-user listings use the ``(user, created)`` and
+``(user, status)`` indexes instead of a join over ``plans_order``. New
+payments get it on creation; fill it in for existing ones with the
+``backfill_payment_user`` command and then switch the lookups over with
+``PLANS_PAYMENTS_DENORMALIZED_USER = True``.
+"""
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from payments import get_payment_model
+from plans.models import Order
+
+
+def denormalized_user_enabled():
+    return getattr(settings, "PLANS_PAYMENTS_DENORMALIZED_USER", False)
+
+
+def user_filter(user):
+    """Keyword arguments filtering ``Payment`` rows of ``user``."""
+    if denormalized_user_enabled():
+        return {"user": user}
+    return {"order__user": user}
+
+
+def backfill_payment_user(batch_size=10000, start_pk=0):
+    """Set ``Payment.user`` from the order for existing payments.
+
+    Runs one ``UPDATE`` per primary key range of ``batch_size`` and yields the
+    end of every range, so callers can report progress or resume with
+    ``start_pk``.
+    """
+    Payment = get_payment_model()
+    max_pk = Payment.objects.order_by("-pk").values_list("pk", flat=True).first()
+    if max_pk is None:
+        return
+    order_user = Order.objects.filter(pk=OuterRef("order_id")).values("user_id")[:1]
+    last_pk = start_pk
+    while last_pk < max_pk:
+        end = last_pk + batch_size
+        Payment.objects.filter(pk__gt=last_pk, pk__lte=end, user__isnull=True, order__isnull=False).update(
+            user_id=Subquery(order_user)
+        )
+        last_pk = min(end, max_pk)
+        yield last_pk
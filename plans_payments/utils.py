@@ -0,0 +1,110 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from decimal import Decimal
+from itertools import islice
+
+import django
+from django.db import connections
+from payments import get_payment_model
+
+from .routers import primary_reads
+
+logger = logging.getLogger(__name__)
+
+
+def chunked(iterable, size):
+    """Yield lists of at most ``size`` items from ``iterable``, lazily."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def init_worker_process():
+    """Initializer of ``ProcessPoolExecutor`` workers running ORM code."""
+    # Spawned workers start without configured apps; forked ones must not
+    # reuse the parent's database connections.
+    django.setup()
+    for connection in connections.all(initialized_only=True):
+        connection.close()
+
+
+def default_worker_id():
+    """Name of this worker process in leases."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"[-64:]
+
+
+class Heartbeat:
+    """Call ``beat`` every ``interval`` seconds on a background thread while the block runs.
+
+    Keeps leases alive during calls that can outlast them, e.g. gateway calls.
+    """
+
+    def __init__(self, beat, interval):
+        self.beat = beat
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    self.beat()
+                except Exception:
+                    logger.exception("Heartbeat failed")
+        finally:
+            # The thread has its own database connections
+            connections.close_all()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def get_client_ip(request):
+    return request.META.get("REMOTE_ADDR")
+
+
+def get_payment_kwargs(payment_variant, order, request=None, autorenewed_payment=False):
+    """Field values of a new ``Payment`` of ``order``."""
+    return dict(
+        variant=payment_variant,
+        order=order,
+        user=order.user,
+        description=f"{order.name} purchase",
+        total=Decimal(order.total()),
+        tax=Decimal(order.tax_total()),
+        currency=order.currency,
+        delivery=Decimal(0),
+        billing_first_name=order.user.first_name,
+        billing_last_name=order.user.last_name,
+        billing_email=order.user.email or "",
+        billing_address_1=order.user.billinginfo.street,
+        # billing_address_2=order.user.billinginfo.zipcode,
+        billing_city=order.user.billinginfo.city,
+        billing_postcode=order.user.billinginfo.zipcode,
+        billing_country_code=order.user.billinginfo.country,
+        # billing_country_area=order.user.billinginfo.zipcode,
+        customer_ip_address=get_client_ip(request) if request else "127.0.0.1",
+        autorenewed_payment=autorenewed_payment,
+    )
+
+
+@primary_reads()
+def create_payment_object(payment_variant, order, request=None, autorenewed_payment=False):
+    Payment = get_payment_model()
+    if hasattr(order.user.userplan, "recurring") and order.user.userplan.recurring.payment_provider != payment_variant:
+        order.user.userplan.recurring.delete()
+    return Payment.objects.create(**get_payment_kwargs(payment_variant, order, request, autorenewed_payment))
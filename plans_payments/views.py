@@ -1,6 +1,6 @@
-from decimal import Decimal
-
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
 from django.urls import reverse, reverse_lazy
@@ -8,55 +8,71 @@ from django.views.generic import View
 from payments import RedirectNeeded, get_payment_model
 from plans.models import Order
 
+from .pagination import InvalidCursor, keyset_page
+from .routers import get_primary_database, get_replica_database, mark_primary_write, replica_is_fresh
+from .users import user_filter
+from .utils import create_payment_object, get_client_ip, get_payment_kwargs  # noqa: F401
+
 
 class PaymentDetailView(LoginRequiredMixin, View):
     login_url = reverse_lazy("auth_login")
     template_name = "plans_payments/payment.html"
 
+    def get_payment(self, request, payment_id):
+        payments = get_payment_model().objects.filter(**user_filter(request.user))
+        if replica_is_fresh(request):
+            try:
+                payment = payments.using(get_replica_database()).get(id=payment_id)
+            except ObjectDoesNotExist:
+                # Replication lag - the replica does not have the payment yet
+                pass
+            else:
+                # The provider may update the payment while building the form
+                payment._state.db = get_primary_database()
+                return payment
+        return get_object_or_404(payments, id=payment_id)
+
     def get(self, request, *args, payment_id=None):
-        payment = get_object_or_404(get_payment_model(), order__user=request.user, id=payment_id)
+        payment = self.get_payment(request, payment_id)
         try:
             form = payment.get_form(data=request.POST or None)
         except RedirectNeeded as redirect_to:
             payment.save()
+            mark_primary_write(request)
             return redirect(str(redirect_to))
         return TemplateResponse(request, "plans_payments/payment.html", {"form": form, "payment": payment})
 
 
-def get_client_ip(request):
-    return request.META.get("REMOTE_ADDR")
-
-
-def create_payment_object(payment_variant, order, request=None, autorenewed_payment=False):
-    Payment = get_payment_model()
-    if hasattr(order.user.userplan, "recurring") and order.user.userplan.recurring.payment_provider != payment_variant:
-        order.user.userplan.recurring.delete()
-    return Payment.objects.create(
-        variant=payment_variant,
-        order=order,
-        description=f"{order.name} purchase",
-        total=Decimal(order.total()),
-        tax=Decimal(order.tax_total()),
-        currency=order.currency,
-        delivery=Decimal(0),
-        billing_first_name=order.user.first_name,
-        billing_last_name=order.user.last_name,
-        billing_email=order.user.email or "",
-        billing_address_1=order.user.billinginfo.street,
-        # billing_address_2=order.user.billinginfo.zipcode,
-        billing_city=order.user.billinginfo.city,
-        billing_postcode=order.user.billinginfo.zipcode,
-        billing_country_code=order.user.billinginfo.country,
-        # billing_country_area=order.user.billinginfo.zipcode,
-        customer_ip_address=get_client_ip(request) if request else "127.0.0.1",
-        autorenewed_payment=autorenewed_payment,
-    )
-
-
 class CreatePaymentView(LoginRequiredMixin, View):
     login_url = reverse_lazy("auth_login")
 
     def get(self, request, *args, order_id=None, payment_variant=None):
         order = get_object_or_404(Order, pk=order_id, user=request.user)
         payment = create_payment_object(payment_variant, order, request)
+        mark_primary_write(request)
         return redirect(reverse("payment_details", kwargs={"payment_id": payment.id}))
+
+
+class PaymentHistoryView(LoginRequiredMixin, View):
+    """JSON listing of the user's payments, newest first, with cursor pagination."""
+
+    login_url = reverse_lazy("auth_login")
+    fields = ("id", "created", "status", "variant", "total", "currency", "description", "order_id")
+    default_limit = 20
+    max_limit = 100
+
+    def get_queryset(self, request):
+        return get_payment_model().objects.filter(**user_filter(request.user))
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = int(request.GET.get("limit", self.default_limit))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.max_limit:
+            return JsonResponse({"error": f"limit must be between 1 and {self.max_limit}"}, status=400)
+        try:
+            rows, next_cursor = keyset_page(self.get_queryset(request), self.fields, request.GET.get("cursor"), limit)
+        except InvalidCursor as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        return JsonResponse({"results": rows, "next": next_cursor})
@@ -0,0 +1,13 @@
+"""
+Drop-in replacement of ``payments.urls`` deduplicating gateway callbacks,
+see ``plans_payments.webhooks``.
+"""
+
+from django.urls import path, re_path
+
+from .webhooks import process_data, static_callback
+
+urlpatterns = [
+    path("process/<uuid:token>/", process_data, name="process_payment"),
+    re_path(r"^process/(?P<variant>[a-z-]+)/$", static_callback, name="static_process_payment"),
+]
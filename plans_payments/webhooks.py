@@ -0,0 +1,157 @@
+"""
+Deduplication of gateway callbacks.
+
+Gateways retry their callbacks until they get a successful response, and
+often more times than that. Every retry reaching ``payments.urls`` loads
+the payment, runs the provider's ``process_data`` and ``Payment.save`` and
+fires ``change_payment_status`` again.
+
+The views of ``plans_payments.webhook_urls`` (a drop-in replacement for
+``payments.urls``) identify each callback by an event id: the value of the
+first of the ``PLANS_PAYMENTS_WEBHOOK_EVENT_ID_HEADERS`` present, the
+provider's ``get_webhook_event_id(request)`` on the static endpoint, or
+else a hash of the request body. The event is claimed by inserting a
+``WebhookEvent`` (unique on ``(scope, event_id)``) in the transaction that
+processes the callback; it is rolled back when processing fails or answers
+with an error, so the gateway's next retry is processed again. Processed
+events are remembered in an in-process LRU cache of
+``PLANS_PAYMENTS_WEBHOOK_CACHE_SIZE`` entries (``10000``), so most retries
+are answered without touching the database.
+
+GET requests without an event id header (customers returning from the
+gateway) are not deduplicated.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from payments import urls as payments_urls
+from payments.core import provider_factory
+
+DEFAULT_EVENT_ID_HEADERS = ("Paypal-Transmission-Id", "Webhook-Id", "Idempotency-Key")
+
+
+class LRUCache:
+    """Thread-safe set of the ``maxsize`` most recently added keys."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+processed_events = LRUCache(getattr(settings, "PLANS_PAYMENTS_WEBHOOK_CACHE_SIZE", 10000))
+
+
+def get_event_id(request, provider=None):
+    """Identifier of the callback ``request``, ``None`` if it should not be deduplicated."""
+    for header in getattr(settings, "PLANS_PAYMENTS_WEBHOOK_EVENT_ID_HEADERS", DEFAULT_EVENT_ID_HEADERS):
+        if request.headers.get(header):
+            return request.headers[header][:128]
+    if provider is not None and hasattr(provider, "get_webhook_event_id"):
+        event_id = provider.get_webhook_event_id(request)
+        if event_id:
+            return str(event_id)[:128]
+    if request.method == "POST" and request.body:
+        return "sha256:" + hashlib.sha256(request.body).hexdigest()
+    return None
+
+
+def claim_event(scope, event_id):
+    """Insert the ``WebhookEvent``; ``False`` if it is already stored.
+
+    Call it inside the transaction processing the event, so that the claim is
+    rolled back with it.
+    """
+    from .models import WebhookEvent
+
+    try:
+        with transaction.atomic():
+            WebhookEvent.objects.create(scope=scope, event_id=event_id)
+    except IntegrityError:
+        return False
+    return True
+
+
+def prune_events(older_than):
+    """Delete the events stored for longer than ``older_than``; returns the number deleted."""
+    from .models import WebhookEvent
+
+    deleted, _ = WebhookEvent.objects.filter(created__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+def duplicate_response():
+    return HttpResponse("")
+
+
+def deduplicated(scope, event_id, process):
+    """Run ``process()`` unless the event ``(scope, event_id)`` was processed already."""
+    if event_id is None:
+        return process()
+    key = (scope, event_id)
+    if key in processed_events:
+        return duplicate_response()
+    with transaction.atomic():
+        if not claim_event(scope, event_id):
+            processed_events.add(key)
+            return duplicate_response()
+        response = process()
+        if response.status_code >= 400:
+            # Not processed, let the gateway retry it
+            transaction.set_rollback(True)
+            return response
+        transaction.on_commit(lambda: processed_events.add(key))
+    return response
+
+
+@csrf_exempt
+def process_data(request, token, provider=None):
+    """``payments.urls.process_data`` answering repeated callbacks without processing them."""
+    return deduplicated(
+        str(token),
+        get_event_id(request, provider),
+        lambda: payments_urls.process_data(request, token, provider),
+    )
+
+
+@csrf_exempt
+def static_callback(request, variant):
+    """``payments.urls.static_callback`` answering repeated callbacks without processing them."""
+    try:
+        provider = provider_factory(variant)
+    except ValueError:
+        # Answered by static_callback
+        provider = None
+    return deduplicated(
+        variant,
+        get_event_id(request, provider),
+        lambda: payments_urls.static_callback(request, variant),
+    )
@@ -0,0 +1,15 @@
+from django.contrib.auth import views as auth_views
+from django.urls import include, path
+
+from plans_payments.async_views import AsyncCreatePaymentView, AsyncPaymentDetailView
+
+urlpatterns = [
+    path("payment_details/<int:payment_id>/", AsyncPaymentDetailView.as_view(), name="payment_details"),
+    path(
+        "create_payment/<str:payment_variant>/<int:order_id>/",
+        AsyncCreatePaymentView.as_view(),
+        name="create_payment",
+    ),
+    path("login/", auth_views.LoginView.as_view(), name="auth_login"),
+    path("", include("plans.urls")),
+]
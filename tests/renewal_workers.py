@@ -0,0 +1,63 @@
+"""
+Processes of the multi-process test of renewal slots (tests.test_scheduler).
+
+    python -m tests.renewal_workers setup ACCOUNTS
+    python -m tests.renewal_workers work CHARGES_FILE
+
+Run with ``PLANS_PAYMENTS_TEST_DB`` pointing to a shared SQLite file.
+"""
+
+import os
+import sys
+import time
+from datetime import timedelta
+from unittest import mock
+
+import django
+
+
+def setup(accounts):
+    from django.core.management import call_command
+    from django.utils import timezone
+    from model_bakery import baker
+    from plans.models import RecurringUserPlan
+
+    from plans_payments.scheduler import schedule_renewals
+
+    call_command("migrate", verbosity=0)
+    for _ in range(accounts):
+        userplan = baker.make("UserPlan", expire=timezone.localdate() + timedelta(days=1))
+        baker.make(
+            "RecurringUserPlan",
+            user_plan=userplan,
+            payment_provider="default",
+            renewal_triggered_by=RecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+            token_verified=True,
+            currency="EUR",
+        )
+    with mock.patch("django.conf.settings.PLANS_AUTORENEW_SCHEDULE", [timedelta(days=3)], create=True):
+        schedule_renewals(window=timedelta(0))
+
+
+def work(charges_file):
+    from plans_payments.scheduler import process_renewal_slots
+
+    def renew_user(user_id, timeout=None):
+        with open(charges_file, "a") as f:
+            f.write(f"{user_id}\n")
+        # A gateway call, lets the other workers in
+        time.sleep(0.01)
+        return True
+
+    with mock.patch("plans_payments.scheduler.renew_user", side_effect=renew_user):
+        with mock.patch("django.conf.settings.PLANS_PAYMENTS_RENEWAL_RATE", 1000, create=True):
+            process_renewal_slots(batch_size=5)
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+    django.setup()
+    if sys.argv[1] == "setup":
+        setup(int(sys.argv[2]))
+    else:
+        work(sys.argv[2])
@@ -1,4 +1,5 @@
 # -*- coding: utf-8
+import os
 from typing import Dict, Tuple
 
 import django
@@ -12,9 +13,15 @@ SECRET_KEY = "-#5o&sf4iu8&-@na$ad*(t)0gl6_gnw-7_=mk5!zcck)p0w&30"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": ":memory:",
+        # A file shared by the worker processes of tests.test_scheduler
+        "NAME": os.environ.get("PLANS_PAYMENTS_TEST_DB", ":memory:"),
+        "OPTIONS": {"timeout": 30},
     }
 }
+if django.VERSION >= (5, 1):
+    # Take the write lock when the transaction starts, concurrent writers wait for it
+    DATABASES["default"]["OPTIONS"]["transaction_mode"] = "IMMEDIATE"
+DATABASE_ROUTERS = ["plans_payments.routers.ReplicaRouter"]
 
 ROOT_URLCONF = "tests.urls"
 
@@ -37,6 +44,7 @@ PAYMENT_MODEL = "plans_payments.Payment"
 
 PAYMENT_VARIANTS: Dict[str, Tuple[str, Dict]] = {
     "default": ("payments.dummy.DummyProvider", {}),
+    "fake": ("plans_payments.fake.FakeProvider", {}),
 }
 
 TEMPLATES = [
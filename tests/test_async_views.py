@@ -0,0 +1,130 @@
+import asyncio
+import importlib
+import threading
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from model_bakery import baker
+from payments import RedirectNeeded
+
+from plans_payments import async_views, urls
+from plans_payments.models import Payment
+
+
+# Provider calls write the payment, keep them on the test transaction's connection
+@override_settings(ROOT_URLCONF="tests.async_urls", PLANS_PAYMENTS_ASYNC_PROVIDER_WORKERS=0)
+class AsyncPaymentDetailViewTests(TestCase):
+    def get(self, url):
+        return async_to_sync(self.async_client.get)(url)
+
+    def test_anonymous(self):
+        response = self.get(reverse("payment_details", kwargs={"payment_id": 1}))
+        self.assertRedirects(response, "/login/?next=/payment_details/1/", fetch_redirect_response=False)
+
+    def test_get(self):
+        user = baker.make("User")
+        payment = baker.make(Payment, order__user=user, variant="default", billing_email="bar@baz.cz")
+        self.async_client.force_login(user)
+        response = self.get(reverse("payment_details", kwargs={"payment_id": payment.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'name="status"')
+
+    def test_different_user(self):
+        payment = baker.make(Payment, order__user=baker.make("User"), variant="default")
+        self.async_client.force_login(baker.make("User"))
+        response = self.get(reverse("payment_details", kwargs={"payment_id": payment.id}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_redirect_needed(self):
+        user = baker.make("User")
+        payment = baker.make(Payment, order__user=user, variant="default", billing_email="bar@baz.cz")
+        self.async_client.force_login(user)
+        with mock.patch.object(Payment, "get_form", side_effect=RedirectNeeded("https://3ds.example.com")):
+            response = self.get(reverse("payment_details", kwargs={"payment_id": payment.id}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, "https://3ds.example.com")
+
+
+@override_settings(ROOT_URLCONF="tests.async_urls")
+class AsyncCreatePaymentViewTests(TestCase):
+    def get(self, url):
+        return async_to_sync(self.async_client.get)(url)
+
+    def test_get(self):
+        user = baker.make("User")
+        self.async_client.force_login(user)
+        order = baker.make("Order", user=user, amount=10, tax=21, currency="EUR")
+        userplan = baker.make("UserPlan", user=user)
+        baker.make("RecurringUserPlan", user_plan=userplan, payment_provider="other-variant")
+        baker.make("BillingInfo", user=user, city="Prague")
+        response = self.get(reverse("create_payment", kwargs={"order_id": order.id, "payment_variant": "default"}))
+        payment = Payment.objects.get(order=order)
+        self.assertRedirects(
+            response,
+            reverse("payment_details", kwargs={"payment_id": payment.id}),
+            fetch_redirect_response=False,
+        )
+        self.assertEqual(payment.variant, "default")
+        self.assertEqual(payment.total, order.total())
+        self.assertEqual(payment.billing_city, "Prague")
+        userplan.refresh_from_db()
+        self.assertFalse(hasattr(userplan, "recurring"))
+
+    def test_different_user(self):
+        order = baker.make("Order", user=baker.make("User"))
+        self.async_client.force_login(baker.make("User"))
+        response = self.get(reverse("create_payment", kwargs={"order_id": order.id, "payment_variant": "default"}))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Payment.objects.exists())
+
+
+class RunProviderCallTests(SimpleTestCase):
+    @override_settings(PLANS_PAYMENTS_ASYNC_PROVIDER_WORKERS=2)
+    def test_bounded_pool(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_call(value):
+            with lock:
+                running.append(value)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(value)
+            return threading.current_thread().name, value
+
+        async def run_all():
+            return await asyncio.gather(*(async_views.run_provider_call(slow_call, i) for i in range(6)))
+
+        results = async_to_sync(run_all)()
+        self.assertEqual([value for _, value in results], list(range(6)))
+        self.assertTrue(all(name.startswith("plans-payments-provider") for name, _ in results))
+        self.assertEqual(max(peak), 2)
+
+    @override_settings(PLANS_PAYMENTS_ASYNC_PROVIDER_WORKERS=0)
+    def test_disabled_pool(self):
+        self.assertIsNone(async_views.get_provider_executor())
+        self.assertEqual(async_to_sync(async_views.run_provider_call)(sum, [1, 2]), 3)
+
+    def test_exception(self):
+        def fail():
+            raise RedirectNeeded("https://example.com")
+
+        with self.assertRaises(RedirectNeeded):
+            async_to_sync(async_views.run_provider_call)(fail)
+
+
+class UrlsTests(SimpleTestCase):
+    def tearDown(self):
+        importlib.reload(urls)
+
+    def test_async_views_setting(self):
+        with override_settings(PLANS_PAYMENTS_ASYNC_VIEWS=True):
+            module = importlib.reload(urls)
+        views = {pattern.name: pattern.callback.view_class for pattern in module.urlpatterns}
+        self.assertIs(views["payment_details"], async_views.AsyncPaymentDetailView)
+        self.assertIs(views["create_payment"], async_views.AsyncCreatePaymentView)
@@ -0,0 +1,121 @@
+from decimal import Decimal
+
+from django.test import TestCase, override_settings
+from model_bakery import baker
+from payments import PaymentStatus
+from plans.models import Order
+
+from plans_payments import models
+from plans_payments.bulk import bulk_change_status
+
+
+class BulkChangeStatusTests(TestCase):
+    def _payment(self, transaction_id, order_status=Order.STATUS.NEW, **kwargs):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        return baker.make(
+            models.Payment,
+            transaction_id=transaction_id,
+            variant="default",
+            order__user=user,
+            order__status=order_status,
+            **kwargs,
+        )
+
+    def test_confirmed(self):
+        payment = self._payment("T1")
+        recurring = baker.make("RecurringUserPlan", user_plan=payment.order.user.userplan, token_verified=False)
+        result = bulk_change_status([("T1", PaymentStatus.CONFIRMED, None)])
+        self.assertEqual(result.updated, 1)
+        payment.refresh_from_db()
+        payment.order.refresh_from_db()
+        recurring.refresh_from_db()
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(payment.order.status, Order.STATUS.COMPLETED)
+        self.assertTrue(recurring.token_verified)
+
+    def test_rejected_cancels_orders(self):
+        new = self._payment("T1")
+        completed = self._payment("T2", order_status=Order.STATUS.COMPLETED)
+        waiting = self._payment("T3")
+        bulk_change_status(
+            [
+                ("T1", PaymentStatus.REJECTED, None),
+                ("T2", PaymentStatus.REJECTED, None),
+                ("T3", PaymentStatus.WAITING, None),
+            ]
+        )
+        self.assertEqual(Order.objects.get(pk=new.order_id).status, Order.STATUS.CANCELED)
+        self.assertEqual(Order.objects.get(pk=completed.order_id).status, Order.STATUS.COMPLETED)
+        self.assertEqual(Order.objects.get(pk=waiting.order_id).status, Order.STATUS.NEW)
+
+    def test_same_end_state_as_change_status(self):
+        statuses = [PaymentStatus.CONFIRMED, PaymentStatus.REJECTED, PaymentStatus.ERROR, PaymentStatus.INPUT]
+        per_row = [self._payment(f"R{i}") for i in range(len(statuses))]
+        bulk = [self._payment(f"B{i}") for i in range(len(statuses))]
+        for payment, status in zip(per_row, statuses):
+            payment.change_status(status)
+        bulk_change_status((f"B{i}", status, None) for i, status in enumerate(statuses))
+        for row_payment, bulk_payment in zip(per_row, bulk):
+            row_payment.refresh_from_db()
+            bulk_payment.refresh_from_db()
+            self.assertEqual(row_payment.status, bulk_payment.status)
+            self.assertEqual(
+                Order.objects.get(pk=row_payment.order_id).status,
+                Order.objects.get(pk=bulk_payment.order_id).status,
+            )
+
+    @override_settings(PLANS_PAYMENTS_RETURN_ORDER_WHEN_PAYMENT_REFUNDED=True)
+    def test_refunded_returns_orders(self):
+        not_valid = self._payment("T1", order_status=Order.STATUS.NOT_VALID, status=PaymentStatus.CONFIRMED)
+        new = self._payment("T2", status=PaymentStatus.CONFIRMED)
+        with self.assertLogs(logger="plans_payments.bulk", level="WARNING"):
+            result = bulk_change_status(
+                [
+                    ("T1", PaymentStatus.REFUNDED, None),
+                    ("T2", PaymentStatus.REFUNDED, None),
+                ]
+            )
+        self.assertEqual(Order.objects.get(pk=not_valid.order_id).status, Order.STATUS.RETURNED)
+        self.assertEqual(Order.objects.get(pk=new.order_id).status, Order.STATUS.NEW)
+        self.assertEqual(result.unreturnable_orders, [new.order_id])
+
+    def test_fee_only(self):
+        payment = self._payment("T1", status=PaymentStatus.WAITING)
+        bulk_change_status([("T1", None, Decimal("0.42"))])
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+        self.assertEqual(payment.transaction_fee, Decimal("0.42"))
+
+    def test_by_pk(self):
+        payment = self._payment("")
+        bulk_change_status([(payment.pk, PaymentStatus.REJECTED, None)], key="pk")
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentStatus.REJECTED)
+
+    def test_identifiers_of_other_types(self):
+        by_pk = self._payment("")
+        numeric = self._payment("123")
+        result = bulk_change_status(
+            [(str(by_pk.pk), PaymentStatus.REJECTED, None), ("not-a-pk", PaymentStatus.REJECTED, None)], key="pk"
+        )
+        self.assertEqual((result.updated, result.missing), (1, ["not-a-pk"]))
+        # E.g. a numeric PayU orderId from a JSON line
+        bulk_change_status([(123, PaymentStatus.CONFIRMED, None)])
+        by_pk.refresh_from_db()
+        numeric.refresh_from_db()
+        self.assertEqual((by_pk.status, numeric.status), (PaymentStatus.REJECTED, PaymentStatus.CONFIRMED))
+
+    def test_missing(self):
+        self._payment("T1")
+        result = bulk_change_status([("T1", None, None), ("UNKNOWN", PaymentStatus.CONFIRMED, None)])
+        self.assertEqual(result.updated, 1)
+        self.assertEqual(result.missing, ["UNKNOWN"])
+
+    def test_query_count_does_not_grow_with_rows(self):
+        for i in range(20):
+            self._payment(f"T{i}")
+        # SAVEPOINT, SELECT payments, UPDATE payments, fee UPDATE, INSERT events, UPDATE orders, RELEASE
+        with self.assertNumQueries(7):
+            bulk_change_status((f"T{i}", PaymentStatus.REJECTED, Decimal("0.1")) for i in range(20))
+        self.assertEqual(Order.objects.filter(status=Order.STATUS.CANCELED).count(), 20)
@@ -0,0 +1,86 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from model_bakery import baker
+from payments import PaymentStatus
+
+from plans_payments import models
+from plans_payments.bulk import bulk_change_status
+from plans_payments.cdc import export_changes, get_watermark, iter_change_batches, prune_changes
+
+
+@override_settings(PLANS_PAYMENTS_CDC=True, PLANS_PAYMENTS_CDC_LAG=0)
+class CDCTests(TestCase):
+    def _payment(self, **kwargs):
+        kwargs.setdefault("total", Decimal("10.00"))
+        if "order__user" not in kwargs:
+            kwargs["order__user"] = baker.make("User")
+            baker.make("UserPlan", user=kwargs["order__user"])
+        return baker.make(models.Payment, variant="default", **kwargs)
+
+    def _export(self, consumer="default", batch_size=1000):
+        stream = StringIO()
+        written = export_changes(stream, consumer, batch_size, lag=timedelta(0))
+        return written, [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_changes_recorded(self):
+        payment = self._payment()
+        payment.change_status(PaymentStatus.INPUT)
+        other = self._payment()
+        bulk_change_status([(other.pk, PaymentStatus.REJECTED, "1.00")], key="pk")
+        self.assertEqual(
+            list(models.PaymentChange.objects.order_by("pk").values_list("payment_id", flat=True)),
+            [payment.pk, payment.pk, other.pk, other.pk],
+        )
+
+    @override_settings(PLANS_PAYMENTS_CDC=False)
+    def test_disabled(self):
+        self._payment()
+        self.assertFalse(models.PaymentChange.objects.exists())
+
+    def test_export(self):
+        first = self._payment()
+        second = self._payment()
+        first.change_status(PaymentStatus.CONFIRMED)
+        written, records = self._export()
+        self.assertEqual(written, 2)
+        # One record per payment, with its current state, in change order
+        self.assertEqual([record["id"] for record in records], [second.pk, first.pk])
+        self.assertEqual(records[1]["status"], PaymentStatus.CONFIRMED)
+        self.assertEqual(records[1]["total"], "10.00")
+        self.assertLess(records[0]["seq"], records[1]["seq"])
+        self.assertEqual(get_watermark("default"), records[1]["seq"])
+
+        # Only what changed since the watermark
+        self.assertEqual(self._export(), (0, []))
+        second_pk = second.pk
+        second.delete()
+        written, records = self._export()
+        self.assertEqual(records, [{"seq": records[0]["seq"], "id": second_pk, "deleted": True}])
+        # Consumers have their own watermark
+        self.assertEqual(self._export("warehouse")[0], 2)
+
+    def test_lag(self):
+        self._payment()
+        self.assertEqual(list(iter_change_batches(lag=timedelta(minutes=1))), [])
+        self.assertEqual(len(list(iter_change_batches(lag=timedelta(0)))), 1)
+
+    def test_prune(self):
+        self._payment()
+        self._payment()
+        self.assertEqual(prune_changes(), 0)
+        self._export()
+        self.assertEqual(prune_changes(), 1)
+        self.assertEqual(models.PaymentChange.objects.count(), 1)
+
+    def test_command(self):
+        payment = self._payment()
+        out = StringIO()
+        err = StringIO()
+        call_command("export_payment_changes", "--prune", stdout=out, stderr=err)
+        self.assertEqual([json.loads(line)["id"] for line in out.getvalue().splitlines()], [payment.pk])
+        self.assertEqual(err.getvalue(), "1 payment changes exported, 0 pruned\n")
@@ -0,0 +1,141 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from model_bakery import baker
+from payments import PaymentStatus
+from plans.models import Order, RecurringUserPlan
+
+from plans_payments.circuitbreaker import CircuitBreaker, get_circuit_breaker
+from plans_payments.models import renew_account
+from plans_payments.signals import renewal_deferred
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = Clock()
+        self.breaker = CircuitBreaker("paypal", error_rate=0.5, min_calls=4, slow_call_seconds=5, clock=self.clock)
+
+    def test_opens_on_error_rate(self):
+        for success in (True, False, True):
+            self.breaker.record(success)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+        # Other variants are not affected
+        self.assertEqual(CircuitBreaker("payu", clock=self.clock).state, CircuitBreaker.CLOSED)
+
+    def test_slow_calls_are_failures(self):
+        for _ in range(4):
+            self.breaker.record(True, duration=6)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_guard(self):
+        with self.assertRaises(ValueError):
+            with self.breaker.guard(ignore=(KeyError,)):
+                raise ValueError
+        with self.assertRaises(KeyError):
+            with self.breaker.guard(ignore=(KeyError,)):
+                raise KeyError
+        with self.breaker.guard(failed=lambda: True):
+            pass
+        calls_key, failures_key = self.breaker._window_keys()
+        self.assertEqual((cache.get(calls_key), cache.get(failures_key)), (3, 2))
+
+    def test_half_open_probe(self):
+        self.breaker.trip()
+        # The open state expires after open_seconds (cache timeout)
+        cache.delete(self.breaker._key("open"))
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        cache.delete(self.breaker._key("open"))
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_late_success_keeps_open(self):
+        self.breaker.trip()
+        # A call started before the breaker opened
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        cache.delete(self.breaker._key("open"))
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_get_circuit_breaker(self):
+        self.assertIsNone(get_circuit_breaker("default"))
+        with self.settings(
+            PLANS_PAYMENTS_CIRCUIT_BREAKER={"min_calls": 5},
+            PLANS_PAYMENTS_CIRCUIT_BREAKERS={"payu": {"min_calls": 50}},
+        ):
+            self.assertEqual(get_circuit_breaker("default").min_calls, 5)
+            self.assertEqual(get_circuit_breaker("default").error_rate, 0.5)
+            self.assertEqual(get_circuit_breaker("payu").min_calls, 50)
+
+
+@override_settings(PLANS_PAYMENTS_CIRCUIT_BREAKER={"min_calls": 1})
+class RenewalCircuitBreakerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = baker.make("User")
+        baker.make("BillingInfo", user=self.user)
+        userplan = baker.make("UserPlan", user=self.user, plan__name="Plan")
+        self.recurring = baker.make(
+            "RecurringUserPlan",
+            user_plan=userplan,
+            payment_provider="default",
+            renewal_triggered_by=RecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+            token_verified=True,
+            currency="EUR",
+            amount=10,
+            last_renewal_attempt=timezone.now(),
+        )
+
+    def test_open_breaker_defers_renewal(self):
+        get_circuit_breaker("default").trip()
+        deferred = mock.Mock()
+        renewal_deferred.connect(deferred)
+        self.addCleanup(renewal_deferred.disconnect, deferred)
+        with self.assertLogs("plans_payments.models", "WARNING"):
+            self.assertIsNone(renew_account(self.user))
+        self.assertFalse(Order.objects.exists())
+        self.recurring.refresh_from_db()
+        # Stays due for the next run
+        self.assertIsNone(self.recurring.last_renewal_attempt)
+        self.assertEqual(deferred.call_args.kwargs["variant"], "default")
+
+    @mock.patch("plans_payments.models.create_payment_object")
+    def test_gateway_failure_opens_breaker(self, create_payment_object):
+        create_payment_object.return_value.autocomplete_with_wallet.side_effect = TimeoutError
+        with self.assertRaises(TimeoutError):
+            renew_account(self.user)
+        self.assertEqual(get_circuit_breaker("default").state, CircuitBreaker.OPEN)
+
+    @mock.patch("plans_payments.models.create_payment_object")
+    def test_error_status_opens_breaker(self, create_payment_object):
+        payment = create_payment_object.return_value
+        payment.autocomplete_with_wallet.side_effect = lambda: setattr(payment, "status", PaymentStatus.ERROR)
+        renew_account(self.user)
+        self.assertEqual(get_circuit_breaker("default").state, CircuitBreaker.OPEN)
+
+    @mock.patch("plans_payments.models.create_payment_object")
+    def test_successful_charge(self, create_payment_object):
+        create_payment_object.return_value.status = PaymentStatus.WAITING
+        renew_account(self.user)
+        create_payment_object.return_value.autocomplete_with_wallet.assert_called_once()
+        self.assertEqual(get_circuit_breaker("default").state, CircuitBreaker.CLOSED)
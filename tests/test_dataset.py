@@ -0,0 +1,65 @@
+import json
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import F
+from django.test import TestCase
+from payments import PaymentStatus
+from plans.models import BillingInfo, Order, RecurringUserPlan, UserPlan
+
+from plans_payments.dataset import generate_chunk
+from plans_payments.models import Payment
+
+
+class GenerateDatasetTests(TestCase):
+    def _snapshot(self):
+        return list(Payment.objects.order_by("created").values_list("variant", "status", "total", "extra_data"))
+
+    def test_generate_chunk(self):
+        users, orders, payments = generate_chunk(0, 50, seed=1, variants={"paypal": 1, "payu": 1}, batch_size=20)
+        self.assertEqual(get_user_model().objects.count(), 50)
+        self.assertEqual((BillingInfo.objects.count(), UserPlan.objects.count()), (50, 50))
+        self.assertTrue(0 < RecurringUserPlan.objects.count() < 50)
+        self.assertEqual((Order.objects.count(), Payment.objects.count()), (orders, payments))
+        self.assertGreaterEqual(payments, orders)
+        self.assertEqual(set(Payment.objects.values_list("variant", flat=True)), {"paypal", "payu"})
+        self.assertIn(PaymentStatus.CONFIRMED, set(Payment.objects.values_list("status", flat=True)))
+        # Payments belong to the users of their orders, spread over time
+        self.assertFalse(Payment.objects.exclude(user=F("order__user")).exists())
+        self.assertGreater(Payment.objects.dates("created", "month").count(), 1)
+        self.assertGreater(Order.objects.dates("created", "month").count(), 1)
+        # Payments get the creation time of their order (plus a minute for a retried attempt)
+        self.assertFalse(Payment.objects.filter(created__lt=F("order__created")).exists())
+        self.assertFalse(Payment.objects.filter(created__gt=F("order__created") + timedelta(minutes=1)).exists())
+        self.assertFalse(Payment.objects.exclude(billing_email=F("user__email")).exists())
+        # The models keep stamping new rows
+        self.assertTrue(Payment._meta.get_field("created").auto_now_add)
+        self.assertTrue(Order._meta.get_field("created").auto_now_add)
+
+        # Fees are computed from the generated gateway responses
+        payment = Payment.objects.filter(variant="paypal", status=PaymentStatus.CONFIRMED).first()
+        sale = json.loads(payment.extra_data)["response"]["transactions"][0]["related_resources"][0]["sale"]
+        self.assertEqual(str(payment.transaction_fee), sale["transaction_fee"]["value"])
+
+    def test_deterministic(self):
+        snapshots = []
+        for _ in range(2):
+            with transaction.atomic():
+                generate_chunk(3, 10, seed=7)
+                snapshots.append(self._snapshot())
+                transaction.set_rollback(True)
+        self.assertEqual(snapshots[0], snapshots[1])
+        generate_chunk(4, 10, seed=7)
+        self.assertNotEqual(self._snapshot(), snapshots[0])
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            "generate_payment_dataset", "--users", "25", "--chunk-size", "10", "--variant", "default:3", stdout=out
+        )
+        self.assertEqual(get_user_model().objects.count(), 25)
+        self.assertRegex(out.getvalue(), r"^25 users, \d+ orders, \d+ payments generated in ")
+        self.assertEqual(set(Payment.objects.values_list("variant", flat=True)), {"default"})
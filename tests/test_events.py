@@ -0,0 +1,89 @@
+from decimal import Decimal
+
+from django.test import TestCase, override_settings
+from model_bakery import baker
+from payments import PaymentStatus
+
+from plans_payments import models
+from plans_payments.bulk import bulk_change_status
+from plans_payments.events import EventKind, payment_timeline
+from plans_payments.fees import recompute_fee_range
+
+
+class PaymentEventTests(TestCase):
+    def _payment(self, **kwargs):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        kwargs.setdefault("variant", "default")
+        return baker.make(models.Payment, order__user=user, **kwargs)
+
+    def _timeline(self, payment):
+        return [(event.kind, event.value) for event in payment_timeline(payment)]
+
+    def test_status_transitions(self):
+        payment = self._payment(status=PaymentStatus.WAITING)
+        payment.change_status(PaymentStatus.INPUT)
+        payment.save()  # unchanged, no event
+        payment = models.Payment.objects.get(pk=payment.pk)
+        payment.change_status(PaymentStatus.CONFIRMED)
+        self.assertEqual(
+            self._timeline(payment),
+            [
+                (EventKind.STATUS, PaymentStatus.WAITING),
+                (EventKind.STATUS, PaymentStatus.INPUT),
+                (EventKind.STATUS, PaymentStatus.CONFIRMED),
+            ],
+        )
+
+    def test_fee_change(self):
+        payment = self._payment()
+        payment = models.Payment.objects.get(pk=payment.pk)
+        payment.variant = "payu"
+        payment.total = Decimal("100")
+        payment.save()
+        self.assertEqual(self._timeline(payment)[-1], (EventKind.FEE, "2.95"))
+
+    def test_payu_resave(self):
+        payment = self._payment(variant="payu", total=Decimal("14.00"))
+        events = self._timeline(payment)
+        for _ in range(3):
+            payment.save()
+            payment = models.Payment.objects.get(pk=payment.pk)
+        self.assertEqual(self._timeline(payment), events)
+
+    def test_token_events(self):
+        payment = self._payment()
+        baker.make("RecurringUserPlan", user_plan=payment.order.user.userplan, token_verified=True)
+        payment.set_renew_token("token", renewal_triggered_by="task")
+        payment.invalidate_renew_token()
+        kinds = [kind for kind, _ in self._timeline(payment)]
+        self.assertEqual(kinds[-2:], [EventKind.TOKEN_SET, EventKind.TOKEN_INVALIDATED])
+
+    def test_bulk_change_status(self):
+        payments = [self._payment(transaction_id=f"T{i}", status=PaymentStatus.WAITING) for i in range(3)]
+        models.PaymentEvent.objects.all().delete()
+        bulk_change_status(
+            [
+                ("T0", PaymentStatus.CONFIRMED, Decimal("0.50")),
+                ("T1", PaymentStatus.WAITING, None),
+                ("T2", None, Decimal("0.70")),
+            ]
+        )
+        self.assertEqual(
+            self._timeline(payments[0]),
+            [(EventKind.STATUS, PaymentStatus.CONFIRMED), (EventKind.FEE, "0.50")],
+        )
+        self.assertEqual(self._timeline(payments[1]), [])
+        self.assertEqual(self._timeline(payments[2]), [(EventKind.FEE, "0.70")])
+
+    def test_recompute_fees(self):
+        payment = self._payment(variant="payu", total=Decimal("10.00"))
+        models.Payment.objects.filter(pk=payment.pk).update(transaction_fee=0)
+        recompute_fee_range(payment.pk, payment.pk + 1)
+        self.assertEqual(self._timeline(payment)[-1], (EventKind.FEE, "0.34"))
+
+    @override_settings(PLANS_PAYMENTS_EVENT_LOG=False)
+    def test_disabled(self):
+        payment = self._payment()
+        payment.change_status(PaymentStatus.REJECTED)
+        self.assertFalse(models.PaymentEvent.objects.exists())
@@ -0,0 +1,103 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from model_bakery import baker
+from payments import PaymentStatus
+
+from plans_payments import models
+from plans_payments.bulk import bulk_change_status
+from plans_payments.facets import get_facet_counts, refresh_facet_counts
+
+
+@override_settings(PLANS_PAYMENTS_FACET_COUNTS=True)
+class FacetCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def _counts(self):
+        return {
+            (field, value): count
+            for field, value, count in models.PaymentFacetCount.objects.filter(count__gt=0).values_list(
+                "field", "value", "count"
+            )
+        }
+
+    def _payment(self, **kwargs):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        kwargs.setdefault("currency", "EUR")
+        return baker.make(models.Payment, variant="default", order__user=user, **kwargs)
+
+    def test_incremental_matches_refresh(self):
+        payments = [self._payment(status=PaymentStatus.WAITING) for _ in range(3)]
+        self._payment(status=PaymentStatus.CONFIRMED, currency="USD", autorenewed_payment=True)
+        payments[0].change_status(PaymentStatus.REJECTED)
+        payment = models.Payment.objects.get(pk=payments[1].pk)
+        payment.currency = "CZK"
+        payment.save()
+        payments[2].delete()
+        incremental = self._counts()
+        self.assertEqual(incremental[("status", PaymentStatus.WAITING)], 1)
+        self.assertEqual(incremental[("currency", "CZK")], 1)
+        self.assertEqual(incremental[("autorenewed_payment", "True")], 1)
+        refresh_facet_counts()
+        self.assertEqual(self._counts(), incremental)
+
+    def test_partial_save(self):
+        payment = models.Payment.objects.get(pk=self._payment(status=PaymentStatus.WAITING).pk)
+        payment.status = PaymentStatus.CONFIRMED
+        payment.currency = "USD"
+        payment.save(update_fields=["currency"])
+        payment.save(update_fields=["currency"])
+        # The status was not written
+        incremental = self._counts()
+        self.assertEqual(incremental[("status", PaymentStatus.WAITING)], 1)
+        refresh_facet_counts()
+        self.assertEqual(self._counts(), incremental)
+        payment.save(update_fields=["status"])
+        incremental = self._counts()
+        self.assertEqual(incremental[("status", PaymentStatus.CONFIRMED)], 1)
+        refresh_facet_counts()
+        self.assertEqual(self._counts(), incremental)
+
+    def test_bulk_change_status(self):
+        self._payment(transaction_id="T1", status=PaymentStatus.WAITING)
+        self._payment(transaction_id="T2", status=PaymentStatus.WAITING)
+        bulk_change_status([("T1", PaymentStatus.CONFIRMED, None), ("T2", PaymentStatus.WAITING, None)])
+        counts = self._counts()
+        self.assertEqual(counts[("status", PaymentStatus.WAITING)], 1)
+        self.assertEqual(counts[("status", PaymentStatus.CONFIRMED)], 1)
+
+    def test_cached(self):
+        self._payment()
+        get_facet_counts()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_facet_counts()["variant"], {"default": 1})
+
+    def test_command(self):
+        self._payment()
+        models.PaymentFacetCount.objects.all().delete()
+        out = StringIO()
+        call_command("refresh_payment_facets", stdout=out)
+        self.assertIn("facet values counted", out.getvalue())
+        self.assertEqual(self._counts()[("variant", "default")], 1)
+
+    def test_admin_changelist(self):
+        self._payment(status=PaymentStatus.CONFIRMED)
+        self._payment(status=PaymentStatus.CONFIRMED, currency="USD")
+        self.client.force_login(get_user_model().objects.create_superuser("admin", "admin@example.com", "admin"))
+        url = reverse("admin:plans_payments_payment_changelist")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"_facets": "1"})
+        self.assertContains(response, "Confirmed (2)")
+        self.assertContains(response, "USD (1)")
+        self.assertFalse([query for query in queries if "DISTINCT" in query["sql"]])
+        response = self.client.get(url, {"currency": "USD"})
+        self.assertEqual(response.context["cl"].result_count, 1)
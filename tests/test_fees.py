@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from plans_payments import models
+from plans_payments.fees import compute_transaction_fee, recompute_fee_range
+
+
+def paypal_extra_data(fee):
+    return json.dumps(
+        {"response": {"transactions": [{"related_resources": [{"sale": {"transaction_fee": {"value": fee}}}]}]}}
+    )
+
+
+class ComputeTransactionFeeTests(TestCase):
+    def test_payu_estimate(self):
+        payment = models.Payment(variant="payu", total=Decimal("10.00"))
+        self.assertEqual(compute_transaction_fee(payment), (Decimal("0.34"), False))
+
+    def test_settled(self):
+        payment = models.Payment(
+            variant="payu", total=Decimal("10.00"), transaction_fee=1, transaction_fee_settled=True
+        )
+        self.assertEqual(compute_transaction_fee(payment), (1, False))
+
+    def test_paypal(self):
+        payment = models.Payment(variant="paypal", extra_data=paypal_extra_data("0.42"))
+        self.assertEqual(compute_transaction_fee(payment), (Decimal("0.42"), False))
+
+    def test_missing(self):
+        payment = models.Payment(variant="paypal", extra_data=json.dumps({"response": {}}))
+        self.assertEqual(compute_transaction_fee(payment), (Decimal("0.0"), True))
+
+
+class RecomputeTransactionFeesTests(TestCase):
+    def setUp(self):
+        self.payment = models.Payment.objects.create(variant="paypal")
+        models.Payment.objects.filter(pk=self.payment.pk).update(extra_data=paypal_extra_data("0.42"))
+        self.unchanged = models.Payment.objects.create(variant="paypal", extra_data=paypal_extra_data("0.10"))
+
+    def test_recompute_fee_range(self):
+        diffs = recompute_fee_range(self.payment.pk, self.unchanged.pk + 1)
+        self.assertEqual(diffs, [(self.payment.pk, Decimal("0.00"), Decimal("0.42"))])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.transaction_fee, Decimal("0.42"))
+
+    def test_recompute_payu_idempotent(self):
+        payu = models.Payment.objects.create(variant="payu", total=Decimal("14.00"))
+        self.assertEqual(payu.transaction_fee, Decimal("0.46"))
+        self.assertEqual(recompute_fee_range(payu.pk, payu.pk + 1), [])
+
+    def test_recompute_skips_malformed_extra_data(self):
+        malformed = models.Payment.objects.create(variant="paypal", total=Decimal("10.00"))
+        models.Payment.objects.filter(pk=malformed.pk).update(extra_data="{not json")
+        with self.assertLogs("plans_payments.fees", "ERROR") as logs:
+            diffs = recompute_fee_range(self.payment.pk, malformed.pk + 1)
+        self.assertIn(f"payment {malformed.pk}", logs.output[0])
+        # The rest of the range is processed
+        self.assertEqual(diffs, [(self.payment.pk, Decimal("0.00"), Decimal("0.42"))])
+
+    def test_command_dry_run(self):
+        out = StringIO()
+        call_command("recompute_transaction_fees", dry_run=True, stdout=out)
+        self.assertIn(f"Payment {self.payment.pk}: 0.00 -> 0.42", out.getvalue())
+        self.assertIn("1 fees would change", out.getvalue())
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.transaction_fee, Decimal("0.00"))
+
+    def test_command_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, "state.json")
+            # The range of the stale payment is already recorded as done
+            with open(state_file, "w") as f:
+                json.dump({"done": [self.payment.pk]}, f)
+            out = StringIO()
+            call_command("recompute_transaction_fees", chunk_size=1, state_file=state_file, stdout=out)
+            with open(state_file) as f:
+                done = json.load(f)["done"]
+        self.assertIn("1 ranges processed, 0 fees changed", out.getvalue())
+        self.assertEqual(done, [self.payment.pk, self.unchanged.pk])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.transaction_fee, Decimal("0.00"))
+
+    def test_command(self):
+        out = StringIO()
+        call_command("recompute_transaction_fees", stdout=out)
+        self.assertIn("1 ranges processed, 1 fees changed", out.getvalue())
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.transaction_fee, Decimal("0.42"))
@@ -0,0 +1,92 @@
+import json
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from plans_payments import gateway_fields, models
+
+PAYPAL_EXTRA_DATA = {
+    "response": {
+        "payer": {"payer_info": {"payer_id": "PAYER1"}},
+        "transactions": [
+            {
+                "related_resources": [
+                    {
+                        "sale": {
+                            "id": "SALE1",
+                            "transaction_fee": {"value": "0.34", "currency": "USD"},
+                        },
+                    },
+                ],
+            },
+        ],
+    },
+}
+
+
+class ExtractGatewayFieldsTests(TestCase):
+    def test_extract_paypal(self):
+        fields = gateway_fields.extract_gateway_fields("paypal", json.dumps(PAYPAL_EXTRA_DATA))
+        self.assertEqual(
+            fields,
+            {"sale_id": "SALE1", "payer_id": "PAYER1", "fee_currency": "USD"},
+        )
+
+    def test_extract_empty(self):
+        self.assertEqual(gateway_fields.extract_gateway_fields("paypal", ""), {})
+
+    def test_extract_invalid_json(self):
+        with self.assertLogs(logger="plans_payments.gateway_fields", level="WARNING"):
+            self.assertEqual(gateway_fields.extract_gateway_fields("paypal", "{"), {})
+
+    @override_settings(PLANS_PAYMENTS_GATEWAY_FIELDS={"order_id": ["orderId"]})
+    def test_extract_custom_setting(self):
+        fields = gateway_fields.extract_gateway_fields("payu", json.dumps({"orderId": "PAYU1"}))
+        self.assertEqual(fields, {"order_id": "PAYU1"})
+
+
+class SyncGatewayFieldsTests(TestCase):
+    def test_save_extracts_fields(self):
+        payment = models.Payment.objects.create(variant="paypal", extra_data=json.dumps(PAYPAL_EXTRA_DATA))
+        self.assertEqual(
+            dict(payment.gateway_fields.values_list("key", "value")),
+            {"sale_id": "SALE1", "payer_id": "PAYER1", "fee_currency": "USD"},
+        )
+        self.assertEqual(list(gateway_fields.find_payments("sale_id", "SALE1")), [payment])
+
+    def test_save_updates_changed_fields(self):
+        payment = models.Payment.objects.create(variant="paypal", extra_data=json.dumps(PAYPAL_EXTRA_DATA))
+        extra_data = json.loads(payment.extra_data)
+        extra_data["response"]["transactions"][0]["related_resources"].append({"refund": {"id": "REFUND1"}})
+        del extra_data["response"]["payer"]
+        payment.extra_data = json.dumps(extra_data)
+        payment.save()
+        self.assertEqual(
+            dict(payment.gateway_fields.values_list("key", "value")),
+            {"sale_id": "SALE1", "refund_id": "REFUND1", "fee_currency": "USD"},
+        )
+
+    def test_repeated_save_does_not_write(self):
+        payment = models.Payment.objects.create(variant="paypal", extra_data=json.dumps(PAYPAL_EXTRA_DATA))
+        # extra_data unchanged, only the UPDATE of the payment
+        with self.assertNumQueries(1):
+            payment.save()
+        payment = models.Payment.objects.get(pk=payment.pk)
+        with self.assertNumQueries(1):
+            payment.save()
+
+    def test_status_change_skips_sync(self):
+        payment = models.Payment.objects.create(variant="paypal", extra_data=json.dumps(PAYPAL_EXTRA_DATA))
+        with self.assertNumQueries(1):
+            payment.save(update_fields=["status"])
+
+
+class BackfillGatewayFieldsCommandTests(TestCase):
+    def test_backfill(self):
+        payment = models.Payment.objects.create(variant="paypal")
+        models.Payment.objects.filter(pk=payment.pk).update(extra_data=json.dumps(PAYPAL_EXTRA_DATA))
+        out = StringIO()
+        call_command("backfill_gateway_fields", batch_size=1, stdout=out)
+        self.assertIn(f"up to pk {payment.pk}", out.getvalue())
+        self.assertEqual(payment.gateway_fields.get(key="sale_id").value, "SALE1")
@@ -0,0 +1,82 @@
+"""
+Cold-start benchmark: ``django.setup()`` in a fresh interpreter.
+
+Each run reports the wall time of ``django.setup()`` and the import time
+spent in ``plans_payments`` modules themselves (``-X importtime`` self time).
+The best of ``RUNS`` is checked against ``PLANS_PAYMENTS_SETUP_BUDGET``
+(seconds) and ``PLANS_PAYMENTS_IMPORT_BUDGET`` (milliseconds); set
+``PLANS_PAYMENTS_IMPORT_BENCHMARK`` to a file path to append the results as
+JSON lines and track them over time.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+RUNS = 3
+
+SETUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+print(json.dumps({
+    "setup_seconds": time.perf_counter() - start,
+    "modules": sorted(name for name in sys.modules if name.startswith("plans_payments")),
+}))
+"""
+
+
+def measure_setup():
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE="tests.settings")
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SETUP_SCRIPT],
+        cwd=Path(__file__).resolve().parent.parent,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(process.stdout)
+    own_microseconds = 0
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        self_time, _, name = line.removeprefix("import time:").split("|")
+        if name.strip().startswith("plans_payments"):
+            own_microseconds += int(self_time)
+    result["plans_payments_import_ms"] = own_microseconds / 1000
+    return result
+
+
+class ImportTimeTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.runs = [measure_setup() for _ in range(RUNS)]
+        path = os.environ.get("PLANS_PAYMENTS_IMPORT_BENCHMARK")
+        if path:
+            with open(path, "a") as benchmark_file:
+                for run in cls.runs:
+                    record = {key: value for key, value in run.items() if key != "modules"}
+                    benchmark_file.write(json.dumps(dict(record, time=time.time())) + "\n")
+
+    def test_views_not_imported_on_setup(self):
+        modules = self.runs[0]["modules"]
+        self.assertIn("plans_payments.models", modules)
+        self.assertNotIn("plans_payments.views", modules)
+        self.assertNotIn("plans_payments.async_views", modules)
+
+    def test_setup_time(self):
+        budget = float(os.environ.get("PLANS_PAYMENTS_SETUP_BUDGET", 5))
+        self.assertLess(min(run["setup_seconds"] for run in self.runs), budget)
+
+    def test_own_import_time(self):
+        budget = float(os.environ.get("PLANS_PAYMENTS_IMPORT_BUDGET", 50))
+        self.assertLess(min(run["plans_payments_import_ms"] for run in self.runs), budget)
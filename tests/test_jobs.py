@@ -0,0 +1,157 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from model_bakery import baker
+from payments import PaymentStatus
+from plans.models import Order
+
+from plans_payments import models
+from plans_payments.jobs import create_job, process_job, process_pending_jobs
+from plans_payments.utils import Heartbeat
+
+
+class AdminJobTests(TestCase):
+    def _payu_payment(self, **kwargs):
+        return baker.make(models.Payment, variant="payu", total=Decimal("100.00"), **kwargs)
+
+    def test_recompute_fee(self):
+        payment = self._payu_payment()
+        models.Payment.objects.filter(pk=payment.pk).update(transaction_fee=Decimal("0"))
+        job = create_job("recompute_fee", [payment.pk])
+        self.assertEqual(job.total, 1)
+        self.assertEqual(process_pending_jobs(workers=1), [job])
+        job.refresh_from_db()
+        payment.refresh_from_db()
+        self.assertEqual(job.status, models.AdminJob.Status.DONE)
+        self.assertEqual((job.processed, job.failed), (1, 0))
+        self.assertEqual(payment.transaction_fee, Decimal("2.95"))
+        item = job.items.get()
+        self.assertEqual(item.status, models.AdminJobItem.Status.DONE)
+        self.assertEqual(item.message, "fee 0.00 -> 2.95")
+
+    def test_failed_items(self):
+        payments = [baker.make(models.Payment, variant="default", status=PaymentStatus.WAITING) for _ in range(3)]
+        job = create_job("refund", [payment.pk for payment in payments])
+        with self.assertLogs("plans_payments.jobs", level="WARNING"):
+            process_job(job, workers=1, batch_size=2)
+        job.refresh_from_db()
+        self.assertEqual((job.processed, job.failed), (3, 3))
+        self.assertEqual(
+            set(job.items.values_list("message", flat=True)),
+            {"Payment with status waiting cannot be refunded"},
+        )
+
+    def test_sync_status(self):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        payment = baker.make(models.Payment, variant="default", status=PaymentStatus.WAITING, order__user=user)
+        job = create_job("sync_status", [payment.pk])
+        provider = mock.Mock()
+        provider.fetch_status.return_value = PaymentStatus.REJECTED
+        with mock.patch("plans_payments.jobs.provider_factory", return_value=provider):
+            process_job(job, workers=1)
+        payment.refresh_from_db()
+        payment.order.refresh_from_db()
+        self.assertEqual(payment.status, PaymentStatus.REJECTED)
+        self.assertEqual(payment.order.status, Order.STATUS.CANCELED)
+        self.assertEqual(job.items.get().message, "status waiting -> rejected")
+
+    def test_sync_status_unsupported_provider(self):
+        payment = baker.make(models.Payment, variant="default")
+        job = create_job("sync_status", [payment.pk])
+        with self.assertLogs("plans_payments.jobs", level="WARNING"):
+            process_job(job, workers=1)
+        item = job.items.get()
+        self.assertEqual(item.status, models.AdminJobItem.Status.FAILED)
+        self.assertIn("cannot fetch the payment status", item.message)
+
+    def test_job_is_processed_once(self):
+        job = create_job("recompute_fee", [self._payu_payment().pk])
+        self.assertTrue(process_job(job, workers=1))
+        self.assertFalse(process_job(job, workers=1))
+        self.assertEqual(process_pending_jobs(workers=1), [])
+
+    def test_takes_over_job_of_dead_worker(self):
+        payments = [self._payu_payment() for _ in range(2)]
+        job = create_job("recompute_fee", [payment.pk for payment in payments])
+        job.items.filter(payment=payments[0]).update(status=models.AdminJobItem.Status.DONE)
+        models.AdminJob.objects.filter(pk=job.pk).update(
+            status=models.AdminJob.Status.RUNNING,
+            worker="dead",
+            lease_until=timezone.now() + timedelta(minutes=1),
+        )
+        self.assertEqual(process_pending_jobs(workers=1), [])
+        models.AdminJob.objects.filter(pk=job.pk).update(lease_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(process_pending_jobs(workers=1), [job])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), (models.AdminJob.Status.DONE, 1))
+        self.assertNotEqual(job.worker, "dead")
+
+    def test_lost_lease(self):
+        job = create_job("recompute_fee", [self._payu_payment().pk])
+
+        def recompute_fee(payment):
+            # Taken over by another worker meanwhile
+            models.AdminJob.objects.filter(pk=job.pk).update(worker="other")
+
+        with mock.patch.dict("plans_payments.jobs.JOB_ACTIONS", {"recompute_fee": ("", recompute_fee)}):
+            with self.assertLogs("plans_payments.jobs", level="WARNING"):
+                self.assertFalse(process_job(job, workers=1, batch_size=1))
+        self.assertEqual(models.AdminJob.objects.get(pk=job.pk).status, models.AdminJob.Status.RUNNING)
+
+    def test_unknown_action(self):
+        with self.assertRaises(ValueError):
+            create_job("delete_everything", [1])
+
+    def test_command(self):
+        job = create_job("recompute_fee", [self._payu_payment().pk for _ in range(2)])
+        out = StringIO()
+        call_command("process_admin_jobs", "--workers", "1", stdout=out)
+        self.assertIn(f"Job {job}: 2 payments processed, 0 failed", out.getvalue())
+
+
+class HeartbeatTests(SimpleTestCase):
+    def test_beats_while_running(self):
+        beat = mock.Mock()
+        with Heartbeat(beat, 0.01):
+            time.sleep(0.1)
+        calls = beat.call_count
+        self.assertGreater(calls, 1)
+        time.sleep(0.05)
+        self.assertEqual(beat.call_count, calls)
+
+
+class AdminJobAdminTests(TestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(self.admin)
+
+    def test_queue_action(self):
+        payments = [baker.make(models.Payment, variant="default") for _ in range(3)]
+        response = self.client.post(
+            reverse("admin:plans_payments_payment_changelist"),
+            {"action": "job_recompute_fee", "_selected_action": [payment.pk for payment in payments[:2]]},
+        )
+        job = models.AdminJob.objects.get()
+        self.assertRedirects(response, reverse("admin:plans_payments_payment_changelist"))
+        self.assertEqual(job.action, "recompute_fee")
+        self.assertEqual(job.created_by, self.admin)
+        self.assertEqual(set(job.items.values_list("payment_id", flat=True)), {payments[0].pk, payments[1].pk})
+
+    def test_progress_and_results(self):
+        job = create_job("recompute_fee", [baker.make(models.Payment, variant="default").pk])
+        process_job(job, workers=1)
+        response = self.client.get(reverse("admin:plans_payments_adminjob_changelist"))
+        self.assertContains(response, "1/1 (100 %)")
+        response = self.client.get(reverse("admin:plans_payments_adminjob_change", args=[job.pk]))
+        self.assertContains(response, f"?job__id__exact={job.pk}")
+        response = self.client.get(reverse("admin:plans_payments_adminjobitem_changelist"), {"job__id__exact": job.pk})
+        self.assertContains(response, "fee 0.00 unchanged")
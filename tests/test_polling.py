@@ -0,0 +1,104 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from model_bakery import baker
+from payments import PaymentStatus
+from payments.core import PROVIDER_CACHE
+from plans.models import Order
+
+from plans_payments import models
+from plans_payments.polling import poll_waiting_payments
+from plans_payments.ratelimit import TokenBucket
+
+PAYMENT_VARIANTS = {
+    "default": ("payments.dummy.DummyProvider", {}),
+    "fake": (
+        "plans_payments.fake.FakeProvider",
+        {"status": PaymentStatus.WAITING, "statuses": {"PAID": PaymentStatus.CONFIRMED, "GONE": "rejected"}},
+    ),
+    "flaky": ("plans_payments.fake.FakeProvider", {"failure_rate": 1}),
+}
+
+
+@override_settings(PAYMENT_VARIANTS=PAYMENT_VARIANTS, PLANS_PAYMENTS_POLL_RATE=1000)
+class PollWaitingPaymentsTests(TestCase):
+    def setUp(self):
+        PROVIDER_CACHE.clear()
+        self.addCleanup(PROVIDER_CACHE.clear)
+
+    def _payment(self, transaction_id, variant="fake", age=timedelta(hours=1), status=PaymentStatus.WAITING):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        payment = baker.make(
+            models.Payment,
+            variant=variant,
+            status=status,
+            transaction_id=transaction_id,
+            total=Decimal("10.00"),
+            order__user=user,
+        )
+        models.Payment.objects.filter(pk=payment.pk).update(modified=timezone.now() - age)
+        return payment
+
+    def test_poll(self):
+        paid = self._payment("PAID")
+        gone = self._payment("GONE")
+        still_waiting = self._payment("WAIT")
+        recent = self._payment("PAID", age=timedelta(minutes=1))
+        ancient = self._payment("PAID", age=timedelta(days=60))
+        confirmed = self._payment("PAID", status=PaymentStatus.CONFIRMED)
+        result = poll_waiting_payments(older_than=timedelta(minutes=30), workers=2, batch_size=2)
+        self.assertEqual((result.polled, result.changed, result.failed, result.skipped), (3, 2, 0, 0))
+        statuses = dict(models.Payment.objects.values_list("pk", "status"))
+        self.assertEqual(statuses[paid.pk], PaymentStatus.CONFIRMED)
+        self.assertEqual(statuses[gone.pk], PaymentStatus.REJECTED)
+        self.assertEqual(statuses[still_waiting.pk], PaymentStatus.WAITING)
+        self.assertEqual(statuses[recent.pk], PaymentStatus.WAITING)
+        self.assertEqual(statuses[ancient.pk], PaymentStatus.WAITING)
+        self.assertEqual(statuses[confirmed.pk], PaymentStatus.CONFIRMED)
+        self.assertEqual(Order.objects.get(pk=paid.order_id).status, Order.STATUS.COMPLETED)
+        self.assertEqual(Order.objects.get(pk=gone.order_id).status, Order.STATUS.CANCELED)
+
+    def test_skips_providers_without_polling_and_counts_failures(self):
+        self._payment("T1", variant="default")
+        self._payment("T2", variant="flaky")
+        with self.assertLogs("plans_payments.polling", level="WARNING"):
+            result = poll_waiting_payments(workers=1)
+        self.assertEqual((result.polled, result.changed, result.failed, result.skipped), (1, 0, 1, 1))
+
+    def test_closes_thread_connections(self):
+        self._payment("PAID")
+        self._payment("T2", variant="flaky")
+        with mock.patch("plans_payments.polling.connection") as connection, self.assertLogs("plans_payments.polling"):
+            poll_waiting_payments(workers=2)
+        self.assertEqual(connection.close.call_count, 2)
+
+    def test_command(self):
+        self._payment("PAID")
+        out = StringIO()
+        call_command("poll_waiting_payments", "--workers", "1", stdout=out)
+        self.assertIn("1 payments polled, 1 changed, 0 failed", out.getvalue())
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_rate(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(2, clock=lambda: now[0], sleep=sleep)
+        for _ in range(6):
+            bucket.acquire()
+        # a burst of 2, then 2 per second
+        self.assertAlmostEqual(now[0], 2.0)
+        self.assertFalse(bucket.try_acquire())
+        now[0] += 0.5
+        self.assertTrue(bucket.try_acquire())
@@ -0,0 +1,295 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from model_bakery import baker
+from payments import PaymentError
+from plans.models import RecurringUserPlan
+
+from plans_payments.circuitbreaker import get_circuit_breaker
+from plans_payments.deadlines import BudgetUsage, Deadline, call_timeout, get_call_timeout
+from plans_payments.fake import FakeProvider
+from plans_payments.models import RenewalRun, RenewalRunEntry, defer_renewal
+from plans_payments.renewal import DueRenewal, checkpoint_run, claim_renewal, iter_due_renewals, run_renewals
+
+
+@override_settings(PLANS_AUTORENEW_SCHEDULE=[timedelta(days=3)])
+class RunRenewalsTests(TestCase):
+    def _recurring(self, expire_in=timedelta(days=1), provider="default", **kwargs):
+        kwargs.setdefault("renewal_triggered_by", RecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK)
+        kwargs.setdefault("token_verified", True)
+        user = baker.make("User")
+        userplan = baker.make("UserPlan", user=user, expire=timezone.localdate() + expire_in)
+        return baker.make(
+            "RecurringUserPlan",
+            user_plan=userplan,
+            payment_provider=provider,
+            currency="EUR",
+            **kwargs,
+        )
+
+    def test_iter_due_renewals(self):
+        due = self._recurring()
+        self._recurring(expire_in=timedelta(days=10))
+        self._recurring(token_verified=False)
+        self._recurring(renewal_triggered_by=RecurringUserPlan.RENEWAL_TRIGGERED_BY.USER)
+        self._recurring(last_renewal_attempt=timezone.now())
+        other = self._recurring(provider="other")
+        rows = list(iter_due_renewals(chunk_size=1))
+        self.assertEqual([row.recurring_id for row in rows], [due.pk, other.pk])
+        self.assertIsInstance(rows[0], DueRenewal)
+        self.assertEqual(rows[0].user_id, due.user_plan.user_id)
+        self.assertEqual(rows[0].expire, due.user_plan.expire)
+        self.assertEqual([row.recurring_id for row in iter_due_renewals(providers=["other"])], [other.pk])
+
+    def test_claim_renewal(self):
+        recurring = self._recurring()
+        (due,) = iter_due_renewals()
+        self.assertTrue(claim_renewal(due))
+        self.assertFalse(claim_renewal(due))
+        recurring.refresh_from_db()
+        self.assertIsNotNone(recurring.last_renewal_attempt)
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_run_renewals(self, renew_account):
+        first = self._recurring()
+        second = self._recurring()
+        with mock.patch("tracemalloc.start") as start:
+            result = run_renewals(chunk_size=1)
+        start.assert_not_called()
+        self.assertEqual((result.due, result.renewed, result.skipped, result.failed), (2, 2, 0, 0))
+        self.assertGreater(result.peak_memory, 0)
+        users = [call.args[0] for call in renew_account.call_args_list]
+        self.assertEqual([user.pk for user in users], [first.user_plan.user_id, second.user_plan.user_id])
+        # Full instances are built when charging, with the claimed attempt
+        self.assertIsNotNone(users[0].userplan.recurring.last_renewal_attempt)
+        # Claimed accounts are not due again
+        self.assertEqual(run_renewals().due, 0)
+
+    @mock.patch("plans_payments.models.renew_account", side_effect=[ValueError("declined"), None])
+    def test_run_renewals_failure(self, renew_account):
+        self._recurring()
+        self._recurring()
+        with self.assertLogs("plans_payments.renewal", "ERROR"):
+            result = run_renewals()
+        self.assertEqual((result.due, result.renewed, result.failed), (2, 1, 1))
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_run_renewals_skips_claimed(self, renew_account):
+        self._recurring()
+        with mock.patch("plans_payments.renewal.claim_renewal", return_value=False):
+            result = run_renewals()
+        self.assertEqual((result.due, result.renewed, result.skipped), (1, 0, 1))
+        renew_account.assert_not_called()
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_command(self, renew_account):
+        self._recurring()
+        self._recurring()
+        out = StringIO()
+        call_command("run_renewals", "--dry-run", stdout=out)
+        self.assertIn("2 due, 0 renewed, 0 skipped, 0 failed, 0 deferred, peak memory", out.getvalue())
+        renew_account.assert_not_called()
+        out = StringIO()
+        call_command("run_renewals", "--limit", "1", "--trace-memory", stdout=out)
+        self.assertIn("1 due, 1 renewed, 0 skipped, 0 failed, 0 deferred, peak memory", out.getvalue())
+
+    @override_settings(PLANS_PAYMENTS_RENEWAL_CALL_TIMEOUT=30, PLANS_PAYMENTS_RENEWAL_CALL_TIMEOUTS={"slow": 120})
+    def test_deadline(self):
+        now = timezone.now()
+        clock = mock.Mock(return_value=now)
+        timeouts = []
+
+        def renew_account(user):
+            timeouts.append(get_call_timeout())
+            clock.return_value += timedelta(seconds=20)
+
+        later = self._recurring(expire_in=timedelta(days=2))
+        latest = self._recurring(expire_in=timedelta(days=3))
+        after_latest = self._recurring(expire_in=timedelta(days=3))
+        urgent = self._recurring(expire_in=timedelta(days=0))
+        slow = self._recurring(provider="slow")
+        with mock.patch("plans_payments.models.renew_account", side_effect=renew_account) as renew:
+            result = run_renewals(deadline=Deadline(now + timedelta(seconds=60), clock=clock))
+        # Most urgent first; the slow variant's budget does not fit after the first charge, the 30 s budget
+        # still fits once more, then no budget fits and the run stops
+        self.assertEqual(
+            [call.args[0].pk for call in renew.call_args_list],
+            [urgent.user_plan.user_id, later.user_plan.user_id],
+        )
+        self.assertEqual((result.due, result.renewed, result.deferred), (4, 2, 2))
+        self.assertEqual(timeouts, [30, 30])
+        self.assertEqual((result.budgets["default"].calls, result.budgets["default"].deferred), (2, 1))
+        self.assertEqual(result.budgets["slow"].deferred, 1)
+        # Deferred accounts were not claimed and stay due
+        self.assertEqual({due.recurring_id for due in iter_due_renewals()}, {latest.pk, after_latest.pk, slow.pk})
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_command_deadline(self, renew_account):
+        self._recurring()
+        out = StringIO()
+        call_command("run_renewals", "--deadline", (timezone.now() + timedelta(seconds=5)).isoformat(), stdout=out)
+        self.assertIn("1 due, 0 renewed, 0 skipped, 0 failed, 1 deferred", out.getvalue())
+        self.assertIn("default: 0 charges, 0.0 s of 0.0 s budget, slowest 0.0 s, 1 deferred", out.getvalue())
+
+
+@override_settings(PLANS_AUTORENEW_SCHEDULE=[timedelta(days=3)])
+class RenewalRunTests(TestCase):
+    def setUp(self):
+        self.recurrings = []
+        for days in range(4):
+            userplan = baker.make("UserPlan", expire=timezone.localdate() + timedelta(days=days))
+            self.recurrings.append(
+                baker.make(
+                    "RecurringUserPlan",
+                    user_plan=userplan,
+                    payment_provider="default",
+                    renewal_triggered_by=RecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+                    token_verified=True,
+                    currency="EUR",
+                )
+            )
+        self.user_ids = [recurring.user_plan.user_id for recurring in self.recurrings]
+
+    def _outcomes(self, run):
+        return dict(run.entries.values_list("user_id", "outcome"))
+
+    @mock.patch("plans_payments.models.renew_account", side_effect=[None, ValueError("declined"), None, None])
+    def test_records_outcomes(self, renew_account):
+        run = RenewalRun.objects.create()
+        with self.assertLogs("plans_payments.renewal", "ERROR"):
+            run_renewals(run=run, checkpoint_every=2)
+        run.refresh_from_db()
+        self.assertEqual(run.status, RenewalRun.Status.FINISHED)
+        self.assertEqual((run.renewed, run.failed, run.skipped, run.deferred), (3, 1, 0, 0))
+        self.assertEqual(self._outcomes(run)[self.user_ids[1]], RenewalRunEntry.Outcome.FAILED)
+        self.assertEqual(run.entries.get(outcome=RenewalRunEntry.Outcome.FAILED).message, "declined")
+        self.assertEqual(
+            (run.last_expire, run.last_recurring_id), (self.recurrings[3].user_plan.expire, self.recurrings[3].pk)
+        )
+
+    @override_settings(PLANS_PAYMENTS_CIRCUIT_BREAKER={"min_calls": 1})
+    @mock.patch("plans_payments.models.renew_account")
+    def test_open_breaker_defers(self, renew_account):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        get_circuit_breaker("default").trip()
+        run = RenewalRun.objects.create()
+        result = run_renewals(run=run)
+        run.refresh_from_db()
+        self.assertEqual((result.renewed, result.deferred), (0, 4))
+        self.assertEqual((run.renewed, run.deferred), (0, 4))
+        self.assertEqual(set(self._outcomes(run).values()), {RenewalRunEntry.Outcome.DEFERRED})
+        renew_account.assert_not_called()
+        # Not claimed, due for the next run
+        self.assertFalse(RecurringUserPlan.objects.filter(last_renewal_attempt__isnull=False).exists())
+
+        # Deferred while charging, e.g. another worker took the half-open probe
+        get_circuit_breaker("default").reset()
+        renew_account.side_effect = lambda user: defer_renewal(user, "circuit breaker open")
+        with self.assertLogs("plans_payments.models", "WARNING"):
+            result = run_renewals()
+        self.assertEqual((result.renewed, result.deferred), (0, 4))
+        self.assertFalse(RecurringUserPlan.objects.filter(last_renewal_attempt__isnull=False).exists())
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_checkpoints_in_batches(self, renew_account):
+        run = RenewalRun.objects.create()
+        batches = []
+
+        def checkpoint(run, entries, position):
+            batches.append(len(entries))
+            checkpoint_run(run, entries, position)
+
+        with mock.patch("plans_payments.renewal.checkpoint_run", side_effect=checkpoint):
+            run_renewals(run=run, checkpoint_every=3)
+        # One batch of 3 entries and the rest at the end
+        self.assertEqual(batches, [3, 1])
+
+    def _crash_on_second_charge(self, charged_before_crash):
+        calls = []
+
+        def renew_account(user):
+            calls.append(user.pk)
+            if len(calls) == 2:
+                if charged_before_crash:
+                    baker.make("Payment", order__user=user, autorenewed_payment=True)
+                raise KeyboardInterrupt
+
+        run = RenewalRun.objects.create()
+        with mock.patch("plans_payments.models.renew_account", side_effect=renew_account):
+            with self.assertRaises(KeyboardInterrupt):
+                run_renewals(run=run)
+            run.refresh_from_db()
+            self.assertEqual(run.status, RenewalRun.Status.RUNNING)
+            self.assertEqual(
+                self._outcomes(run),
+                {self.user_ids[0]: RenewalRunEntry.Outcome.RENEWED, self.user_ids[1]: RenewalRunEntry.Outcome.CLAIMED},
+            )
+            result = run_renewals(run=run)
+        run.refresh_from_db()
+        self.assertEqual(run.status, RenewalRun.Status.FINISHED)
+        self.assertEqual(set(self._outcomes(run).values()), {RenewalRunEntry.Outcome.RENEWED})
+        self.assertEqual(len(self._outcomes(run)), 4)
+        return calls, result
+
+    def test_resume_charged_before_crash(self):
+        calls, result = self._crash_on_second_charge(charged_before_crash=True)
+        # Not charged again
+        self.assertEqual(calls, self.user_ids)
+        self.assertEqual((result.recovered, result.renewed), (1, 2))
+
+    def test_resume_crashed_before_charge(self):
+        calls, result = self._crash_on_second_charge(charged_before_crash=False)
+        self.assertEqual(calls, [self.user_ids[0], self.user_ids[1], self.user_ids[1], *self.user_ids[2:]])
+        self.assertEqual((result.recovered, result.renewed), (0, 3))
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_resume_keeps_foreign_claims(self, renew_account):
+        run = RenewalRun.objects.create()
+        run_renewals(run=run, limit=1)
+        # Claimed past the checkpoint by schedule_renewals, its slot not processed yet
+        scheduled = self.recurrings[2]
+        claim_renewal(next(due for due in iter_due_renewals() if due.recurring_id == scheduled.pk))
+        attempt = RecurringUserPlan.objects.get(pk=scheduled.pk).last_renewal_attempt
+        result = run_renewals(run=run)
+        self.assertEqual((result.recovered, result.renewed), (0, 2))
+        self.assertEqual(RecurringUserPlan.objects.get(pk=scheduled.pk).last_renewal_attempt, attempt)
+        self.assertNotIn(scheduled.user_plan.user_id, self._outcomes(run))
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_command_resume(self, renew_account):
+        out = StringIO()
+        call_command("run_renewals", "--limit", "1", stdout=out)
+        run = RenewalRun.objects.get()
+        self.assertIn(f"{run}: running, 0 recovered, 1 renewed", out.getvalue())
+        out = StringIO()
+        call_command("run_renewals", "--resume", stdout=out)
+        self.assertIn("3 due, 3 renewed", out.getvalue())
+        self.assertIn(f"{run}: finished, 0 recovered, 4 renewed", out.getvalue())
+        with self.assertRaisesMessage(CommandError, "No unfinished renewal run to resume"):
+            call_command("run_renewals", "--resume", str(run.pk))
+
+
+class DeadlineTests(SimpleTestCase):
+    def test_call_timeout(self):
+        self.assertEqual(get_call_timeout(default=30), 30)
+        with call_timeout(5):
+            self.assertEqual(get_call_timeout(default=30), 5)
+        self.assertIsNone(get_call_timeout())
+
+    def test_fake_provider_times_out(self):
+        provider = FakeProvider(latency=0.05)
+        with call_timeout(0.01):
+            with self.assertRaises(PaymentError):
+                provider.fetch_status(mock.Mock(transaction_id=""))
+
+    def test_budget_usage(self):
+        usage = BudgetUsage()
+        usage.add(30, 3)
+        usage.add(30, 12)
+        self.assertEqual(str(usage), "2 charges, 15.0 s of 60.0 s budget (25%), slowest 12.0 s, 0 deferred")
@@ -0,0 +1,217 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from model_bakery import baker
+from payments import PaymentStatus
+from plans.models import RecurringUserPlan
+
+from plans_payments import models
+from plans_payments.retries import process_due_retries, schedule_retry
+
+RenewalRetry = models.RenewalRetry
+
+
+@override_settings(PLANS_PAYMENTS_RENEWAL_RETRIES=True)
+class RenewalRetryTests(TestCase):
+    def setUp(self):
+        self.user = baker.make("User")
+        baker.make("BillingInfo", user=self.user)
+        userplan = baker.make("UserPlan", user=self.user)
+        self.recurring = baker.make(
+            "RecurringUserPlan",
+            user_plan=userplan,
+            payment_provider="default",
+            renewal_triggered_by=RecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+            token_verified=True,
+            currency="EUR",
+        )
+
+    def _payment(self, decline_code=None, **kwargs):
+        kwargs.setdefault("autorenewed_payment", True)
+        return baker.make(
+            models.Payment,
+            variant="default",
+            total=Decimal("10.00"),
+            order__user=self.user,
+            extra_data=json.dumps({"decline_code": decline_code} if decline_code else {}),
+            **kwargs,
+        )
+
+    def test_failed_renewal_schedules_retry(self):
+        before = timezone.now()
+        payment = self._payment("INSUFFICIENT_FUNDS")
+        payment.change_status(PaymentStatus.REJECTED)
+        retry = RenewalRetry.objects.get()
+        self.assertEqual(
+            (retry.status, retry.attempts, retry.decline_code, retry.payment, retry.variant),
+            (RenewalRetry.Status.PENDING, 1, "INSUFFICIENT_FUNDS", payment, "default"),
+        )
+        self.assertGreaterEqual(retry.next_attempt, before + timedelta(hours=1))
+
+    def test_not_scheduled(self):
+        self._payment(autorenewed_payment=False).change_status(PaymentStatus.REJECTED)
+        self._payment().change_status(PaymentStatus.CONFIRMED)
+        with self.settings(PLANS_PAYMENTS_RENEWAL_RETRIES=False):
+            self._payment().change_status(PaymentStatus.ERROR)
+        self.assertFalse(RenewalRetry.objects.exists())
+
+    def test_backoff_and_max_attempts(self):
+        now = timezone.now()
+        delays = []
+        for _ in range(3):
+            retry = schedule_retry(self._payment(), now=now)
+            delays.append(retry.next_attempt - now)
+        self.assertEqual(delays, [timedelta(hours=1), timedelta(hours=2), timedelta(hours=4)])
+        retry = schedule_retry(self._payment(), now=now)
+        self.assertEqual((retry.status, retry.attempts, retry.next_attempt), (RenewalRetry.Status.EXHAUSTED, 4, None))
+        # The next failure starts a new retry
+        self.assertNotEqual(schedule_retry(self._payment()).pk, retry.pk)
+
+    def test_duplicate_callback(self):
+        payment = self._payment()
+        payment.change_status(PaymentStatus.ERROR)
+        payment.change_status(PaymentStatus.REJECTED)
+        retry = schedule_retry(payment)
+        self.assertEqual((RenewalRetry.objects.count(), retry.attempts), (1, 1))
+        # Also once the retry is finished
+        RenewalRetry.objects.update(status=RenewalRetry.Status.EXHAUSTED)
+        schedule_retry(payment)
+        self.assertEqual(RenewalRetry.objects.count(), 1)
+
+    @override_settings(PLANS_PAYMENTS_RETRY_RULES={"DO_NOT_HONOR": "stop", "INSUFFICIENT_FUNDS": {"delay": 86400}})
+    def test_rules(self):
+        now = timezone.now()
+        retry = schedule_retry(self._payment("INSUFFICIENT_FUNDS"), now=now)
+        self.assertEqual(retry.next_attempt, now + timedelta(days=1))
+        retry = schedule_retry(self._payment("DO_NOT_HONOR"), now=now)
+        self.assertEqual(retry.status, RenewalRetry.Status.EXHAUSTED)
+
+    def test_dead_token(self):
+        self._payment("INVALID_TOKEN").change_status(PaymentStatus.REJECTED)
+        self.assertEqual(RenewalRetry.objects.get().status, RenewalRetry.Status.DEAD)
+        self.recurring.refresh_from_db()
+        self.assertFalse(self.recurring.token_verified)
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_process_due_retries(self, renew_account):
+        retry = schedule_retry(self._payment())
+        self.assertEqual(process_due_retries(), 0)
+        renew_account.assert_not_called()
+
+        # Charge failed again: the status change reschedules it
+        renew_account.side_effect = lambda user: schedule_retry(self._payment(status=PaymentStatus.REJECTED))
+        self.assertEqual(process_due_retries(now=retry.next_attempt, batch_size=1), 1)
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.attempts), (RenewalRetry.Status.PENDING, 2))
+
+        # Charged
+        renew_account.side_effect = lambda user: self._payment(status=PaymentStatus.CONFIRMED)
+        self.assertEqual(process_due_retries(now=retry.next_attempt), 1)
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, RenewalRetry.Status.DONE)
+        self.assertEqual(renew_account.call_args.args[0], self.user)
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_waiting_charge_is_not_done(self, renew_account):
+        retry = schedule_retry(self._payment())
+        renew_account.side_effect = lambda user: self._payment(status=PaymentStatus.INPUT)
+        process_due_retries(now=retry.next_attempt)
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.attempts), (RenewalRetry.Status.PENDING, 1))
+        # Still waiting for the gateway: not charged again
+        process_due_retries(now=retry.next_attempt)
+        self.assertEqual(renew_account.call_count, 1)
+        # Confirmed by the gateway callback
+        models.Payment.objects.filter(status=PaymentStatus.INPUT).update(status=PaymentStatus.CONFIRMED)
+        retry.refresh_from_db()
+        process_due_retries(now=retry.next_attempt)
+        self.assertEqual(renew_account.call_count, 1)
+        self.assertEqual(RenewalRetry.objects.get(pk=retry.pk).status, RenewalRetry.Status.DONE)
+
+    @override_settings(PLANS_PAYMENTS_RETRY_MAX_POLLS=2)
+    @mock.patch("plans_payments.models.renew_account")
+    def test_stuck_waiting_charge(self, renew_account):
+        retry = schedule_retry(self._payment())
+        renew_account.side_effect = lambda user: self._payment(status=PaymentStatus.WAITING)
+        process_due_retries(now=retry.next_attempt)
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.polls), (RenewalRetry.Status.PENDING, 1))
+        process_due_retries(now=retry.next_attempt)
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.polls, retry.next_attempt), (RenewalRetry.Status.EXHAUSTED, 2, None))
+        self.assertEqual(renew_account.call_count, 1)
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_takes_over_retry_of_dead_worker(self, renew_account):
+        retry = schedule_retry(self._payment())
+        now = retry.next_attempt
+        RenewalRetry.objects.filter(pk=retry.pk).update(
+            status=RenewalRetry.Status.RUNNING, lease_until=now + timedelta(minutes=1)
+        )
+        self.assertEqual(process_due_retries(now=now), 0)
+        renew_account.side_effect = lambda user: self._payment(status=PaymentStatus.CONFIRMED)
+        self.assertEqual(process_due_retries(now=now + timedelta(minutes=2)), 1)
+        self.assertEqual(RenewalRetry.objects.get(pk=retry.pk).status, RenewalRetry.Status.DONE)
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_dead_worker_charged_already(self, renew_account):
+        retry = schedule_retry(self._payment())
+        now = retry.next_attempt
+        RenewalRetry.objects.filter(pk=retry.pk).update(status=RenewalRetry.Status.RUNNING, lease_until=now)
+        self._payment(status=PaymentStatus.CONFIRMED)
+        self.assertEqual(process_due_retries(now=now + timedelta(minutes=2)), 1)
+        renew_account.assert_not_called()
+        self.assertEqual(RenewalRetry.objects.get(pk=retry.pk).status, RenewalRetry.Status.DONE)
+
+    @mock.patch("plans_payments.models.renew_account", return_value=None)
+    def test_process_not_charged(self, renew_account):
+        retry = schedule_retry(self._payment())
+        process_due_retries(now=retry.next_attempt)
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.attempts), (RenewalRetry.Status.PENDING, 1))
+        self.assertGreater(retry.next_attempt, timezone.now())
+
+    @mock.patch("plans_payments.models.renew_account", side_effect=ValueError("gateway down"))
+    def test_process_raises(self, renew_account):
+        retry = schedule_retry(self._payment())
+        for attempts in (2, 3):
+            with self.assertLogs("plans_payments.retries", "ERROR"):
+                process_due_retries(now=retry.next_attempt)
+            retry.refresh_from_db()
+            self.assertEqual((retry.status, retry.attempts), (RenewalRetry.Status.PENDING, attempts))
+        with self.assertLogs("plans_payments.retries", "ERROR"):
+            process_due_retries(now=retry.next_attempt)
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.attempts), (RenewalRetry.Status.EXHAUSTED, 4))
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_process_not_renewed_by_task(self, renew_account):
+        retry = schedule_retry(self._payment())
+        RecurringUserPlan.objects.filter(pk=self.recurring.pk).update(payment_provider="removed")
+        process_due_retries(now=retry.next_attempt)
+        renew_account.assert_not_called()
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, RenewalRetry.Status.EXHAUSTED)
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_process_invalidated_token(self, renew_account):
+        retry = schedule_retry(self._payment())
+        RecurringUserPlan.objects.filter(pk=self.recurring.pk).update(token_verified=False)
+        process_due_retries(now=retry.next_attempt)
+        renew_account.assert_not_called()
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, RenewalRetry.Status.DEAD)
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_command(self, renew_account):
+        retry = schedule_retry(self._payment())
+        RenewalRetry.objects.filter(pk=retry.pk).update(next_attempt=timezone.now())
+        out = StringIO()
+        call_command("process_renewal_retries", stdout=out)
+        self.assertEqual(out.getvalue(), "1 renewal retries processed\n")
@@ -0,0 +1,125 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from model_bakery import baker
+from payments import PaymentStatus, RedirectNeeded
+
+from plans_payments import routers
+from plans_payments.models import Payment
+
+
+@override_settings(PLANS_PAYMENTS_REPLICA_DATABASES=["replica"])
+class ReplicaRouterTests(TestCase):
+    def test_reads_default_outside_context(self):
+        router = routers.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Payment))
+
+    def test_replica_reads(self):
+        router = routers.ReplicaRouter()
+        with routers.replica_reads():
+            self.assertEqual(router.db_for_read(Payment), "replica")
+            with routers.primary_reads():
+                self.assertEqual(router.db_for_read(Payment), "default")
+            self.assertEqual(router.db_for_read(Payment), "replica")
+
+    def test_replica_instance_written_to_primary(self):
+        payment = Payment()
+        payment._state.db = "replica"
+        self.assertEqual(routers.ReplicaRouter().db_for_write(Payment, instance=payment), "default")
+        payment._state.db = "default"
+        self.assertIsNone(routers.ReplicaRouter().db_for_write(Payment, instance=payment))
+
+    def test_no_migrations_on_replica(self):
+        self.assertFalse(routers.ReplicaRouter().allow_migrate("replica", "plans_payments"))
+        self.assertIsNone(routers.ReplicaRouter().allow_migrate("default", "plans_payments"))
+
+    @override_settings(PLANS_PAYMENTS_REPLICA_DATABASES=[])
+    def test_no_replica_configured(self):
+        with routers.replica_reads():
+            self.assertIsNone(routers.ReplicaRouter().db_for_read(Payment))
+
+
+# The test database has no real replica; the primary alias stands in for it
+# and the routing decisions are observed on get_replica_database().
+@override_settings(PLANS_PAYMENTS_REPLICA_DATABASES=["default"])
+class ReplicaViewTests(TestCase):
+    def setUp(self):
+        self.user = baker.make("User")
+        self.payment = baker.make(Payment, order__user=self.user, variant="default", billing_email="bar@baz.cz")
+        self.client.force_login(self.user)
+
+    def _get_detail(self):
+        with mock.patch("plans_payments.views.get_replica_database", wraps=routers.get_replica_database) as replica:
+            response = self.client.get(reverse("payment_details", kwargs={"payment_id": self.payment.id}))
+        return response, replica.call_count
+
+    def test_admin_changelist_reads_replica(self):
+        baker.make(Payment, status="confirmed", order__user=self.user)
+        self.client.force_login(get_user_model().objects.create_superuser("admin", "admin@example.com", "admin"))
+        with mock.patch.object(routers, "get_replica_database", wraps=routers.get_replica_database) as replica:
+            response = self.client.get(
+                reverse("admin:plans_payments_payment_changelist"), {"faulty_payments": "unconfirmed_order"}
+            )
+        self.assertContains(response, "1 payment")
+        self.assertTrue(replica.called)
+
+    def test_detail_from_replica(self):
+        response, replica_reads = self._get_detail()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica_reads, 1)
+
+    def test_detail_after_write_from_primary(self):
+        session = self.client.session
+        routers.mark_primary_write(mock.Mock(session=session))
+        session.save()
+        response, replica_reads = self._get_detail()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica_reads, 0)
+
+    def test_detail_after_lag_from_replica(self):
+        session = self.client.session
+        session[routers.LAST_WRITE_SESSION_KEY] = 0
+        session.save()
+        response, replica_reads = self._get_detail()
+        self.assertEqual(replica_reads, 1)
+
+    def test_detail_falls_back_to_primary(self):
+        queryset_class = type(Payment.objects.all())
+        original_get = queryset_class.get
+
+        def get(queryset, *args, **kwargs):
+            if queryset.db == "default" and queryset._db == "default":
+                # Simulate a replica lagging behind the primary
+                raise Payment.DoesNotExist
+            return original_get(queryset, *args, **kwargs)
+
+        with mock.patch.object(queryset_class, "get", autospec=True, side_effect=get):
+            response = self.client.get(reverse("payment_details", kwargs={"payment_id": self.payment.id}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_redirect_keeps_newer_primary_values(self):
+        def get_form(payment, data=None):
+            # Confirmed on the primary after the replica read
+            Payment.objects.filter(pk=payment.pk).update(status=PaymentStatus.CONFIRMED)
+            payment.transaction_id = "T1"
+            raise RedirectNeeded("https://3ds.example.com")
+
+        with mock.patch.object(Payment, "get_form", autospec=True, side_effect=get_form):
+            response, replica_reads = self._get_detail()
+        self.assertEqual((response.status_code, replica_reads), (302, 1))
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.transaction_id), (PaymentStatus.CONFIRMED, "T1"))
+
+    def test_detail_different_user(self):
+        self.client.force_login(baker.make("User"))
+        response, replica_reads = self._get_detail()
+        self.assertEqual(response.status_code, 404)
+
+    def test_create_marks_write(self):
+        order = baker.make("Order", user=self.user)
+        baker.make("UserPlan", user=self.user)
+        baker.make("BillingInfo", user=self.user)
+        self.client.get(reverse("create_payment", kwargs={"order_id": order.id, "payment_variant": "default"}))
+        self.assertIn(routers.LAST_WRITE_SESSION_KEY, self.client.session)
@@ -0,0 +1,185 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import django
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from model_bakery import baker
+from plans.models import RecurringUserPlan
+
+from plans_payments.models import RenewalSlot
+from plans_payments.scheduler import claim_slots, extend_lease, jitter, process_renewal_slots, schedule_renewals
+
+
+@override_settings(PLANS_AUTORENEW_SCHEDULE=[timedelta(days=3)], PLANS_PAYMENTS_RENEWAL_RATE=1000)
+class RenewalSchedulerTests(TestCase):
+    def _recurring(self, provider="default"):
+        user = baker.make("User")
+        userplan = baker.make("UserPlan", user=user, expire=timezone.localdate() + timedelta(days=1))
+        return baker.make(
+            "RecurringUserPlan",
+            user_plan=userplan,
+            payment_provider=provider,
+            renewal_triggered_by=RecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+            token_verified=True,
+            currency="EUR",
+        )
+
+    def test_jitter(self):
+        window = timedelta(hours=1)
+        offsets = [jitter(user_id, window) for user_id in range(1000)]
+        self.assertEqual(offsets[42], jitter(42, window))
+        self.assertTrue(all(timedelta(0) <= offset < window for offset in offsets))
+        # Spread over the window
+        self.assertEqual(len({int(offset.total_seconds() // 600) for offset in offsets}), 6)
+
+    def test_schedule(self):
+        first = self._recurring()
+        second = self._recurring("other")
+        start = timezone.now()
+        self.assertEqual(schedule_renewals(window=timedelta(minutes=10), start=start), 2)
+        slots = {slot.recurring_id: slot for slot in RenewalSlot.objects.all()}
+        self.assertEqual(slots[first.pk].run_at, start + jitter(first.user_plan.user_id, timedelta(minutes=10)))
+        self.assertEqual(slots[second.pk].variant, "other")
+        # Scheduling claims the renewal attempt, the accounts are not scheduled again
+        self.assertEqual(schedule_renewals(), 0)
+        self.assertEqual(RenewalSlot.objects.count(), 2)
+
+    def test_schedule_skips_pending_slots(self):
+        scheduled = self._recurring()
+        self._recurring()
+        schedule_renewals(window=timedelta(0))
+        # Due again, e.g. deferred by the circuit breaker, while its slot is still pending
+        RecurringUserPlan.objects.filter(pk=scheduled.pk).update(last_renewal_attempt=None)
+        with self.assertNumQueries(2):
+            # The due renewals and the pending slots
+            self.assertEqual(schedule_renewals(), 0)
+        scheduled.refresh_from_db()
+        self.assertIsNone(scheduled.last_renewal_attempt)
+        self.assertEqual(RenewalSlot.objects.count(), 2)
+
+    @mock.patch("plans_payments.models.renew_account", side_effect=[None, ValueError("declined")])
+    def test_process(self, renew_account):
+        self._recurring()
+        self._recurring()
+        self._recurring()
+        start = timezone.now()
+        schedule_renewals(window=timedelta(minutes=10), start=start)
+        later = RenewalSlot.objects.order_by("run_at").last()
+        RenewalSlot.objects.filter(pk=later.pk).update(run_at=start + timedelta(hours=1))
+
+        with self.assertLogs("plans_payments.scheduler", "ERROR"):
+            self.assertEqual(process_renewal_slots(now=start + timedelta(minutes=10), batch_size=1), (1, 1))
+        self.assertEqual(renew_account.call_count, 2)
+        statuses = dict(RenewalSlot.objects.values_list("pk", "status"))
+        self.assertEqual(statuses.pop(later.pk), RenewalSlot.Status.PENDING)
+        self.assertEqual(sorted(statuses.values()), [RenewalSlot.Status.DONE, RenewalSlot.Status.FAILED])
+        self.assertEqual(RenewalSlot.objects.get(status=RenewalSlot.Status.FAILED).message, "declined")
+
+    def test_claim_slots(self):
+        self._recurring()
+        self._recurring()
+        schedule_renewals(window=timedelta(0))
+        now = timezone.now()
+        first = claim_slots("a", 1, now=now, lease=timedelta(minutes=5))
+        second = claim_slots("b", 10, now=now, lease=timedelta(minutes=5))
+        self.assertEqual((len(first), len(second)), (1, 1))
+        self.assertNotEqual(first[0][0], second[0][0])
+        self.assertEqual(claim_slots("c", 10, now=now), [])
+        slot = RenewalSlot.objects.get(pk=first[0][0])
+        self.assertEqual((slot.status, slot.worker, slot.claimed), (RenewalSlot.Status.RUNNING, "a", now))
+        self.assertEqual(slot.lease_until, now + timedelta(minutes=5))
+
+        # Heartbeat
+        self.assertEqual(extend_lease("a", timedelta(hours=1)), 1)
+        self.assertEqual(claim_slots("c", 10, now=now + timedelta(minutes=10)), second)
+        # Expired leases are taken over, keeping the first claim time
+        rows = claim_slots("d", 10, now=now + timedelta(hours=2))
+        self.assertEqual([(row[0], row[3]) for row in rows], [(first[0][0], now), (second[0][0], now)])
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_lease_lost(self, renew_account):
+        self._recurring()
+        schedule_renewals(window=timedelta(0))
+
+        def take_over(*args, **kwargs):
+            RenewalSlot.objects.update(worker="other")
+            return True
+
+        with mock.patch("plans_payments.scheduler.TokenBucket.acquire", side_effect=take_over):
+            with self.assertLogs("plans_payments.scheduler", "WARNING"):
+                self.assertEqual(process_renewal_slots(worker="a"), (0, 0))
+        renew_account.assert_not_called()
+        self.assertEqual(RenewalSlot.objects.get().status, RenewalSlot.Status.RUNNING)
+
+    @mock.patch("plans_payments.scheduler.Heartbeat")
+    def test_heartbeat_during_charge(self, heartbeat):
+        self._recurring()
+        schedule_renewals(window=timedelta(0))
+
+        def charge(*args, **kwargs):
+            # A charge outlasting the lease keeps it alive
+            self.assertTrue(heartbeat.return_value.__enter__.called)
+            self.assertFalse(heartbeat.return_value.__exit__.called)
+            RenewalSlot.objects.update(lease_until=timezone.now())
+            beat, interval = heartbeat.call_args.args
+            beat()
+            self.assertEqual(interval, 150)
+            self.assertGreater(RenewalSlot.objects.get().lease_until, timezone.now() + timedelta(minutes=4))
+
+        with mock.patch("plans_payments.models.renew_account", side_effect=charge):
+            self.assertEqual(process_renewal_slots(worker="a", lease=timedelta(minutes=5)), (1, 0))
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_reclaimed_slot_already_renewed(self, renew_account):
+        recurring = self._recurring()
+        schedule_renewals(window=timedelta(0))
+        now = timezone.now()
+        claim_slots("dead", 10, now=now, lease=timedelta(0))
+        # The dead worker charged the account before dying
+        baker.make("Payment", order__user=recurring.user_plan.user, autorenewed_payment=True)
+        self.assertEqual(process_renewal_slots(now=now + timedelta(seconds=1)), (0, 0))
+        renew_account.assert_not_called()
+        slot = RenewalSlot.objects.get()
+        self.assertEqual((slot.status, slot.message), (RenewalSlot.Status.DONE, "already renewed"))
+
+    @mock.patch("plans_payments.models.renew_account")
+    def test_commands(self, renew_account):
+        self._recurring()
+        out = StringIO()
+        call_command("schedule_renewals", "--window", "0", stdout=out)
+        self.assertEqual(out.getvalue(), "1 renewals scheduled\n")
+        out = StringIO()
+        call_command("process_renewal_slots", stdout=out)
+        self.assertEqual(out.getvalue(), "1 renewals processed, 0 failed\n")
+        renew_account.assert_called_once()
+
+
+@unittest.skipUnless(django.VERSION >= (5, 1), "Concurrent SQLite writers need transaction_mode")
+class MultiProcessRenewalSlotsTests(SimpleTestCase):
+    """Workers in separate processes on a shared database charge every account exactly once."""
+
+    accounts = 60
+    workers = 4
+
+    def _run(self, env, *args):
+        return subprocess.Popen([sys.executable, "-m", "tests.renewal_workers", *args], env=env)
+
+    def test_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            env = {**os.environ, "PLANS_PAYMENTS_TEST_DB": os.path.join(directory, "db.sqlite3")}
+            charges = os.path.join(directory, "charges")
+            self.assertEqual(self._run(env, "setup", str(self.accounts)).wait(timeout=120), 0)
+            workers = [self._run(env, "work", charges) for _ in range(self.workers)]
+            self.assertEqual([worker.wait(timeout=120) for worker in workers], [0] * self.workers)
+            with open(charges) as f:
+                charged = f.read().split()
+        self.assertEqual(len(charged), self.accounts)
+        self.assertEqual(len(set(charged)), self.accounts)
@@ -0,0 +1,143 @@
+import gzip
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from model_bakery import baker
+from payments import PaymentStatus
+from plans.models import Order
+
+from plans_payments import models
+from plans_payments.settlement import SettlementFormatError, import_settlement
+
+PAYPAL_SECTIONED_CSV = """RH,2026/10/18 00:00:00 +0000,A,MERCHANT,001
+FH,01
+SH,2026/10/17 00:00:00 +0000,2026/10/17 23:59:59 +0000,MERCHANT,
+CH,Transaction ID,Transaction Status,Fee Debit or Credit,Fee Amount,Fee Currency
+SB,SALE1,S,DR,59,USD
+SB,SALE2,D,DR,0,USD
+SB,SALE3,S,DR,10,USD
+SF,,3
+RF,3
+"""
+
+
+class ImportSettlementTests(TestCase):
+    def _payment(self, **kwargs):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        return baker.make(models.Payment, order__user=user, order__status=Order.STATUS.NEW, **kwargs)
+
+    def _paypal_payment(self, sale_id):
+        payment = self._payment(variant="paypal", status=PaymentStatus.WAITING)
+        models.PaymentGatewayField.objects.create(payment=payment, key="sale_id", value=sale_id)
+        return payment
+
+    def test_paypal_csv(self):
+        confirmed = self._paypal_payment("SALE1")
+        rejected = self._paypal_payment("SALE2")
+        result = import_settlement(StringIO(PAYPAL_SECTIONED_CSV), "paypal", "csv", batch_size=2)
+        self.assertEqual(result.updated, 2)
+        self.assertEqual(result.missing, ["SALE3"])
+        confirmed.refresh_from_db()
+        rejected.refresh_from_db()
+        self.assertEqual(confirmed.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(confirmed.transaction_fee, Decimal("0.59"))
+        self.assertTrue(confirmed.transaction_fee_settled)
+        self.assertEqual(Order.objects.get(pk=confirmed.order_id).status, Order.STATUS.COMPLETED)
+        self.assertEqual(rejected.status, PaymentStatus.REJECTED)
+        self.assertEqual(Order.objects.get(pk=rejected.order_id).status, Order.STATUS.CANCELED)
+
+    def test_paypal_jsonl(self):
+        payment = self._paypal_payment("SALE1")
+        payment.change_status(PaymentStatus.CONFIRMED)
+        line = {
+            "transaction_info": {
+                "transaction_id": "SALE1",
+                "transaction_status": "V",
+                "fee_amount": {"currency_code": "USD", "value": "-0.59"},
+            },
+        }
+        import_settlement(StringIO(json.dumps(line) + "\n\n"), "paypal", "jsonl")
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentStatus.REFUNDED)
+        self.assertEqual(payment.transaction_fee, Decimal("0.59"))
+
+    def test_payu_csv(self):
+        payment = self._payment(variant="payu", transaction_id="PAYU1", total=Decimal("10.00"))
+        self.assertEqual(payment.transaction_fee, Decimal("0.34"))
+        import_settlement(StringIO("orderId,status,fee\nPAYU1,COMPLETED,25\n"), "payu", "csv")
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(payment.transaction_fee, Decimal("0.25"))
+        # The settled fee is not replaced by the estimate on save
+        payment.save()
+        payment.refresh_from_db()
+        self.assertEqual(payment.transaction_fee, Decimal("0.25"))
+
+    def test_paypal_jsonl_invalid_line(self):
+        lines = [{"transaction_info": {"transaction_id": "SALE1"}}, {"transaction_info": {}}, ["SALE3"]]
+        stream = StringIO("".join(json.dumps(line) + "\n" for line in lines))
+        with self.assertRaisesRegex(SettlementFormatError, "line 2"):
+            import_settlement(stream, "paypal", "jsonl")
+        stream = StringIO("".join(json.dumps(line) + "\n" for line in lines[::2]))
+        with self.assertRaisesRegex(SettlementFormatError, "line 2"):
+            import_settlement(stream, "paypal", "jsonl")
+
+    def test_payu_missing_column(self):
+        with self.assertRaisesRegex(SettlementFormatError, "line 2 has no 'orderId'"):
+            import_settlement(StringIO("id,status\n1,COMPLETED\n"), "payu", "csv")
+
+    def test_payu_invalid_rows(self):
+        with self.assertRaisesRegex(SettlementFormatError, "line 3"):
+            import_settlement(StringIO("orderId,status,fee\nPAYU1,COMPLETED,25\nPAYU2,COMPLETED,n/a\n"), "payu", "csv")
+        for bad_line in ["{not json", "5", json.dumps({"orderId": "PAYU2", "fee": "n/a"})]:
+            stream = StringIO(json.dumps({"orderId": "PAYU1"}) + "\n" + bad_line + "\n")
+            with self.subTest(bad_line), self.assertRaisesRegex(SettlementFormatError, "Invalid PayU order on line 2"):
+                import_settlement(stream, "payu", "jsonl")
+
+    def test_paypal_csv_invalid_fee(self):
+        report = "Transaction ID,Transaction Status,Fee Amount\nSALE1,S,-25\nSALE2,S,n/a\n"
+        with self.assertRaisesRegex(SettlementFormatError, "line 3"):
+            import_settlement(StringIO(report), "paypal", "csv")
+
+    def test_unknown_format(self):
+        with self.assertRaises(SettlementFormatError):
+            import_settlement(StringIO(""), "payu", "xml")
+
+
+class ImportSettlementCommandTests(TestCase):
+    def test_gzipped_jsonl(self):
+        payment = baker.make(
+            models.Payment,
+            variant="payu",
+            transaction_id="PAYU1",
+            status=PaymentStatus.CONFIRMED,
+            total=Decimal("10.00"),
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "payu.jsonl.gz")
+            with gzip.open(path, "wt") as f:
+                f.write(json.dumps({"orderId": "PAYU1", "fee": "31"}) + "\n")
+            out = StringIO()
+            call_command("import_settlement", path, provider="payu", stdout=out)
+        self.assertIn("1 payments updated, 0 rows without payment", out.getvalue())
+        payment.refresh_from_db()
+        self.assertEqual(payment.transaction_fee, Decimal("0.31"))
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+
+    def test_missing_file(self):
+        with self.assertRaises(CommandError):
+            call_command("import_settlement", "/nonexistent/file.csv", provider="payu")
+
+    def test_invalid_row(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "paypal.jsonl")
+            with open(path, "w") as f:
+                f.write(json.dumps({"transaction_info": {"transaction_status": "S"}}) + "\n")
+            with self.assertRaisesRegex(CommandError, "line 1"):
+                call_command("import_settlement", path, provider="paypal")
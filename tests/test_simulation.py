@@ -0,0 +1,116 @@
+import unittest
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from model_bakery import baker
+from payments import PaymentStatus
+from payments.core import PROVIDER_CACHE, provider_factory
+from payments.models import BasePayment
+from plans.models import Order, RecurringUserPlan
+
+from plans_payments import models
+from plans_payments.fake import FakeProvider
+from plans_payments.simulation import LatencyClock, fake_providers, simulate_renewals
+
+has_wallet = hasattr(BasePayment, "autocomplete_with_wallet")
+
+
+@override_settings(PLANS_AUTORENEW_SCHEDULE=[timedelta(days=3)])
+class SimulateRenewalsTests(TestCase):
+    def setUp(self):
+        self.recurrings = []
+        for _ in range(4):
+            user = baker.make("User")
+            userplan = baker.make("UserPlan", user=user, expire=timezone.localdate() + timedelta(days=1))
+            plan_pricing = baker.make("PlanPricing", plan=userplan.plan, price=12)
+            baker.make("BillingInfo", user=user, country="CZ")
+            self.recurrings.append(
+                baker.make(
+                    "RecurringUserPlan",
+                    user_plan=userplan,
+                    payment_provider="default",
+                    renewal_triggered_by=RecurringUserPlan.RENEWAL_TRIGGERED_BY.TASK,
+                    amount=14,
+                    pricing=plan_pricing.pricing,
+                    token_verified=True,
+                    currency="EUR",
+                )
+            )
+
+    def test_rolls_back(self):
+        result = simulate_renewals(latency=0.5)
+        self.assertEqual((result.due, result.accounts), (4, 4))
+        self.assertEqual(result.renewed + result.failed + result.skipped, 4)
+        self.assertGreater(result.queries_per_account, 0)
+        self.assertGreaterEqual(result.max_queries, result.queries_per_account)
+        self.assertGreater(result.peak_memory, 0)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(models.Payment.objects.exists())
+        self.assertFalse(RecurringUserPlan.objects.filter(last_renewal_attempt__isnull=False).exists())
+        # The real providers are back
+        self.assertNotIsInstance(provider_factory("default"), FakeProvider)
+
+    def test_rolls_back_per_account(self):
+        claimed = []
+
+        def renew_user(user_id, timeout=None):
+            # The claims of the accounts before were rolled back already
+            claimed.append(RecurringUserPlan.objects.filter(last_renewal_attempt__isnull=False).count())
+
+        with mock.patch("plans_payments.simulation.renew_user", side_effect=renew_user):
+            simulate_renewals()
+        self.assertEqual(claimed, [1, 1, 1, 1])
+
+    @unittest.skipUnless(has_wallet, "django-payments without autocomplete_with_wallet")
+    def test_outcomes_and_projection(self):
+        result = simulate_renewals(latency=0.5, overrides={"default": {"failure_rate": 0.5}}, seed=1)
+        self.assertEqual(result.renewed + result.failed, 4)
+        self.assertTrue(result.renewed and result.failed)
+        self.assertEqual(result.gateway_time, 2)
+        self.assertAlmostEqual(result.projected_duration, result.elapsed + 2)
+
+    def test_limit(self):
+        result = simulate_renewals(limit=2, latency=1)
+        self.assertEqual((result.due, result.accounts), (4, 2))
+        self.assertAlmostEqual(result.projected_duration, result.seconds_per_account * 4)
+
+    @mock.patch("plans_payments.models.renew_account", side_effect=ValueError("declined"))
+    def test_failure(self, renew_account):
+        result = simulate_renewals(limit=1)
+        self.assertEqual((result.failed, result.renewed), (1, 0))
+
+    def test_command(self):
+        out = StringIO()
+        call_command("simulate_renewals", "--limit", "2", "--latency", "0.2", "--failure-rate", "0.1", stdout=out)
+        self.assertIn("2 of 4 due accounts simulated", out.getvalue())
+        self.assertIn("queries per account", out.getvalue())
+        self.assertIn("projected duration", out.getvalue())
+
+
+class FakeProviderSimulationTests(SimpleTestCase):
+    def test_latency_distribution(self):
+        clock = LatencyClock()
+        provider = FakeProvider(latency=1, latency_stdev=0.5, seed=0, sleep=clock.sleep)
+        for _ in range(100):
+            provider.fetch_status(mock.Mock(transaction_id=""))
+        self.assertNotEqual(clock.total, 100)
+        self.assertAlmostEqual(clock.total / 100, 1, delta=0.2)
+
+    def test_autocomplete_with_wallet(self):
+        payment = mock.Mock(transaction_id="")
+        FakeProvider(sleep=LatencyClock().sleep).autocomplete_with_wallet(payment)
+        payment.change_status.assert_called_once_with(PaymentStatus.CONFIRMED)
+        payment = mock.Mock(transaction_id="")
+        FakeProvider(failure_rate=1).autocomplete_with_wallet(payment)
+        payment.change_status.assert_called_once_with(PaymentStatus.REJECTED, "Fake gateway failure")
+
+    def test_fake_providers(self):
+        original = PROVIDER_CACHE.get("default")
+        with fake_providers(["default"], {"latency": 2}, {"default": {"failure_rate": 1}}):
+            provider = provider_factory("default")
+            self.assertEqual((provider.latency, provider.failure_rate), (2, 1))
+        self.assertIs(PROVIDER_CACHE.get("default"), original)
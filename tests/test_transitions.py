@@ -0,0 +1,161 @@
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from model_bakery import baker
+from payments import PaymentStatus
+from plans.models import Order
+
+from plans_payments import models, transitions
+from plans_payments.bulk import bulk_change_status
+from plans_payments.events import EventKind, payment_timeline
+from plans_payments.transitions import (
+    InvalidTransition,
+    complete_order,
+    return_order,
+    transition_order,
+    transition_orders,
+    transition_payment,
+)
+
+
+class TransitionTests(TestCase):
+    def _payment(self, order_status=Order.STATUS.NEW, **kwargs):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        kwargs.setdefault("variant", "default")
+        return baker.make(models.Payment, order__user=user, order__status=order_status, **kwargs)
+
+    def test_transition_payment(self):
+        payment = self._payment(status=PaymentStatus.WAITING)
+        payment = models.Payment.objects.get(pk=payment.pk)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(transition_payment(payment, PaymentStatus.INPUT, message="3DS"))
+        # One conditional UPDATE, no read of the payment
+        self.assertEqual(
+            [query["sql"].split()[0] for query in queries if 'payments_payment"' in query["sql"]], ["UPDATE"]
+        )
+        self.assertEqual((payment.status, payment.message), (PaymentStatus.INPUT, "3DS"))
+        self.assertTrue(transition_payment(payment, PaymentStatus.CONFIRMED))
+        payment.save()  # already recorded, no event
+        self.assertEqual(models.Payment.objects.get(pk=payment.pk).status, PaymentStatus.CONFIRMED)
+        self.assertEqual(
+            [event.value for event in payment_timeline(payment) if event.kind == EventKind.STATUS],
+            [PaymentStatus.WAITING, PaymentStatus.INPUT, PaymentStatus.CONFIRMED],
+        )
+        # status_changed was sent
+        self.assertEqual(Order.objects.get(pk=payment.order_id).status, Order.STATUS.COMPLETED)
+
+    def test_concurrent_payment_change(self):
+        payment = self._payment(status=PaymentStatus.WAITING)
+        models.Payment.objects.filter(pk=payment.pk).update(status=PaymentStatus.REJECTED)
+        self.assertFalse(transition_payment(payment, PaymentStatus.CONFIRMED))
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+        self.assertEqual(models.Payment.objects.get(pk=payment.pk).status, PaymentStatus.REJECTED)
+        self.assertEqual(Order.objects.get(pk=payment.order_id).status, Order.STATUS.NEW)
+
+    def test_change_status(self):
+        payment = self._payment(status=PaymentStatus.WAITING)
+        models.Payment.objects.filter(pk=payment.pk).update(status=PaymentStatus.REJECTED)
+        self.assertFalse(payment.change_status(PaymentStatus.CONFIRMED))
+        # Reloaded, not overwritten by a later save
+        self.assertEqual(payment.status, PaymentStatus.REJECTED)
+        payment.save()
+        self.assertEqual(Order.objects.get(pk=payment.order_id).status, Order.STATUS.NEW)
+        with self.assertLogs(logger="plans_payments.models", level="WARNING"):
+            self.assertFalse(payment.change_status(PaymentStatus.CONFIRMED))
+        self.assertEqual(models.Payment.objects.get(pk=payment.pk).status, PaymentStatus.REJECTED)
+        self.assertFalse(payment.change_status(PaymentStatus.REJECTED, "declined"))
+        self.assertEqual(models.Payment.objects.get(pk=payment.pk).message, "declined")
+
+    def test_bulk_concurrent_change(self):
+        first = self._payment(status=PaymentStatus.WAITING, transaction_id="T1")
+        second = self._payment(status=PaymentStatus.WAITING, transaction_id="T2")
+        refunded = self._payment(status=PaymentStatus.REFUNDED, transaction_id="T3")
+
+        def transition_payments(*args, **kwargs):
+            # Rejected by a webhook after the batch was read
+            models.Payment.objects.filter(pk=second.pk).update(status=PaymentStatus.REJECTED)
+            return real(*args, **kwargs)
+
+        real = transitions.transition_payments
+        with mock.patch("plans_payments.bulk.transition_payments", transition_payments), self.assertLogs(
+            logger="plans_payments.bulk", level="WARNING"
+        ):
+            result = bulk_change_status((f"T{i}", PaymentStatus.CONFIRMED, None) for i in range(1, 4))
+        self.assertEqual((result.updated, result.changed, result.invalid_transitions), (3, 1, 1))
+        self.assertEqual(models.Payment.objects.get(pk=second.pk).status, PaymentStatus.REJECTED)
+        self.assertEqual(models.Payment.objects.get(pk=refunded.pk).status, PaymentStatus.REFUNDED)
+        self.assertEqual(Order.objects.get(pk=first.order_id).status, Order.STATUS.COMPLETED)
+        self.assertEqual(Order.objects.get(pk=second.order_id).status, Order.STATUS.NEW)
+        self.assertEqual(Order.objects.get(pk=refunded.order_id).status, Order.STATUS.NEW)
+
+    def test_complete_order(self):
+        order = self._payment().order
+        with mock.patch.object(Order, "complete_order", autospec=True, side_effect=Order.complete_order) as complete:
+            self.assertTrue(complete_order(order))
+            self.assertFalse(complete_order(order))
+        complete.assert_called_once()
+        self.assertEqual(order.status, Order.STATUS.COMPLETED)
+        self.assertIsNotNone(order.completed)
+        self.assertEqual(Order.objects.get(pk=order.pk).status, Order.STATUS.COMPLETED)
+
+    def test_return_order(self):
+        order = self._payment(order_status=Order.STATUS.NOT_VALID).order
+        self.assertTrue(return_order(order, "refunded"))
+        self.assertEqual(order.status, Order.STATUS.RETURNED)
+        self.assertEqual(Order.objects.get(pk=order.pk).status, Order.STATUS.RETURNED)
+        self.assertFalse(return_order(order))
+        canceled = self._payment(order_status=Order.STATUS.CANCELED).order
+        with self.assertRaises(ValueError):
+            return_order(canceled)
+        self.assertEqual(Order.objects.get(pk=canceled.pk).status, Order.STATUS.CANCELED)
+
+    def test_invalid_transition(self):
+        payment = self._payment(status=PaymentStatus.REFUNDED)
+        with self.assertRaises(InvalidTransition):
+            transition_payment(payment, PaymentStatus.CONFIRMED)
+        with self.assertRaises(InvalidTransition):
+            transition_order(payment.order, Order.STATUS.NEW)
+
+    def test_transition_orders(self):
+        new = self._payment().order
+        completed = self._payment(order_status=Order.STATUS.COMPLETED).order
+        returned = self._payment(order_status=Order.STATUS.RETURNED).order
+        with self.assertNumQueries(1):
+            changed = transition_orders([new.pk, completed.pk, returned.pk], Order.STATUS.CANCELED)
+        self.assertEqual(changed, 2)
+        self.assertEqual(Order.objects.get(pk=completed.pk).status, Order.STATUS.COMPLETED)
+        self.assertFalse(transition_order(completed, Order.STATUS.RETURNED, expected=Order.STATUS.NOT_VALID))
+        self.assertTrue(transition_order(completed, Order.STATUS.RETURNED))
+        self.assertEqual(completed.status, Order.STATUS.RETURNED)
+
+    def test_rejected_payment_keeps_concurrently_completed_order(self):
+        payment = self._payment(status=PaymentStatus.WAITING)
+        payment = models.Payment.objects.select_related("order").get(pk=payment.pk)
+        # Completed by another payment after this one was loaded
+        Order.objects.filter(pk=payment.order_id).update(status=Order.STATUS.COMPLETED)
+        payment.change_status(PaymentStatus.REJECTED)
+        self.assertEqual(Order.objects.get(pk=payment.order_id).status, Order.STATUS.COMPLETED)
+
+    def test_rejected_payment_cancels_order(self):
+        payment = self._payment(status=PaymentStatus.WAITING)
+        payment.change_status(PaymentStatus.REJECTED)
+        self.assertEqual(payment.order.status, Order.STATUS.CANCELED)
+        self.assertEqual(Order.objects.get(pk=payment.order_id).status, Order.STATUS.CANCELED)
+
+    def test_records_history(self):
+        payment = self._payment(status=PaymentStatus.WAITING)
+        # As django-simple-history registers it
+        with mock.patch.object(Order, "history", create=True) as history:
+            payment.change_status(PaymentStatus.REJECTED)
+            history.bulk_history_create.assert_called_once_with(
+                [payment.order],
+                update=True,
+                default_change_reason="Django-plans-payments: Payment status changed to rejected",
+            )
+            history.reset_mock()
+            # No transition, no history
+            self.assertFalse(transition_order(payment.order, Order.STATUS.CANCELED, expected=Order.STATUS.NEW))
+            history.bulk_history_create.assert_not_called()
@@ -0,0 +1,59 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from model_bakery import baker
+
+from plans_payments import models
+from plans_payments.users import backfill_payment_user
+from plans_payments.views import create_payment_object
+
+
+class PaymentUserTests(TestCase):
+    def test_set_on_create(self):
+        user = baker.make("User")
+        payment = baker.make(models.Payment, order__user=user, variant="default")
+        self.assertEqual(payment.user, user)
+
+    def test_create_payment_object(self):
+        user = baker.make("User")
+        baker.make("UserPlan", user=user)
+        baker.make("BillingInfo", user=user)
+        order = baker.make("Order", user=user, amount=10, tax=0, currency="EUR")
+        self.assertEqual(create_payment_object("default", order).user_id, user.pk)
+
+    def test_backfill(self):
+        payments = [baker.make(models.Payment, order__user=baker.make("User"), variant="default") for _ in range(5)]
+        orphan = baker.make(models.Payment, order=None, variant="default")
+        models.Payment.objects.update(user=None)
+        self.assertEqual(
+            list(backfill_payment_user(batch_size=2, start_pk=orphan.pk - 6)),
+            [orphan.pk - 4, orphan.pk - 2, orphan.pk],
+        )
+        for payment in payments:
+            payment.refresh_from_db()
+            self.assertEqual(payment.user_id, payment.order.user_id)
+        orphan.refresh_from_db()
+        self.assertIsNone(orphan.user_id)
+
+    def test_backfill_command(self):
+        payment = baker.make(models.Payment, order__user=baker.make("User"), variant="default")
+        models.Payment.objects.update(user=None)
+        out = StringIO()
+        call_command("backfill_payment_user", stdout=out)
+        self.assertIn(f"Payment users backfilled up to pk {payment.pk}", out.getvalue())
+        payment.refresh_from_db()
+        self.assertEqual(payment.user_id, payment.order.user_id)
+
+    @override_settings(PLANS_PAYMENTS_DENORMALIZED_USER=True)
+    def test_ownership_uses_user(self):
+        user = baker.make("User")
+        payment = baker.make(models.Payment, order__user=user, variant="default")
+        # Denormalized lookups do not join the order
+        models.Payment.objects.filter(pk=payment.pk).update(order=None)
+        self.client.force_login(user)
+        response = self.client.get(reverse("payment_history"))
+        self.assertEqual([row["id"] for row in response.json()["results"]], [payment.pk])
+        self.client.force_login(baker.make("User"))
+        self.assertEqual(self.client.get(reverse("payment_history")).json()["results"], [])
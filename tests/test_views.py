@@ -1,7 +1,9 @@
+from datetime import timedelta
 from unittest import mock
 
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from model_bakery import baker
 from payments import PaymentStatus, RedirectNeeded
 
@@ -118,3 +120,54 @@ class AdminSmokeTests(TestCase):
 
         payment_admin = PaymentAdmin(Payment, AdminSite())
         self.assertIn("status", payment_admin.list_display)
+
+
+class PaymentHistoryViewTests(TestCase):
+    def setUp(self):
+        self.user = baker.make("User")
+        self.client.force_login(self.user)
+
+    def _payments(self, count, user=None):
+        payments = baker.make(Payment, order__user=user or self.user, variant="default", _quantity=count)
+        # Same creation time for some of them, the id breaks the tie
+        for i, payment in enumerate(payments):
+            Payment.objects.filter(pk=payment.pk).update(created=timezone.now() - timedelta(days=i // 2))
+        return payments
+
+    def test_pagination(self):
+        payments = self._payments(5)
+        self._payments(2, user=baker.make("User"))
+        ids = []
+        cursor = None
+        pages = 0
+        while True:
+            params = {"limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            data = self.client.get(reverse("payment_history"), params).json()
+            ids += [row["id"] for row in data["results"]]
+            pages += 1
+            cursor = data["next"]
+            if not cursor:
+                break
+        self.assertEqual(pages, 3)
+        expected = sorted(payments, key=lambda p: (Payment.objects.get(pk=p.pk).created, p.pk), reverse=True)
+        self.assertEqual(ids, [p.pk for p in expected])
+
+    def test_columns(self):
+        payment = self._payments(1)[0]
+        row = self.client.get(reverse("payment_history")).json()["results"][0]
+        self.assertEqual(
+            set(row), {"id", "created", "status", "variant", "total", "currency", "description", "order_id"}
+        )
+        self.assertEqual(row["order_id"], payment.order_id)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(reverse("payment_history"), {"cursor": "nonsense"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("payment_history"), {"limit": "1000"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("payment_history"), {"limit": "x"}).status_code, 400)
+
+    def test_anonymous(self):
+        self.client.logout()
+        response = self.client.get(reverse("payment_history"))
+        self.assertRedirects(response, "/login/?next=/payment_history/")
@@ -0,0 +1,103 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from model_bakery import baker
+
+from plans_payments import models
+from plans_payments.webhooks import LRUCache, get_event_id, process_data, processed_events, static_callback
+
+
+class WebhookDeduplicationTests(TestCase):
+    def setUp(self):
+        processed_events.clear()
+        self.addCleanup(processed_events.clear)
+        self.payment = baker.make(models.Payment, variant="default", total=Decimal("10.00"))
+        self.factory = RequestFactory()
+
+    def _post(self, body=b'{"order": {"status": "COMPLETED"}}', **headers):
+        request = self.factory.post("/process/", body, content_type="application/json", headers=headers)
+        with self.captureOnCommitCallbacks(execute=True):
+            return process_data(request, self.payment.token)
+
+    @mock.patch("payments.dummy.DummyProvider.process_data", return_value=HttpResponse("processed"))
+    def test_retries_are_not_processed(self, provider_process_data):
+        self.assertEqual(self._post().content, b"processed")
+        with self.assertNumQueries(0):
+            response = self._post()
+        self.assertEqual((response.status_code, response.content), (200, b""))
+        # Another process (empty cache) finds the stored event
+        processed_events.clear()
+        self.assertEqual(self._post().content, b"")
+        self.assertEqual(provider_process_data.call_count, 1)
+        # A different notification is processed
+        self._post(b'{"order": {"status": "CANCELED"}}')
+        self.assertEqual(provider_process_data.call_count, 2)
+        self.assertEqual(models.WebhookEvent.objects.filter(scope=str(self.payment.token)).count(), 2)
+
+    @mock.patch(
+        "payments.dummy.DummyProvider.process_data",
+        side_effect=[HttpResponse(status=403), ValueError("broken"), HttpResponse("processed")],
+    )
+    def test_failed_processing_is_retried(self, provider_process_data):
+        self.assertEqual(self._post().status_code, 403)
+        with self.assertRaises(ValueError):
+            self._post()
+        self.assertEqual(self._post().content, b"processed")
+        self.assertEqual(provider_process_data.call_count, 3)
+        self.assertEqual(models.WebhookEvent.objects.count(), 1)
+
+    @mock.patch("payments.dummy.DummyProvider.process_data", return_value=HttpResponse("processed"))
+    def test_static_callback(self, provider_process_data):
+        request = self.factory.post("/process/default/", b"{}", content_type="application/json")
+        with mock.patch("payments.dummy.DummyProvider.get_token_from_request", return_value=self.payment.token):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(static_callback(request, "default").content, b"processed")
+            self.assertEqual(static_callback(request, "default").content, b"")
+        self.assertEqual(provider_process_data.call_count, 1)
+
+    @mock.patch("payments.dummy.DummyProvider.process_data", return_value=HttpResponse("processed"))
+    def test_returning_customer_not_deduplicated(self, provider_process_data):
+        with self.settings(ROOT_URLCONF="plans_payments.webhook_urls"):
+            url = reverse("process_payment", kwargs={"token": self.payment.token})
+        self.assertEqual(url, f"/process/{self.payment.token}/")
+        for _ in range(2):
+            self.assertEqual(process_data(self.factory.get(url), self.payment.token).content, b"processed")
+        self.assertEqual(provider_process_data.call_count, 2)
+        self.assertFalse(models.WebhookEvent.objects.exists())
+
+    def test_event_id(self):
+        request = self.factory.post("/", b"{}", content_type="application/json", headers={"Webhook-Id": "evt_1"})
+        self.assertEqual(get_event_id(request), "evt_1")
+        provider = mock.Mock(get_webhook_event_id=mock.Mock(return_value=42))
+        self.assertEqual(get_event_id(self.factory.post("/", b"{}", content_type="application/json"), provider), "42")
+        self.assertTrue(
+            get_event_id(self.factory.post("/", b"{}", content_type="application/json")).startswith("sha256:")
+        )
+
+    def test_prune_command(self):
+        old = models.WebhookEvent.objects.create(scope="default", event_id="old")
+        models.WebhookEvent.objects.filter(pk=old.pk).update(created=timezone.now() - timedelta(days=40))
+        models.WebhookEvent.objects.create(scope="default", event_id="new")
+        out = StringIO()
+        call_command("prune_webhook_events", "--days", "30", stdout=out)
+        self.assertEqual(out.getvalue(), "1 webhook events deleted\n")
+        self.assertEqual(list(models.WebhookEvent.objects.values_list("event_id", flat=True)), ["new"])
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.add("a")
+        cache.add("b")
+        self.assertIn("a", cache)
+        cache.add("c")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 2)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+from django.contrib import admin
 from django.contrib.auth import views as auth_views
 from django.urls import include, path
 
@@ -8,4 +9,5 @@ urlpatterns = [
     path("", include("plans_payments.urls")),
     path("login/", auth_views.LoginView.as_view(), name="auth_login"),
     path("", include("plans.urls")),
+    path("admin/", admin.site.urls),
 ]